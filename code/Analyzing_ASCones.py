@@ -0,0 +1,298 @@
+import os
+import sqlite3
+import time
+from pathlib import Path
+import numpy as np
+import dbStructure
+import Index_ASGraph
+
+def popcount(bits):
+    try:
+        return bits.bit_count()
+    except AttributeError:
+        # int.bit_count is new in Python 3.10
+        return bin(bits).count('1')
+
+def adjacency_lists(graph, rel):
+    """Returns, for every AS id, the ids linked to it with the relationship code rel."""
+    src = np.repeat(np.arange(len(graph.asns)), np.diff(graph.indptr))
+    mask = np.asarray(graph.rels) == rel
+    src = src[mask]
+    dst = np.asarray(graph.indices)[mask]
+    bounds = np.zeros(len(graph.asns) + 1, dtype=np.int64)
+    bounds[1:] = np.cumsum(np.bincount(src, minlength=len(graph.asns)))
+    dst = dst.tolist()
+    bounds = bounds.tolist()
+    return [dst[bounds[i]:bounds[i+1]] for i in range(len(graph.asns))]
+
+def strongly_connected(succ):
+    """Returns the strongly connected components of the graph succ (lists of ids),
+    each one after every component it can reach (Tarjan, without recursion)."""
+    n = len(succ)
+    index = [-1] * n
+    low = [0] * n
+    on_stack = [False] * n
+    stack = []
+    components = []
+    counter = 0
+    for root in range(n):
+        if index[root] >= 0:
+            continue
+        work = [(root, 0)]
+        while work:
+            v, child = work.pop()
+            if child == 0:
+                index[v] = counter
+                low[v] = counter
+                counter += 1
+                stack.append(v)
+                on_stack[v] = True
+            elif low[succ[v][child-1]] < low[v]:
+                # returning from the child that was just visited
+                low[v] = low[succ[v][child-1]]
+            while child < len(succ[v]):
+                w = succ[v][child]
+                child += 1
+                if index[w] < 0:
+                    work.append((v, child))
+                    work.append((w, 0))
+                    break
+                if on_stack[w] and index[w] < low[v]:
+                    low[v] = index[w]
+            else:
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        component.append(w)
+                        if w == v:
+                            break
+                    components.append(component)
+    return components
+
+class AnalyzingASCones:
+    """
+        Computes, for every AS in asn_conn, in one pass over the AS graph:
+            the size of its customer cone (itself and every AS below it over
+                provider to customer links),
+            how many ASes are above it over customer to provider links,
+            the fewest customer to provider links to an AS without providers,
+            and how many other ASes it reaches over a valley-free path
+                (up any number of providers, across at most one peer,
+                then down any number of customers).
+        Sets of ASes are Python ints used as bitsets, with bit i for AS id i.
+        The sets are computed in the order of the strongly connected components,
+        so each one is built from the sets already computed for its neighbors.
+        The cone of every AS with customers is kept until the second pass
+        has read it for the last time, so the peak memory is those cones.
+        The upstream and reach sets of a component are dropped as soon as
+        the last component above it is done.
+        The results are cached in the asn_cone table for the date of the links,
+        and dropped by an incremental update (-c --incremental) that replaces those links.
+    """
+    def __init__(self, db_file, asn=None):
+        self.db_file = db_file
+        self.asn = asn
+        name, fields = self.read_fields(dbStructure.sql_create_asn_cone_table)
+        self.asn_cone_table = name
+        self.asn_cone_header = fields
+
+    def read_fields(self, sql_str):
+        """Reads in the table name and field names from the dbStructure file.
+        The dbStructure file should be the standard for the DB,
+        and everything should reference it for the ground truth."""
+        table_fields = []
+        table_name = sql_str.split('\n')[0].rstrip().split(' ')[-1].replace('(', '')
+        sql_list = sql_str.split('\n')[1:-1]
+        for row in sql_list:
+            field = row.lstrip().split(' ')[0].upper()
+            if 'PRIMARY' in field or 'FOREIGN' in field:
+                continue
+            table_fields.append(field)
+        return table_name, table_fields
+
+    def run_steps(self):
+        print("Analyzing the customer cones of the ASes in asn_conn.")
+        if self.db_file is None or not os.path.isfile(self.db_file):
+            print("\tDatabase does not exist. Create database before analyzing it.")
+            return
+        conn = sqlite3.connect(self.db_file)
+        try:
+            conn.execute(dbStructure.sql_create_asn_cone_table)
+            for index_sql in dbStructure.sql_create_asn_cone_indexes:
+                conn.execute(index_sql)
+            latest = conn.execute("""SELECT source, asof_date FROM asn_conn
+                    ORDER BY asof_date DESC LIMIT 1""").fetchone()
+            if latest is None:
+                print("\tThere are no AS links in the database. Process the ASRank data first.")
+                return
+            source, asof_date = latest
+            cached = conn.execute(f"""SELECT COUNT(*) FROM {self.asn_cone_table}
+                    WHERE source=? AND asof_date=?""", (source, asof_date)).fetchone()[0]
+            if cached:
+                print(f"\tUsing the {cached} cached rows for {source} {asof_date}.")
+            else:
+                rows = self.compute(conn, source, asof_date)
+                self.save_rows(conn, rows, source, asof_date)
+            self.print_summary(conn, source, asof_date)
+        finally:
+            conn.close()
+
+    def compute(self, conn, source, asof_date):
+        start_time = time.time()
+        links = conn.execute("""SELECT relationship_type, asn1, asn2 FROM asn_conn
+                WHERE source=? AND asof_date=?""", (source, asof_date))
+        graph = Index_ASGraph.graph_from_rows(links)
+        print(f"\tBuilt the graph of {len(graph)} ASes from {source} {asof_date}.")
+        customers = adjacency_lists(graph, Index_ASGraph.P2C)
+        providers = adjacency_lists(graph, Index_ASGraph.C2P)
+        peers = adjacency_lists(graph, Index_ASGraph.P2P)
+
+        cone_sizes, cones = self.customer_cones(customers, providers, peers)
+        upstream_sizes, reach_sizes = self.upstream_and_reach(customers, providers, peers, cones)
+        depths = self.provider_depths(customers, providers)
+        print(f"\tComputed the cones of {len(graph)} ASes in {time.time() - start_time:.2f} s.")
+
+        rows = []
+        for i, asn in enumerate(graph.asns.tolist()):
+            depth = depths[i] if depths[i] >= 0 else None
+            rows.append([asn, cone_sizes[i], upstream_sizes[i], depth, reach_sizes[i],
+                    source, asof_date])
+        return rows
+
+    def customer_cones(self, customers, providers, peers):
+        """Returns the cone size of every AS, and the cones of the ASes that have customers.
+        The cone of an AS without customers is only itself, so it is not stored."""
+        cone_sizes = [1] * len(customers)
+        cones = {}
+        for component in strongly_connected(customers):
+            if len(component) == 1 and not customers[component[0]]:
+                continue
+            members = set(component)
+            bits = 0
+            for v in component:
+                bits |= 1 << v
+                for c in customers[v]:
+                    if not c in members:
+                        bits |= cones.get(c, 1 << c)
+            size = popcount(bits)
+            for v in component:
+                cone_sizes[v] = size
+                if customers[v]:
+                    cones[v] = bits
+        return cone_sizes, cones
+
+    def upstream_and_reach(self, customers, providers, peers, cones):
+        """Returns how many ASes are above each AS, and how many it reaches valley free.
+        The reach of an AS is everything below itself or its peers,
+        plus the reach of its providers.
+        Each cone is removed from cones once it has been read by its AS and all its peers."""
+        upstream_sizes = [0] * len(customers)
+        reach_sizes = [0] * len(customers)
+        components = strongly_connected(providers)
+        comp_of = [0] * len(customers)
+        for k, component in enumerate(components):
+            for v in component:
+                comp_of[v] = k
+        # how many components above each component still need its sets
+        remaining = [0] * len(components)
+        for k, component in enumerate(components):
+            for d in {comp_of[p] for v in component for p in providers[v]} - {k}:
+                remaining[d] += 1
+        cone_reads = {v:1 + len(peers[v]) for v in cones}
+
+        def read_cone(v):
+            if not v in cones:
+                return 1 << v
+            bits = cones[v]
+            cone_reads[v] -= 1
+            if cone_reads[v] == 0:
+                del cones[v]
+            return bits
+
+        upstream = {}
+        reach = {}
+        for k, component in enumerate(components):
+            up_bits = 0
+            reach_bits = 0
+            below = set()
+            for v in component:
+                up_bits |= 1 << v
+                reach_bits |= read_cone(v)
+                for p in peers[v]:
+                    reach_bits |= read_cone(p)
+                for p in providers[v]:
+                    if comp_of[p] != k:
+                        below.add(comp_of[p])
+            for d in below:
+                up_bits |= upstream[d]
+                reach_bits |= reach[d]
+                remaining[d] -= 1
+                if remaining[d] == 0:
+                    del upstream[d]
+                    del reach[d]
+            up_size = popcount(up_bits) - 1
+            reach_size = popcount(reach_bits) - 1
+            for v in component:
+                upstream_sizes[v] = up_size
+                reach_sizes[v] = reach_size
+            if remaining[k]:
+                upstream[k] = up_bits
+                reach[k] = reach_bits
+        return upstream_sizes, reach_sizes
+
+    def provider_depths(self, customers, providers):
+        """Returns the fewest customer to provider links from each AS to an AS
+        without providers, or -1 if there is no such chain."""
+        depths = [-1] * len(customers)
+        frontier = [v for v in range(len(customers)) if not providers[v]]
+        for v in frontier:
+            depths[v] = 0
+        depth = 0
+        while frontier:
+            depth += 1
+            next_frontier = []
+            for v in frontier:
+                for c in customers[v]:
+                    if depths[c] < 0:
+                        depths[c] = depth
+                        next_frontier.append(c)
+            frontier = next_frontier
+        return depths
+
+    def save_rows(self, conn, rows, source, asof_date):
+        conn.execute(f"DELETE FROM {self.asn_cone_table} WHERE source=? AND asof_date=?",
+                (source, asof_date))
+        fields = ", ".join(self.asn_cone_header)
+        places = ", ".join(["?"] * len(self.asn_cone_header))
+        conn.executemany(f"INSERT INTO {self.asn_cone_table} ({fields}) VALUES ({places})", rows)
+        conn.commit()
+        print(f"\tSaved {len(rows)} rows to {self.asn_cone_table}.")
+
+    def print_summary(self, conn, source, asof_date):
+        if self.asn:
+            query = f"""SELECT * FROM {self.asn_cone_table}
+                    WHERE asn=? AND source=? AND asof_date=?"""
+            row = conn.execute(query, (self.asn, source, asof_date)).fetchone()
+            if row is None:
+                print(f"\tAS{self.asn} has no links in {source} {asof_date}.")
+                return
+            for field, value in zip(self.asn_cone_header, row):
+                print(f"\t{field}: {value}")
+            return
+        query = f"""SELECT asn, customer_cone_size FROM {self.asn_cone_table}
+                WHERE source=? AND asof_date=? ORDER BY customer_cone_size DESC LIMIT 10"""
+        print("\tThe largest customer cones:")
+        for asn, size in conn.execute(query, (source, asof_date)):
+            print(f"\t\tAS{asn}: {size}")
+
+if __name__ == "__main__":
+    print("This script should not be run by itself. Run it through iGDB.py")
+    db_dir = Path("../database")
+    db_file = None
+    if os.path.isdir(db_dir):
+        for f in os.listdir(db_dir):
+            db_file = db_dir / f
+    my_analyzer = AnalyzingASCones(db_file)
+    my_analyzer.run_steps()
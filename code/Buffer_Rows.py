@@ -0,0 +1,223 @@
+from pathlib import Path
+import os
+import csv
+import shutil
+import hashlib
+import tempfile
+from array import array
+
+# the array type used for each SQL type, everything else is dictionary encoded
+array_types = {"integer":'q', "numeric":'d'}
+int_min = -2**63
+int_max = 2**63 - 1
+
+def read_table_fields(sql_str):
+    """Reads in the table name, field names and field types from the dbStructure file."""
+    table_fields = []
+    field_types = []
+    table_name = sql_str.split('\n')[0].rstrip().split(' ')[-1].replace('(', '')
+    for row in sql_str.split('\n')[1:-1]:
+        parts = row.strip().rstrip(',').split()
+        if len(parts) < 2 or 'PRIMARY' in parts[0].upper() or 'FOREIGN' in parts[0].upper():
+            continue
+        table_fields.append(parts[0].upper())
+        field_types.append(parts[1].lower())
+    return table_name, table_fields, field_types
+
+def read_field_types(sql_str):
+    """Returns the SQL type of each field in a dbStructure table definition."""
+    return read_table_fields(sql_str)[2]
+
+def to_array_value(value, type_code):
+    """Returns the value as it is stored in an array of type_code,
+    or None if it cannot be stored without changing how it is written out.
+    Strings are only converted if they are written out the same way afterwards."""
+    if type_code == 'q':
+        if type(value) is str:
+            try:
+                if str(int(value)) == value:
+                    value = int(value)
+            except ValueError:
+                return None
+        # bool is a subclass of int but is written as True or False
+        if type(value) is int and int_min <= value <= int_max:
+            return value
+    else:
+        if type(value) is str:
+            try:
+                if str(float(value)) == value:
+                    value = float(value)
+            except ValueError:
+                return None
+        if type(value) is float:
+            return value
+    return None
+
+class ColumnarBuffer:
+    """
+        Collects the rows of one output table column by column.
+        The integer and numeric columns are kept in arrays, and the other
+        columns are dictionary encoded, so a value repeated in every row,
+        like the source or the date, is only stored once.
+        A value that does not fit its column, e.g. 'NULL' in a numeric column,
+        is kept as it is in the exceptions of that column.
+        Above spill_rows rows the buffer is written to a temporary csv file,
+        and write_csv copies the spilled files before the rows still in memory.
+        With dedup, rows equal to one already added are dropped and counted
+        per value of the SOURCE field, if the table has one.
+    """
+    def __init__(self, sql_str, dedup=False, spill_rows=1000000, spill_dir=None):
+        self.table_name, self.header, self.field_types = read_table_fields(sql_str)
+        self.type_codes = [array_types.get(t) for t in self.field_types]
+        self.dedup = dedup
+        self.spill_rows = spill_rows
+        self.spill_dir = spill_dir
+        if 'SOURCE' in self.header:
+            self.source_idx = self.header.index('SOURCE')
+        else:
+            self.source_idx = None
+        self.seen = set()
+        self.duplicates = {}
+        self.spill_files = []
+        self.num_spilled = 0
+        self.clear()
+
+    def clear(self):
+        """Empties the in-memory rows. The dictionaries start over as well,
+        so the values of rows already spilled are not kept."""
+        self.num_rows = 0
+        self.columns = []
+        self.values = []
+        self.codes = []
+        self.exceptions = [{} for t in self.type_codes]
+        for type_code in self.type_codes:
+            if type_code:
+                self.columns.append(array(type_code))
+                self.values.append(None)
+                self.codes.append(None)
+            else:
+                self.columns.append(array('i'))
+                self.values.append([])
+                self.codes.append({})
+
+    def append(self, row):
+        """Adds the row. With dedup, returns False if an equal row was already added."""
+        if self.dedup:
+            key = hashlib.blake2b(repr(tuple(row)).encode(), digest_size=16).digest()
+            if key in self.seen:
+                if self.source_idx is None:
+                    source = ''
+                else:
+                    source = row[self.source_idx]
+                self.duplicates[source] = self.duplicates.get(source, 0) + 1
+                return False
+            self.seen.add(key)
+
+        for i, value in enumerate(row):
+            type_code = self.type_codes[i]
+            if type_code:
+                stored = to_array_value(value, type_code)
+                if stored is None:
+                    self.exceptions[i][self.num_rows] = value
+                    stored = 0
+                self.columns[i].append(stored)
+                continue
+            try:
+                code = self.codes[i].get(value)
+            except TypeError:
+                # an unhashable value cannot be a dictionary key
+                self.exceptions[i][self.num_rows] = value
+                self.columns[i].append(-1)
+                continue
+            if code is None:
+                code = len(self.values[i])
+                self.codes[i][value] = code
+                self.values[i].append(value)
+            self.columns[i].append(code)
+        self.num_rows += 1
+
+        if self.num_rows >= self.spill_rows:
+            self.spill()
+        return True
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return self.num_spilled + self.num_rows
+
+    def iter_chunks(self, chunk_size=100000):
+        """Yields the in-memory rows as lists of at most chunk_size rows."""
+        for start in range(0, self.num_rows, chunk_size):
+            end = min(start + chunk_size, self.num_rows)
+            columns = []
+            for i, column in enumerate(self.columns):
+                if self.type_codes[i]:
+                    values = column[start:end].tolist()
+                else:
+                    lookup = self.values[i]
+                    values = [lookup[c] for c in column[start:end]]
+                for j, value in self.exceptions[i].items():
+                    if start <= j < end:
+                        values[j - start] = value
+                columns.append(values)
+            yield [list(r) for r in zip(*columns)]
+
+    def write_rows(self, f):
+        csv_writer = csv.writer(f, delimiter=',')
+        for chunk in self.iter_chunks():
+            csv_writer.writerows(chunk)
+
+    def spill(self):
+        if self.num_rows == 0:
+            return
+        if self.spill_dir is not None and not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        fd, f_name = tempfile.mkstemp(prefix=f".{self.table_name}_", suffix=".spill", dir=self.spill_dir)
+        with os.fdopen(fd, 'w') as f:
+            self.write_rows(f)
+        self.spill_files.append(f_name)
+        self.num_spilled += self.num_rows
+        self.clear()
+
+    def write_csv(self, f_name):
+        """Writes the header and every row to f_name, and removes the spill files.
+        The buffer is empty afterwards."""
+        print(f"\tSaving to {f_name}.")
+        with open(f_name, 'w') as f:
+            csv_writer = csv.writer(f, delimiter=',')
+            csv_writer.writerow(self.header)
+            f.flush()
+            for spill_file in self.spill_files:
+                # the spilled rows are already csv, so they are copied as bytes
+                with open(spill_file, 'rb') as s:
+                    shutil.copyfileobj(s, f.buffer)
+            self.write_rows(f)
+        self.close()
+
+    def close(self):
+        for spill_file in self.spill_files:
+            if os.path.isfile(spill_file):
+                os.remove(spill_file)
+        self.spill_files = []
+        self.num_spilled = 0
+        self.clear()
+
+    def report(self):
+        for source, count in self.duplicates.items():
+            if source:
+                print(f"\tSkipped {count} duplicate {self.table_name} rows from {source}.")
+            else:
+                print(f"\tSkipped {count} duplicate {self.table_name} rows.")
+
+if __name__ == "__main__":
+    print("This script should not be run by itself. Run it through iGDB.py")
+    import dbStructure
+    my_rows = ColumnarBuffer(dbStructure.sql_create_asn_asname_table, dedup=True, spill_rows=2)
+    my_rows.append([3356, 'LEVEL3', 'test', '2022-10-08'])
+    my_rows.append([3356, 'LEVEL3', 'test', '2022-10-08'])
+    my_rows.append([174, 'COGENT', 'test', '2022-10-08'])
+    my_rows.append(['NULL', 'UNKNOWN', 'test', '2022-10-08'])
+    my_rows.report()
+    my_rows.write_csv(Path(tempfile.gettempdir()) / "asn_asname_example.csv")
@@ -1,9 +1,10 @@
 import os
 from pathlib import Path
-import requests
 import json
-from time import sleep
+import math
 from datetime import datetime
+import Fetch_Pages
+import Journal_Crawls
 
 class CrawlingASRank:
     """
@@ -17,6 +18,10 @@ class CrawlingASRank:
         self.links_base_url = "https://api.asrank.caida.org/v2/restful/asnLinks/?offset=XXX&first=YYY"
         self.orgs_base_url = "https://api.asrank.caida.org/v2/restful/organizations/?offset=XXX&first=YYY"
         self.first = 10000
+        # a few pages at a time, at most two requests per second
+        self.fetcher = Fetch_Pages.FetchEngine(max_workers=4, rate=2.0, burst=2, timeout=120)
+        self.page_rounds = 3
+        self.failed_types = set()
         today = datetime.now()
         year = today.year
         if today.month < 10:
@@ -32,6 +37,10 @@ class CrawlingASRank:
         self.asn_file = "ASNS-offsetXXX.json"
         self.links_file = "LINKS-offsetXXX.json"
         self.orgs_file = "ORGS-offsetXXX.json"
+        # the url, the key of its data and the offset files of each endpoint
+        self.endpoints = {"ASNS":(self.asn_base_url, "asns", self.asn_file),
+                "LINKS":(self.links_base_url, "asnLinks", self.links_file),
+                "ORGS":(self.orgs_base_url, "organizations", self.orgs_file)}
 
         if not os.path.isdir(self.out_dir):
             os.makedirs(self.out_dir)
@@ -45,134 +54,119 @@ class CrawlingASRank:
                     print(f"\tData already retrieved for {self.date_folder.replace('_', '/')}.")
                     return
 
-        # retrieve all the ASN files
-        self.retrieve_asn_files()
+        self.journal = Journal_Crawls.CrawlJournal(self.out_dir / ".crawl_journal")
 
-        # retrieve all the ASN links files
-        self.retrieve_links_files()
+        # find how many pages each endpoint has
+        self.count_pages()
 
-        # retrieve all the organizations files
-        self.retrieve_orgs_files()
+        # retrieve the pages of all three endpoints at the same time
+        self.retrieve_pages()
 
         # combine all the individual files by offset into a single file
         #  and remove all the individual offset files
-        self.combine_files('ASNS')
-        self.combine_files('LINKS')
-        self.combine_files('ORGS')
-
-    def retrieve_asn_files(self):
-        count = 0
-        while True:
-            save_file = self.asn_file.replace("XXX", str(count))
-            if os.path.isfile(self.out_dir / save_file):
-                print(f"\t{save_file} already exists. Continuing.")
-                count += self.first
+        for f_type in self.page_offsets:
+            if f_type in self.failed_types:
+                print(f"\tNot combining the {f_type} files, some pages are missing. Run the update again to retry them.")
                 continue
-            url = self.asn_base_url
-            url = url.replace("XXX", str(count))
-            url = url.replace("YYY", str(self.first))
-            print(f"\tRetrieving: {url}")
-            asn_page = self.retrieve_page(url)
-            asn_dict = asn_page.json()
-            try:
-                save_dict = asn_dict["data"]["asns"]["edges"]
-            except:
-                print(f"\tCould not parse data for url: {url}")
-                continue
-            self.save_json(save_dict, self.out_dir / save_file)
-            count += self.first
-            is_next = asn_dict["data"]["asns"]["pageInfo"]["hasNextPage"]
-            sleep(1) # to ensure we don't put too much load on the server
-            if not is_next:
-                break
+            self.combine_files(f_type)
+        if self.failed_types:
+            self.journal.close()
+        else:
+            self.journal.remove()
 
-    def retrieve_links_files(self):
-        count = 0
-        while True:
-            save_file = self.links_file.replace("XXX", str(count))
-            if os.path.isfile(self.out_dir / save_file):
-                print(f"\t{save_file} already exists. Continuing.")
-                count += self.first
+    def count_pages(self):
+        """Asks each endpoint for a single item to read its totalCount.
+        The count is kept in the journal, so a resumed crawl asks for the same offsets."""
+        self.page_offsets = {}
+        urls = []
+        types = []
+        for f_type, (base_url, data_key, f_name) in self.endpoints.items():
+            if os.path.isfile(self.out_dir / f"{f_type}.json"):
+                print(f"\t{f_type}.json already exists.")
+                continue
+            total = self.journal.data(f"count:{f_type}")
+            if total is not None:
+                self.page_offsets[f_type] = list(range(0, total, self.first))
                 continue
-            url = self.links_base_url
-            url = url.replace("XXX", str(count))
-            url = url.replace("YYY", str(self.first))
-            print(f"\tRetrieving: {url}")
-            links_page = self.retrieve_page(url)
-            links_dict = links_page.json()
+            types.append(f_type)
+            urls.append(base_url.replace("XXX", '0').replace("YYY", '1'))
+        for f_type, data in zip(types, self.fetcher.fetch_many(urls)):
+            data_key = self.endpoints[f_type][1]
             try:
-                save_dict = links_dict["data"]["asnLinks"]["edges"]
+                total = data["data"][data_key]["totalCount"]
             except:
-                print(f"\tCould not parse data for url: {url}")
+                print(f"\tCould not read the number of {f_type}.")
+                self.failed_types.add(f_type)
                 continue
-            self.save_json(save_dict, self.out_dir / save_file)
-            count += self.first
-            is_next = links_dict["data"]["asnLinks"]["pageInfo"]["hasNextPage"]
-            sleep(1) # to ensure we don't put too much load on the server
-            if not is_next:
+            print(f"\t{total} {f_type} in {math.ceil(total / self.first)} pages.")
+            self.journal.record(f"count:{f_type}", data=total)
+            self.page_offsets[f_type] = list(range(0, total, self.first))
+
+    def retrieve_pages(self):
+        tasks = []
+        for f_type, offsets in self.page_offsets.items():
+            base_url, data_key, f_name = self.endpoints[f_type]
+            for offset in offsets:
+                url = base_url.replace("XXX", str(offset)).replace("YYY", str(self.first))
+                tasks.append((url, self.out_dir / f_name.replace("XXX", str(offset))))
+        # the pages that failed are tried again a few times before giving up
+        for attempt in range(self.page_rounds):
+            if attempt:
+                print(f"\tRetrying {len(tasks)} pages.")
+            tasks = self.fetcher.fetch_to_files(tasks, parse=self.parse_page, journal=self.journal)
+            if not tasks:
                 break
+        for url, f_name in tasks:
+            self.failed_types.add(f_name.name.split('-')[0])
 
-    def retrieve_orgs_files(self):
-        count = 0
-        while True:
-            save_file = self.orgs_file.replace("XXX", str(count))
-            if os.path.isfile(self.out_dir / save_file):
-                print(f"\t{save_file} already exists. Continuing.")
-                count += self.first
-                continue
-            url = self.orgs_base_url
-            url = url.replace("XXX", str(count))
-            url = url.replace("YYY", str(self.first))
-            print(f"\tRetrieving: {url}")
-            orgs_page = self.retrieve_page(url)
-            orgs_dict = orgs_page.json()
+    def parse_page(self, page_dict):
+        """Returns the edges of a page, or None if the page has none."""
+        for data_key in ["asns", "asnLinks", "organizations"]:
             try:
-                save_dict = orgs_dict["data"]["organizations"]["edges"]
-            except:
-                print(f"\tCould not parse data for url: {url}")
+                return page_dict["data"][data_key]["edges"]
+            except (KeyError, TypeError):
                 continue
-            self.save_json(save_dict, self.out_dir / save_file)
-            count += self.first
-            is_next = orgs_dict["data"]["organizations"]["pageInfo"]["hasNextPage"]
-            sleep(1) # to ensure we don't put too much load on the server
-            if not is_next:
-                break
+        return None
 
-    def retrieve_page(self, url):
-        page = requests.get(url)
-        return page
+    def offset_files(self, f_type):
+        """Returns the offset files of f_type, in the order of their offsets."""
+        offset_files = []
+        for f in os.listdir(self.out_dir):
+            if f.startswith(f"{f_type}-offset") and f.endswith(".json"):
+                offset = int(f.replace(f"{f_type}-offset", '').replace(".json", ''))
+                offset_files.append((offset, f))
+        return [f for offset, f in sorted(offset_files)]
 
     def combine_files(self, f_type):
+        """Writes the items of the offset files into one json list, one file at a time,
+        so only a single page is held in memory."""
         print("\tCombining individual files into a single json file.")
-        data_list = []
-        for f in os.listdir(self.out_dir):
-            if not f_type in f:
-                continue
-            if not 'offset' in f:
-                continue
-            with open(self.out_dir / f, 'r') as f:
-                sub_list = json.load(f)
+        offset_files = self.offset_files(f_type)
+        all_file = self.out_dir / f"{f_type}.json"
+        tmp_file = self.out_dir / f".{f_type}.json.part"
+        num_items = 0
+        with open(tmp_file, 'w') as out_f:
+            out_f.write('[')
+            for f in offset_files:
+                with open(self.out_dir / f, 'r') as in_f:
+                    sub_list = json.load(in_f)
                 for e in sub_list:
-                    data_list.append(e)
-        if data_list:
-            all_file = f"{f_type}.json"
-            self.save_json(data_list, self.out_dir / all_file)
+                    if num_items:
+                        out_f.write(', ')
+                    out_f.write(json.dumps(e))
+                    num_items += 1
+            out_f.write(']')
+        if num_items:
+            print(f"Saving to {all_file}.")
+            os.replace(tmp_file, all_file)
         else:
             print("No data to save.")
+            os.remove(tmp_file)
 
         # remove all the individual offset files
-        for f in os.listdir(self.out_dir):
-            if not f_type in f:
-                continue
-            if not 'offset' in f:
-                continue
+        for f in offset_files:
             os.remove(self.out_dir / f)
 
-    def save_json(self, data, f_name):
-        print(f"Saving to {f_name}.")
-        with open(f_name, 'w') as f:
-            json.dump(data, f)
-
 if __name__ == "__main__":
     print("This script should not be run by itself. Run it through iGDB.py")
     output_dir = Path("../unprocessed/ASRank")
@@ -1,9 +1,8 @@
 import os
 from pathlib import Path
-import requests
-import json
-from time import sleep
 from datetime import datetime
+import Fetch_Pages
+import Journal_Crawls
 
 class CrawlingEuroIX:
     """
@@ -35,46 +34,24 @@ class CrawlingEuroIX:
         self.ixp_file = "IXPS.json"
         self.asn_file = "ASNS.json"
         self.asn_switch_file = "ASNS-BY-IXP-SWITCH.json"
+        # the three datasets are large downloads, so one at a time
+        self.fetcher = Fetch_Pages.FetchEngine(max_workers=1, rate=1.0, burst=1, timeout=300)
 
         if not os.path.isdir(self.out_dir):
             os.makedirs(self.out_dir)
 
     def run_steps(self):
         print("Retrieving data from EuroIX.")
-
-        if os.path.isfile(self.out_dir / self.ixp_file):
-            print(f"\tIXP data already retrieved for {self.date_folder.replace('_', '/')}.")
-        else:
-            print(f"\tRetrieving: {self.ixp_url}")
-            data_page = self.retrieve_page(self.ixp_url)
-            data_dict = data_page.json()
-            self.save_json(data_dict, self.out_dir / self.ixp_file)
-
-        if os.path.isfile(self.out_dir / self.asn_file):
-            print(f"\tASN data already retrieved for {self.date_folder.replace('_', '/')}.")
+        self.journal = Journal_Crawls.CrawlJournal(self.out_dir / ".crawl_journal")
+        tasks = [(self.ixp_url, self.out_dir / self.ixp_file),
+                 (self.asn_url, self.out_dir / self.asn_file),
+                 (self.asn_switch_url, self.out_dir / self.asn_switch_file)]
+        failed = self.fetcher.fetch_to_files(tasks, journal=self.journal)
+        if failed:
+            self.journal.close()
         else:
-            print(f"\tRetrieving: {self.asn_url}")
-            data_page = self.retrieve_page(self.asn_url)
-            data_dict = data_page.json()
-            self.save_json(data_dict, self.out_dir / self.asn_file)
-
-        if os.path.isfile(self.out_dir / self.asn_switch_file):
-            print(f"\tASN by IXP switch data already retrieved for ", end='')
-            print(f"{self.date_folder.replace('_', '/')}.")
-        else:
-            print(f"\tRetrieving: {self.asn_switch_url}")
-            data_page = self.retrieve_page(self.asn_switch_url)
-            data_dict = data_page.json()
-            self.save_json(data_dict, self.out_dir / self.asn_switch_file)
-
-    def retrieve_page(self, url):
-        page = requests.get(url)
-        return page
-
-    def save_json(self, data, f_name):
-        print(f"\tSaving to {f_name}.")
-        with open(f_name, 'w') as f:
-            json.dump(data, f)
+            print(f"\tData retrieved for {self.date_folder.replace('_', '/')}.")
+            self.journal.remove()
 
 if __name__ == "__main__":
     print("This script should not be run by itself. Run it through iGDB.py")
@@ -1,54 +1,187 @@
-import os, time, json
+import os, sys, time, json
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
+from urllib.parse import urljoin
 
 from pathlib import Path
 
-from selenium import webdriver
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.firefox.options import Options as FirefoxOptions
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
+import Fetch_Pages
+import Journal_Crawls
 
+# the elements that never have an end tag
+_VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+              "link", "meta", "param", "source", "track", "wbr"}
+# the elements whose text starts on a new line, as a browser shows it
+_BLOCK_TAGS = {"div", "p", "tr", "li", "table", "tbody", "thead", "ul", "ol", "h1", "h2", "h3"}
+
+
+class HTMLElement:
+    def __init__(self, tag, attrs, parent=None):
+        self.tag = tag
+        self.attrs = dict(attrs)
+        self.parent = parent
+        self.children = []
+
+    def iter(self):
+        """Yields every element under this one, in document order."""
+        for child in self.children:
+            if isinstance(child, HTMLElement):
+                yield child
+                yield from child.iter()
+
+    def find_all(self, tag=None, id=None, class_name=None):
+        found = []
+        for e in self.iter():
+            if tag is not None and e.tag != tag:
+                continue
+            if id is not None and e.attrs.get("id") != id:
+                continue
+            if class_name is not None and not class_name in (e.attrs.get("class") or "").split():
+                continue
+            found.append(e)
+        return found
+
+    def find(self, tag=None, id=None, class_name=None):
+        found = self.find_all(tag, id, class_name)
+        return found[0] if found else None
+
+    def get(self, name):
+        return self.attrs.get(name)
+
+    def raw_text(self):
+        parts = []
+        for child in self.children:
+            if isinstance(child, HTMLElement):
+                if child.tag == "br" or child.tag in _BLOCK_TAGS:
+                    parts.append("\n")
+                parts.append(child.raw_text())
+            else:
+                parts.append(child)
+        return "".join(parts)
+
+    @property
+    def text(self):
+        """The text the way Selenium returns it: the spaces of every line collapsed,
+        and <br> or a block element starting a new line."""
+        lines = [" ".join(line.split()) for line in self.raw_text().split("\n")]
+        return "\n".join(line for line in lines if line)
+
+class HTMLTreeParser(HTMLParser):
+    """Builds a tree of HTMLElements with the standard library parser.
+    An end tag closes every element opened after the matching start tag,
+    and an end tag without a start tag is ignored."""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = HTMLElement("document", [])
+        self.stack = [self.root]
+
+    def handle_starttag(self, tag, attrs):
+        element = HTMLElement(tag, attrs, self.stack[-1])
+        self.stack[-1].children.append(element)
+        if not tag in _VOID_TAGS:
+            self.stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        element = HTMLElement(tag, attrs, self.stack[-1])
+        self.stack[-1].children.append(element)
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i].tag == tag:
+                del self.stack[i:]
+                return
+
+    def handle_data(self, data):
+        self.stack[-1].children.append(data)
+
+def parse_html(html):
+    parser = HTMLTreeParser()
+    parser.feed(html)
+    parser.close()
+    return parser.root
 
 class CrawlingHE:
+    """
+        This class retrieves the IXPs, their properties and their members from Hurricane Electric.
+        The pages are retrieved over plain HTTP by the shared fetch engine,
+        a few at a time with exponential backoff, and parsed with html.parser.
+        Only the pages that cannot be retrieved that way, e.g. because HE returned
+        a browser check instead of the page, are retrieved with Selenium and a headless Firefox.
+        The list of IXPs and every IXP filled in are recorded in a journal as they finish,
+        so a crawl that is interrupted only retrieves the remaining IXPs when it is run again.
+    """
     _SLEEP_DURATION = 5*60
     _MAX_RETRIES = 10
-    def __init__(self, out_dir):
+    _USER_AGENT = "Mozilla/5.0 (Windows NT 6.3; WOW64; rv:44.0) Gecko/20100101 Firefox/44.0"
+    def __init__(self, out_dir, use_browser=True):
         self._ixp_summary_url = "http://bgp.he.net/report/exchanges"
         self._ixp_base_url = "http://bgp.he.net/exchange"
-        self._out_dir = out_dir        
+        self._out_dir = out_dir
+        self._use_browser = use_browser
+        self._fetcher = Fetch_Pages.FetchEngine(max_workers=4, rate=2.0, burst=2, retries=5, backoff=5.0)
+        self._fetcher.session.headers["User-Agent"] = CrawlingHE._USER_AGENT
+
+        if not os.path.isdir(self._out_dir):
+            os.makedirs(self._out_dir)
 
     def run_steps(self):
         print("Retrieving IXP data from Hurricane Electric")
-        self._ixps = self._fetch_ixp_list()
+        day = time.strftime("%Y%m%d")
+        self._journal = Journal_Crawls.CrawlJournal(self._out_dir / f".crawl_journal_{day}")
+        self._ixps = self._journal.data("ixp_list")
+        if self._ixps is None:
+            self._ixps = self._fetch_ixp_list()
+            if not self._ixps:
+                print("\tCould not retrieve the list of IXPs.")
+                self._journal.close()
+                return
+            self._journal.record("ixp_list", data=self._ixps)
         self._fill_ixps()
-        self.save_json(self._out_dir / ("he_dump_"+time.strftime("%Y%m%d")+".json"))
+        self.save_json(self._out_dir / ("he_dump_"+day+".json"))
+        missing = [ixp for ixp in self._ixps if not self._journal.is_done(f"ixp:{ixp}")]
+        if missing:
+            # running again today retries only the IXPs that are still missing
+            print(f"\t{len(missing)} IXPs could not be retrieved. Run the update again to retry them.")
+            self._journal.close()
+        else:
+            self._journal.remove()
+
+    def _fetch_page(self, url):
+        """Returns the parsed page, or None if it could not be retrieved."""
+        response = self._fetcher.get(url)
+        if response is None or response.status_code != 200:
+            return None
+        return parse_html(response.text)
 
     def _fetch_ixp_list(self):
-        options = FirefoxOptions()
-        options.add_argument("--headless")
-        browser = webdriver.Firefox(options=options)
-        profile = webdriver.FirefoxProfile()
-        profile.set_preference("general.useragent.override", 
-            "Mozilla/5.0 (Windows NT 6.3; WOW64; rv:44.0) Gecko/20100101 Firefox/44.0")
-        
-        browser.get(self._ixp_summary_url)
+        document = self._fetch_page(self._ixp_summary_url)
+        table = document.find(id="exchangestable") if document is not None else None
+        if table is None:
+            print("\tThe IXP list is not available over HTTP.")
+            if not self._use_browser:
+                return {}
+            return self._fetch_ixp_list_browser()
+        ixps = self._read_ixp_list(table, self._ixp_summary_url)
+        print(f"Found {len(ixps)} IXPs HE summary list")
+        return ixps
+
+    def _read_ixp_list(self, table, page_url):
         ixps = {}
-        ixp_table = browser.find_element_by_xpath("id('exchangestable')/tbody")
-        ixp_rows = ixp_table.find_elements_by_tag_name("tr")
-        for row in ixp_rows:
-            tds = row.find_elements_by_tag_name("td")
+        tbody = table.find("tbody") or table
+        for row in tbody.find_all("tr"):
+            tds = row.find_all("td")
             if tds:
-                a_element = tds[0].find_element_by_tag_name("a")
+                a_element = tds[0].find("a")
                 name = a_element.text
-                link = a_element.get_attribute("href")
+                link = urljoin(page_url, a_element.get("href"))
                 members = int(tds[1].text.replace(",",""))
-                data  = tds[2].find_element_by_tag_name("img").get_attribute('alt')
+                img = tds[2].find("img")
+                data = img.get("alt") if img is not None else None
                 cc = tds[3].text
                 city = tds[4].text
-                website = tds[5].find_element_by_tag_name("a").get_attribute("href")
+                website_a = tds[5].find("a")
+                website = urljoin(page_url, website_a.get("href")) if website_a is not None else None
 
                 ixps[name] = {
                               "name" : name,
@@ -59,99 +192,222 @@ class CrawlingHE:
                               "ixp_external_url" : website,
                               "he_url" : link
                              }
-        browser.quit()
+        return ixps
+
+    def _fill_ixps(self):
+        names = []
+        for ixp in self._ixps:
+            filled = self._journal.data(f"ixp:{ixp}")
+            if filled is None:
+                names.append(ixp)
+            else:
+                self._ixps[ixp] = filled
+        print(f"\tRetrieving {len(names)} IXP pages, {len(self._ixps) - len(names)} already retrieved.")
+        filled = self._fetcher.map(self._fill_ixp, names)
+        failed = [ixp for ixp, is_filled in zip(names, filled) if not is_filled]
+        if not failed:
+            return
+        print(f"\t{len(failed)} IXP pages could not be retrieved over HTTP.")
+        if self._use_browser:
+            self._fill_ixps_browser(failed)
+
+    def _fill_ixp(self, ixp):
+        """Fills in the properties and members of the IXP from its page.
+        Returns False if the page could not be retrieved or is not an IXP page."""
+        url = self._ixps[ixp]["he_url"]
+        document = self._fetch_page(url)
+        if document is None or document.find(id="exchange") is None:
+            return False
+        try:
+            self._read_ixp_page(self._ixps[ixp], document, url)
+        except (AttributeError, IndexError) as e:
+            print(ixp, type(e).__name__, e)
+            return False
+        self._journal.record(f"ixp:{ixp}", data=self._ixps[ixp])
+        return True
+
+    def _read_ixp_page(self, ixp_dict, document, page_url):
+        property_names = document.find_all(class_name="asleft")
+        property_values = document.find_all(class_name="asright")
+        for name, value in zip(property_names, property_values):
+            if "IPv4 Prefixes:" in name.text:
+                ixp_dict["v4_pfxs"] = value.text.split(", ")
+            elif "IPv6 Prefixes:" in name.text:
+                ixp_dict["v6_pfxs"] = value.text.split(", ")
+            else:
+                key = name.text.strip().replace(":","").lower().replace(" ", "_")
+                if key in ixp_dict:
+                    continue
+                elif key == "data_feed_health":
+                    ixp_dict[key] = value.find("img").get("alt")
+                else:
+                    ixp_dict[key] = value.text
+
+        ixp_dict["members"] = []
+        members_table = document.find(id="members")
+        if members_table is None:
+            return
+        for row in members_table.find_all("tr"):
+            tds = row.find_all("td")
+            if len(tds) > 0:
+                a_element = tds[0].find("a")
+                ixp_dict["members"].append({
+                                        "asn" : a_element.text,
+                                        "as_name" : tds[1].text,
+                                        "he_asn_url" : urljoin(page_url, a_element.get("href")),
+                                        "v4_ips" : tds[2].text.split("\n"),
+                                        "v6_ips" : tds[3].text.split("\n")
+                                      })
+
+    def _start_browser(self):
+        # selenium is only needed, and imported, when a page has to be retrieved with the browser
+        from selenium import webdriver
+        from selenium.webdriver.firefox.options import Options as FirefoxOptions
+        options = FirefoxOptions()
+        options.add_argument("--headless")
+        options.set_preference("general.useragent.override", CrawlingHE._USER_AGENT)
+        return webdriver.Firefox(options=options)
+
+    def _fetch_ixp_list_browser(self):
+        try:
+            browser = self._start_browser()
+        except ImportError:
+            print("\tSelenium is not installed, so the IXP list cannot be retrieved with the browser.")
+            return {}
+        try:
+            browser.get(self._ixp_summary_url)
+            ixps = self._read_ixp_list(parse_html(browser.page_source).find(id="exchangestable"),
+                                       self._ixp_summary_url)
+        finally:
+            browser.quit()
         print(f"Found {len(ixps)} IXPs HE summary list")
         return ixps
 
-    def _fill_ixps(self, num_workers=4):
+    def _fill_ixps_browser(self, ixps, num_workers=4):
+        try:
+            import selenium
+        except ImportError:
+            print("\tSelenium is not installed, so they cannot be retrieved with the browser.")
+            return
+        print(f"\tRetrieving {len(ixps)} IXP pages with the browser.")
         pool = ThreadPoolExecutor(max_workers=num_workers)
         submitted_futures = {}
-        for ixp in self._ixps:
-            ft = pool.submit(self._fill_ixp, ixp)
+        for ixp in ixps:
+            ft = pool.submit(self._fill_ixp_browser, ixp)
             submitted_futures[ft] = ixp
-        # we wait fot the enqueued futures to complete, collect the results.
-        while submitted_futures:
-            # we could pass in an overall timeout based on the # worker threads here, or even timeout
-            # for individual future from the time they started running.
-            for ft in as_completed(submitted_futures.keys()):
-                item = submitted_futures[ft]
-                del submitted_futures[ft]
-                try:
-                    res = ft.result()
-                except Exception as e:
-                    if isinstance(e, KeyboardInterrupt):
-                        raise e
-                    print("Exception while running work item %s: %s", item, e)
+        for ft in as_completed(submitted_futures.keys()):
+            item = submitted_futures[ft]
+            try:
+                ft.result()
+            except Exception as e:
+                if isinstance(e, KeyboardInterrupt):
+                    raise e
+                print(f"Exception while running work item {item}: {e}")
+        pool.shutdown()
 
-    def _fill_ixp(self, ixp):
+    def _fill_ixp_browser(self, ixp):
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.common.by import By
         url = self._ixps[ixp]["he_url"]
         # Due to the fact that selenium webdriver is not thread safe, we launch an instance of webdriver per
         # thread. See: https://github.com/SeleniumHQ/selenium/wiki/Frequently-Asked-Questions#q-is-webdriver-thread-safe
-        # We don't do anything crazy and just launch the browser sessions in "headless" mode.
-        options = FirefoxOptions()
-        options.add_argument("--headless")
-        browser = webdriver.Firefox(options=options)
-        profile = webdriver.FirefoxProfile()
-        profile.set_preference("general.useragent.override",
-                               "Mozilla/5.0 (Windows NT 6.3; WOW64; rv:44.0) Gecko/20100101 Firefox/44.0")
+        # The page is then parsed the same way as the pages retrieved over HTTP.
+        browser = self._start_browser()
         attempt = 1
-        while attempt <= CrawlingHE._MAX_RETRIES:
-            try:
-                browser.find_element_by_tag_name('body').send_keys(Keys.COMMAND + 't')
-                browser.get(url)
-                elem = WebDriverWait(browser, 30).until(
-                    EC.presence_of_element_located((By.ID, "exchange")))
-                property_names = browser.find_elements_by_class_name("asleft")
-                property_values = browser.find_elements_by_class_name("asright")
-                #self._ixps[ixp]["etc"] = {}
-                for name, value in zip(property_names, property_values):
-                    if "IPv4 Prefixes:" in name.text:
-                        self._ixps[ixp]["v4_pfxs"] = value.text.split(", ")
-                    elif "IPv6 Prefixes:" in name.text:
-                        self._ixps[ixp]["v6_pfxs"] = value.text.split(", ")
-                    else:
-                        key = name.text.strip().replace(":","").lower().replace(" ", "_")
-                        if key in self._ixps[ixp]: 
-                            continue
-                        elif key == "data_feed_health":
-                            self._ixps[ixp][key] = value.find_element_by_tag_name("img").get_attribute('alt')
-                        else:
-                            self._ixps[ixp][key] = value.text
-
-                self._ixps[ixp]["members"] = []
-                members_table = browser.find_elements_by_id("members")
-                if not members_table:
-                    browser.find_element_by_tag_name('body').send_keys(Keys.COMMAND + 'w')
+        try:
+            while attempt <= CrawlingHE._MAX_RETRIES:
+                try:
+                    browser.get(url)
+                    WebDriverWait(browser, 30).until(
+                        EC.presence_of_element_located((By.ID, "exchange")))
+                    self._read_ixp_page(self._ixps[ixp], parse_html(browser.page_source), url)
+                    self._journal.record(f"ixp:{ixp}", data=self._ixps[ixp])
                     break
-                trs = members_table[0].find_elements_by_tag_name("tr")
-                for row in trs:
-                    tds = row.find_elements_by_tag_name("td")
-                    if len(tds) > 0:
-                        a_element = tds[0].find_element_by_tag_name("a")
-                        asn = a_element.text
-                        he_asn_url = a_element.get_attribute("href")
-                        self._ixps[ixp]['members'].append({
-                                                "asn" : asn,
-                                                "as_name" : tds[1].text,
-                                                "he_asn_url" : he_asn_url,
-                                                "v4_ips" : tds[2].text.split("\n"),
-                                                "v6_ips" : tds[3].text.split("\n")
-                                              })
-                browser.find_element_by_tag_name('body').send_keys(Keys.COMMAND + 'w')
-                break
-            except Exception as e:
-                print(ixp, type(e).__name__, e)
-                attempt += 1
-                time.sleep(CrawlingHE._SLEEP_DURATION)
-        browser.quit()
+                except Exception as e:
+                    print(ixp, type(e).__name__, e)
+                    # exponential backoff, up to _SLEEP_DURATION between attempts
+                    time.sleep(min(CrawlingHE._SLEEP_DURATION, 5 * 2**(attempt - 1)))
+                    attempt += 1
+        finally:
+            browser.quit()
 
     def save_json(self, f_name):
         print(f"Saving to {f_name}.")
         with open(f_name, 'w') as f:
             json.dump(list(self._ixps.values()), f, indent=4)
 
+_FIXTURE_SUMMARY = """<html><body><table id="exchangestable"><thead><tr><th>Exchange</th></tr></thead><tbody>
+<tr><td><a href="/exchange/AMS-IX">AMS-IX</a></td><td>1,023</td><td><img alt="Good" src="/x.gif"></td>
+<td>NL</td><td>Amsterdam</td><td><a href="https://www.ams-ix.net/">Website</a></td></tr>
+<tr><td><a href="/exchange/Flaky-IX">Flaky-IX</a></td><td>2</td><td><img alt="Good"></td>
+<td>US</td><td>Chicago</td><td><a href="https://flaky.example/">Website</a></td></tr>
+<tr><td><a href="/exchange/Checked-IX">Checked-IX</a></td><td>3</td><td><img alt="Bad"></td>
+<td>DE</td><td>Frankfurt</td><td><a href="https://checked.example/">Website</a></td></tr>
+</tbody></table></body></html>"""
+
+_FIXTURE_IXP = """<html><body><div id="exchange">
+<div class="asleft">Name:</div><div class="asright">  AMS-IX  </div>
+<div class="asleft">IPv4 Prefixes:</div><div class="asright">80.249.208.0/21, 80.249.216.0/21</div>
+<div class="asleft">Data Feed Health:</div><div class="asright"><img alt="Good"></div>
+<div class="asleft">Members:</div><div class="asright">1,023</div>
+<table id="members"><thead><tr><th>ASN</th><th>Name</th><th>IPv4</th><th>IPv6</th></tr></thead><tbody>
+<tr><td><a href="/AS3356">AS3356</a></td><td>Level 3 &amp; Co</td><td>80.249.209.1<br>80.249.209.2</td><td>2001:7f8:1::a500:3356:1</td></tr>
+<tr><td><a href="/AS174">AS174</a></td><td>Cogent</td><td>80.249.208.174</td><td></td></tr>
+</tbody></table></div></body></html>"""
+
+def self_check():
+    """Crawls a local fixture server standing in for bgp.he.net."""
+    import tempfile
+
+    def respond(path, count):
+        html_type = {"Content-Type":"text/html"}
+        if path == "/report/exchanges":
+            return 200, html_type, _FIXTURE_SUMMARY
+        elif path == "/exchange/AMS-IX":
+            return 200, html_type, _FIXTURE_IXP
+        elif path == "/exchange/Flaky-IX" and count < 3:
+            return 503, html_type, "Service Unavailable"
+        elif path == "/exchange/Flaky-IX":
+            return 200, html_type, _FIXTURE_IXP.replace("AMS-IX", "Flaky-IX")
+        # a browser check instead of the page
+        return 200, html_type, "<html><body><script>check()</script></body></html>"
+
+    with Fetch_Pages.StandInServer(respond) as server:
+        crawler = CrawlingHE(Path(tempfile.mkdtemp(prefix="he_")), use_browser=False)
+        crawler._ixp_summary_url = server.base_url + "/report/exchanges"
+        crawler._fetcher.backoff = 0.1
+        crawler._fetcher.rate = 20
+        crawler.run_steps()
+        ixps = crawler._ixps
+        assert list(ixps) == ["AMS-IX", "Flaky-IX", "Checked-IX"], list(ixps)
+        ams = ixps["AMS-IX"]
+        assert ams["members"][0] == {"asn":"AS3356", "as_name":"Level 3 & Co",
+                "he_asn_url":server.base_url + "/AS3356",
+                "v4_ips":["80.249.209.1", "80.249.209.2"], "v6_ips":["2001:7f8:1::a500:3356:1"]}, ams["members"][0]
+        assert ams["members"][1]["v6_ips"] == [""]
+        assert ams["v4_pfxs"] == ["80.249.208.0/21", "80.249.216.0/21"]
+        assert ams["data_feed_health"] == "Good" and ams["cc"] == "NL"
+        assert len(ixps["Flaky-IX"]["members"]) == 2
+        assert not "v4_pfxs" in ixps["Checked-IX"]
+        first_requests = server.num_requests()
+
+        # a second crawl resumes from the journal and only asks for the missing IXP
+        resumed = CrawlingHE(crawler._out_dir, use_browser=False)
+        resumed._ixp_summary_url = crawler._ixp_summary_url
+        resumed._fetcher.rate = 20
+        resumed.run_steps()
+        assert server.seen["/exchange/Checked-IX"] == 2 and server.seen["/report/exchanges"] == 1
+        assert resumed._ixps["AMS-IX"] == ams
+        print(f"Self-check passed: {first_requests} requests, {server.num_requests() - first_requests} after resuming.")
+    crawler._fetcher.close()
+    resumed._fetcher.close()
+
 if __name__ == "__main__":
     print("This script should not be run by itself. Run it through iGDB.py")
-    output_dir = Path("../unprocessed/HE")
-    my_crawler = CrawlingHE(output_dir)
-    my_crawler.run_steps()
+    if "--self-check" in sys.argv:
+        self_check()
+    else:
+        output_dir = Path("../unprocessed/HE")
+        my_crawler = CrawlingHE(output_dir)
+        my_crawler.run_steps()
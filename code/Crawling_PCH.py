@@ -1,10 +1,10 @@
 import os
 from pathlib import Path
-import requests
 import re
 import json
-from time import sleep
 from datetime import datetime
+import Fetch_Pages
+import Journal_Crawls
 
 class CrawlingPCH:
     """
@@ -32,6 +32,8 @@ class CrawlingPCH:
         self.active_idx = {}
         self.active_file = "pch_active_ixp.json"
         self.subnets_file = "pch_subnets_XX.json"
+        # a few requests at a time, never more than 4 per second
+        self.fetcher = Fetch_Pages.FetchEngine(max_workers=4, rate=4.0, burst=4)
 
         if not os.path.isdir(self.out_dir):
             os.makedirs(self.out_dir)
@@ -44,36 +46,41 @@ class CrawlingPCH:
                 print(f"Data already retrieved for {self.date_folder.replace('_', '/')}.")
                 return
 
+        self.journal = Journal_Crawls.CrawlJournal(self.out_dir / ".crawl_journal")
         # first retrieve the index page and get the IXP indexes
         self.retrieve_and_save_active_idx()
         # next retrieve the subnets page for each IXP and save locally
-        self.retrieve_and_save_subnets()
+        failed = self.retrieve_and_save_subnets()
+        if failed:
+            print("\tNot combining the subnets files, some are missing. Run the update again to retry them.")
+            self.journal.close()
+            return
         # combine all the individual subnets files into a single file
         #  and remove all the individual subnets files
         self.combine_subnets_files()
+        self.journal.remove()
 
     def retrieve_and_save_active_idx(self):
-        active_idx_page = self.retrieve_page(self.ixp_base_url)
-        self.active_idx = active_idx_page.json()
+        # a resumed crawl uses the same list of IXPs as the first attempt
+        if self.journal.is_done(self.ixp_base_url):
+            with open(self.out_dir / self.active_file, 'r') as f:
+                self.active_idx = json.load(f)
+            return
+        self.active_idx = self.fetcher.get_json(self.ixp_base_url)
+        if self.active_idx is None:
+            print("\tCould not retrieve the active IXPs.")
+            self.active_idx = []
+            return
         self.save_json(self.active_idx, self.out_dir / self.active_file)
-        sleep(0.5) # to ensure we don't put too much load on the server
+        self.journal.record(self.ixp_base_url, payload=self.out_dir / self.active_file)
 
     def retrieve_and_save_subnets(self):
+        tasks = []
         for ixp_dict in self.active_idx:
             ixp_id = ixp_dict['id']
             save_file = self.subnets_file.replace('XX', str(ixp_id))
-            if os.path.isfile(self.out_dir / save_file):
-                continue
-            subnets_url = self.subnets_base_url + str(ixp_id)
-            print(f"Retrieving {subnets_url}")
-            page = self.retrieve_page(subnets_url)
-            subnets_dict = page.json()
-            self.save_json(subnets_dict, self.out_dir / save_file)
-            sleep(0.5) # to ensure we don't put too much load on the server
-
-    def retrieve_page(self, url):
-        page = requests.get(url)
-        return page
+            tasks.append((self.subnets_base_url + str(ixp_id), self.out_dir / save_file))
+        return self.fetcher.fetch_to_files(tasks, indent=4, journal=self.journal)
 
     def combine_subnets_files(self):
         print("Combining individual files into a single json file.")
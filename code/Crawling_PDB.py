@@ -2,42 +2,52 @@ import os
 from pathlib import Path
 import requests
 import re
-import json
+import Fetch_Pages
 
 class CrawlingPDB:
     def __init__(self, out_dir):
         self.base_url = "https://publicdata.caida.org/datasets/peeringdb-v2/"
         self.out_dir = out_dir
-        self.dump_dict = {}
         self.save_file = ""
+        self.dump_url = ""
+        # the dump is one large download, so one request at a time
+        self.fetcher = Fetch_Pages.FetchEngine(max_workers=1, rate=1.0, burst=1, timeout=300)
 
         if not os.path.isdir(self.out_dir):
             os.makedirs(self.out_dir)
 
     def run_steps(self):
         print("Retrieving PeeringDB data from CAIDA.")
+        self.validators = Fetch_Pages.ValidatorStore(self.out_dir / ".validators.json")
         self.retrieve_latest_version()
         if self.save_file:
             self.save_latest()
+        self.validators.save()
 
     def retrieve_latest_version(self):
         # we walk through the latest year, then month, then day to find the most recent version
 
         # first retrieve the index page and get the latest year
         idx_page = self.retrieve_page(self.base_url)
-        years_ref = re.findall("<a href=\"20../\">", idx_page.text)
+        if idx_page is None:
+            return
+        years_ref = re.findall("<a href=\"20../\">", idx_page)
         year = years_ref[-1].replace('<a href="', '').replace('/">', '')
 
         # next retrieve the year page and get the latest month
         year_url = self.base_url + f"{year}/"
         year_page = self.retrieve_page(year_url)
-        months_ref = re.findall("<a href=\"../\">", year_page.text)
+        if year_page is None:
+            return
+        months_ref = re.findall("<a href=\"../\">", year_page)
         month = months_ref[-1].replace('<a href="', '').replace('/">', '')
 
         # next retrieve the month page to find the latest json file
         month_url = year_url + f"{month}/"
         month_page = self.retrieve_page(month_url)
-        dump_file_list = re.findall("<a href=\"peeringdb_2_dump_20.._.._...json\">", month_page.text)
+        if month_page is None:
+            return
+        dump_file_list = re.findall("<a href=\"peeringdb_2_dump_20.._.._...json\">", month_page)
         dump_file = dump_file_list[-1].replace('<a href="', '').replace('">', '')
 
         # retrieve the latest file, if it is not already downloaded
@@ -48,19 +58,52 @@ class CrawlingPDB:
             return
         else:
             self.save_file = dump_file
-            dump_url = month_url + f"{dump_file}"
-            print(f"Retrieving: {dump_file}. This will take a moment, be patient.")
-            raw_dump = self.retrieve_page(dump_url)
-            self.dump_dict = raw_dump.json()
+            self.dump_url = month_url + f"{dump_file}"
 
     def retrieve_page(self, url):
-        page = requests.get(url)
-        return page
+        """Returns the text of an index page. The text is kept with the validators,
+        so an index page that has not changed is answered with 304 and not sent again."""
+        entry = self.validators.get(url)
+        headers = self.validators.headers(url) if entry.get("TEXT") else {}
+        page = self.fetcher.get(url, headers=headers)
+        if page is None:
+            return None
+        if page.status_code == 304:
+            return entry["TEXT"]
+        if page.status_code != 200:
+            print(f"\t{url} returned HTTP {page.status_code}.")
+            return None
+        self.validators.update(url, page, TEXT=page.text)
+        return page.text
 
     def save_latest(self):
+        """The dump is written to disk as it arrives, without decoding it, and to a
+        temporary file first, so an interrupted download is never taken for a complete one."""
+        print(f"Retrieving: {self.save_file}. This will take a moment, be patient.")
+        tmp_file = self.out_dir / f".{self.save_file}.part"
+        raw_dump = self.fetcher.get(self.dump_url, stream=True)
+        if raw_dump is None or raw_dump.status_code != 200:
+            print(f"\tCould not retrieve {self.dump_url}.")
+            return
+        try:
+            with open(tmp_file, 'wb') as f:
+                for chunk in raw_dump.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        except requests.RequestException as e:
+            print(f"\tThe download of {self.save_file} was interrupted ({e}). Run the update again to retry it.")
+            os.remove(tmp_file)
+            return
+        finally:
+            raw_dump.close()
+        with open(tmp_file, 'rb') as f:
+            is_json = f.read(64).lstrip()[:1] == b'{'
+        if not is_json:
+            print(f"\t{self.dump_url} did not return json.")
+            os.remove(tmp_file)
+            return
         print(f"Saving to {self.out_dir} / {self.save_file}.")
-        with open(self.out_dir / self.save_file, 'w') as f:
-            json.dump(self.dump_dict, f, indent=4)
+        os.replace(tmp_file, self.out_dir / self.save_file)
+        self.validators.update(self.dump_url, raw_dump, FILE=self.save_file)
 
 if __name__ == "__main__":
     print("This script should not be run by itself. Run it through iGDB.py")
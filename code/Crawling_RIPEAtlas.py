@@ -1,15 +1,17 @@
 import os
 from pathlib import Path
-import requests
 import json
-from time import sleep
+import math
 from datetime import datetime
+import Fetch_Pages
+import Journal_Crawls
 
 class CrawlingRIPEAtlas:
     def __init__(self, out_dir, replace_existing):
         self.anchors_url = "https://atlas.ripe.net/api/v2/anchors/?format=json&page=XX"
         self.probes_url = "https://atlas.ripe.net/api/v2/probes/?format=json&page=XX"
         self.replace_existing = replace_existing
+        self.fetcher = Fetch_Pages.FetchEngine(max_workers=4, rate=4.0, burst=4)
 
         today = datetime.now()
         year = today.year
@@ -28,65 +30,55 @@ class CrawlingRIPEAtlas:
             os.makedirs(self.out_dir)
 
     def run_steps(self):
+        self.journal = Journal_Crawls.CrawlJournal(self.out_dir / ".crawl_journal")
         print("Retrieving the RIPE Atlas anchors.")
-        self.retrieve_anchors()
+        failed = self.retrieve_anchors()
 
         print("Retrieving the RIPE Atlas probes.")
-        self.retrieve_probes()
+        failed += self.retrieve_probes()
+        if failed:
+            self.journal.close()
+        else:
+            self.journal.remove()
 
     def retrieve_anchors(self):
-        p_num = 1
-        while True:
-            save_fname = f"anchors_{p_num}.json"
-            url = self.anchors_url.replace('XX', str(p_num))
-
-            # if the local file exists and we don't want to replace it, continue
-            if self.replace_existing == 'N':
-                if os.path.isfile(self.out_dir / save_fname):
-                    print(f"Skipping {save_fname}")
-                    p_num += 1
-                    continue
-
-            print(f"Retrieving {url}")
-            data = requests.get(url)
-            data_j = data.json()
-            if 'error' in data_j.keys():
-                print(data_j)
-                break
-            self.save_file(data_j, self.out_dir / save_fname)
-            if 'next' in data_j.keys() and not data_j['next']:
-                    break
-
-            p_num += 1
-            sleep(0.5)
-            # input("ENTER to continue.")
+        return self.retrieve_pages(self.anchors_url, "anchors")
 
     def retrieve_probes(self):
-        p_num = 1
-        while True:
-            save_fname = f"probes_{p_num}.json"
-            url = self.probes_url.replace('XX', str(p_num))
-
-            # if the local file exists and we don't want to replace it, continue
-            if self.replace_existing == 'N':
-                if os.path.isfile(self.out_dir / save_fname):
-                    print(f"Skipping {save_fname}")
-                    p_num += 1
-                    continue
-
+        return self.retrieve_pages(self.probes_url, "probes")
+
+    def retrieve_pages(self, base_url, f_type):
+        """The first page gives the total count, so the number of pages is known
+        and the rest of them are retrieved at the same time.
+        Returns the pages that could not be retrieved."""
+        first_file = self.out_dir / f"{f_type}_1.json"
+        if self.replace_existing == 'N' and os.path.isfile(first_file):
+            print(f"Skipping {first_file.name}")
+            with open(first_file, 'r') as f:
+                data_j = json.load(f)
+        else:
+            url = base_url.replace('XX', '1')
             print(f"Retrieving {url}")
-            data = requests.get(url)
-            data_j = data.json()
-            if 'error' in data_j.keys():
+            data_j = self.fetcher.get_json(url)
+            if data_j is None or 'error' in data_j.keys():
                 print(data_j)
-                break
-            self.save_file(data_j, self.out_dir / save_fname)
-            if 'next' in data_j.keys() and not data_j['next']:
-                    break
-
-            p_num += 1
-            sleep(0.5)
-            # input("ENTER to continue")
+                return [(url, first_file)]
+            self.save_file(data_j, first_file)
+        if not data_j.get('next') or not data_j.get('results'):
+            return []
+
+        num_pages = math.ceil(data_j['count'] / len(data_j['results']))
+        tasks = []
+        for p_num in range(2, num_pages + 1):
+            tasks.append((base_url.replace('XX', str(p_num)), self.out_dir / f"{f_type}_{p_num}.json"))
+        return self.fetcher.fetch_to_files(tasks, parse=self.parse_page,
+                replace=(self.replace_existing != 'N'), journal=self.journal)
+
+    def parse_page(self, data_j):
+        if 'error' in data_j.keys():
+            print(data_j)
+            return None
+        return data_j
 
     def save_file(self, data, f_name):
         with open(f_name, 'w') as f:
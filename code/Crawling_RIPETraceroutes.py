@@ -1,19 +1,30 @@
 import os
 from pathlib import Path
-import requests
 import json
 import csv
-from time import sleep
+import requests
+import calendar
 from datetime import datetime
 from datetime import timedelta
-from ripe.atlas.cousteau import AtlasResultsRequest
+import Fetch_Pages
+import Journal_Crawls
 
 class CrawlingRIPETraceroutes:
-    def __init__(self, out_dir, ripe_dir):
+    """
+        This class retrieves yesterday's IPv4 anchoring mesh traceroutes of every RIPE Atlas anchor.
+        The measurement IDs of all the anchors are read from a few pages that list
+        every anchoring mesh measurement, instead of one request per anchor.
+        The results of each anchor are then retrieved for every time window, a few at a time,
+        and streamed straight to their own file as they arrive.
+        Each window is a (start, end) pair of "HH:MM" UTC times on the day of the results.
+    """
+    def __init__(self, out_dir, ripe_dir, windows=None):
         self.ripe_dir = ripe_dir
         self.msm_url = "https://atlas.ripe.net/api/v2/measurements/?"
-        self.msm_url += "type=traceroute&target=XX&is_public=true&status=2&af=4"
+        self.msm_url += "type=traceroute&is_public=true&status=2&af=4&page_size=500&page=XX"
         self.msm_url += "&description__contains=%22Anchoring%20Mesh%20Measurement%22"
+        self.results_url = "https://atlas.ripe.net/api/v2/measurements/XX/results/?format=json"
+        self.fetcher = Fetch_Pages.FetchEngine(max_workers=8, rate=4.0, burst=8, timeout=120)
 
         today = datetime.now()
         yesterday = today - timedelta(days=1)
@@ -37,10 +48,11 @@ class CrawlingRIPETraceroutes:
         self.msm_id_header = ["ANCHOR_ID", "TRACEROUTE_MEASUREMENT_ID"]
         self.msm_id_file = self.out_dir / "anchor_traceroute_measurement_id.csv"
 
-        self.start_date = (yesterday.year, yesterday.month, yesterday.day, 12, 0)
-        self.end_date = (yesterday.year, yesterday.month, yesterday.day, 12, 30)
-        self.traceroute_results = {}
-        self.traceroute_file = "anchor_traceroute_results_XXX.json"
+        if not windows:
+            windows = [("12:00", "12:30")]
+        self.day = datetime(yesterday.year, yesterday.month, yesterday.day)
+        self.windows = windows
+        self.traceroute_file = "anchor_traceroute_results_XXX_WWW.json"
 
     def run_steps(self):
         # open the anchors files
@@ -49,22 +61,30 @@ class CrawlingRIPETraceroutes:
             print(f"Please update RIPE anchor data with: python iGDB.py -u ripe", end='')
             return
         self.read_anchors_file()
+        self.journal = Journal_Crawls.CrawlJournal(self.out_dir / ".crawl_journal")
         # retrieve the measurement ID for traceroute
         if not os.path.isfile(self.msm_id_file):
-            self.retrieve_msm_id()
+            if not self.retrieve_msm_id():
+                self.journal.close()
+                return
             self.save_csv(self.msm_id_list, self.msm_id_header, self.msm_id_file)
         else:
             print(f"\tTraceroute measurement ID file exists, reading existing file.")
             self.msm_id_list = self.read_csv(self.msm_id_file)
-        # retrieve the corresponding traceroutes for one hour that happened yesterday
-        if not os.path.isfile(self.traceroute_file):
-            self.retrieve_traceroutes()
+        # retrieve the corresponding traceroutes for each window of yesterday
+        failed = self.retrieve_traceroutes()
+        if failed:
+            print(f"\t{len(failed)} traceroute results could not be retrieved. Run the update again to retry them.")
+            self.journal.close()
         else:
-            print(f"\tTraceroute measurement results file exists for {self.date_folder.replace('_', '/')}.")
+            self.journal.remove()
 
     def read_anchors_file(self):
-        for dd in os.listdir(self.ripe_dir):
-            for af in os.listdir(self.ripe_dir / dd):
+        seen = set()
+        for dd in sorted(os.listdir(self.ripe_dir)):
+            if not os.path.isdir(self.ripe_dir / dd):
+                continue
+            for af in sorted(os.listdir(self.ripe_dir / dd)):
                 if not 'anchors' in af:
                     continue
                 with open(self.ripe_dir / dd / af) as f:
@@ -74,78 +94,108 @@ class CrawlingRIPETraceroutes:
                     fqdn = r['fqdn']
                     is_anchor = r['type']
                     is_disabled = r['is_disabled']
-                    if is_anchor == 'Anchor' and not is_disabled:
+                    # the same anchor is listed in the anchors files of every day
+                    if is_anchor == 'Anchor' and not is_disabled and not pid in seen:
+                        seen.add(pid)
                         self.anchors_list.append((pid, fqdn))
 
     def retrieve_msm_id(self):
+        """Reads the measurement ID of every anchor from the pages that list all the anchoring
+        mesh measurements. Returns False if the measurements could not be listed."""
         print("\tRetrieving traceroute IPv4 measurement IDs.")
-        count = 0 # for development
-        for row in self.anchors_list:
-            p_id = row[0]
-            fqdn = row[1]
-
-            url = self.msm_url.replace('XX', fqdn)
-
-            print(f"\n\tRetrieving {url}")
-            data = requests.get(url, timeout=10)
-            data_j = data.json()
-            if 'error' in data_j.keys():
-                print(data_j)
-                continue
-            try:
-                msm_id = data_j['results'][0]['id']
-            except:
+        targets = self.journal.data("msm_targets")
+        if targets is None:
+            targets = self.list_mesh_measurements()
+            if targets is None:
+                return False
+            self.journal.record("msm_targets", data=targets)
+        for p_id, fqdn in self.anchors_list:
+            if fqdn in targets:
+                self.msm_id_list.append((p_id, targets[fqdn]))
+            else:
                 print(f"\tNo traceroute IPv4 measurement for anchor {p_id}.")
-                continue
-            self.msm_id_list.append((p_id, msm_id))
-
-            # for development
-            count += 1
-            if count >= 50:
-                break
-
-            sleep(0.5)
+        print(f"\tFound the measurements of {len(self.msm_id_list)} of {len(self.anchors_list)} anchors.")
+        return True
+
+    def list_mesh_measurements(self):
+        """Returns the first measurement ID listed for each target, or None if a page failed.
+        The first page gives the count, and the rest of the pages are retrieved at the same time."""
+        first_page = self.fetcher.get_json(self.msm_url.replace('XX', '1'))
+        if first_page is None or 'error' in first_page.keys():
+            print(first_page)
+            return None
+        pages = [first_page]
+        if first_page.get('next') and first_page.get('results'):
+            num_pages = -(-first_page['count'] // len(first_page['results']))
+            urls = [self.msm_url.replace('XX', str(p)) for p in range(2, num_pages + 1)]
+            pages += self.fetcher.fetch_many(urls)
+        targets = {}
+        for page in pages:
+            if page is None or not 'results' in page:
+                return None
+            for m in page['results']:
+                if m.get('target') and not m['target'] in targets:
+                    targets[m['target']] = m['id']
+        return targets
+
+    def window_times(self, window):
+        """Returns the start and stop of a window as UTC timestamps.
+        A window that ends before it starts ends on the next day."""
+        start = datetime.strptime(window[0], "%H:%M")
+        end = datetime.strptime(window[1], "%H:%M")
+        start = self.day.replace(hour=start.hour, minute=start.minute)
+        stop = self.day.replace(hour=end.hour, minute=end.minute)
+        if stop <= start:
+            stop += timedelta(days=1)
+        return calendar.timegm(start.timetuple()), calendar.timegm(stop.timetuple())
 
     def retrieve_traceroutes(self):
-        all_pids = []
-        for row in self.msm_id_list:
-            all_pids.append(row[0])
-
-        for row in self.msm_id_list:
-            t_pid = row[0]
-            msm_id = row[1]
-            save_file = self.traceroute_file.replace("XXX", str(t_pid))
-            if os.path.isfile(self.out_dir / save_file):
-                print(f"Traceroute IPv4 data already downloaded for {t_pid}. Continuing.")
-                continue
-            print(f"\tRetrieving traceroute IPv4 measurement results for {t_pid}.")
-            self.retrieve_msm(t_pid, msm_id, all_pids)
-            self.save_json(self.traceroute_results[t_pid], self.out_dir / save_file)
-
-    def retrieve_msm(self, target_pid, msm, source_pids):
-        s_year = self.start_date[0]
-        s_month = self.start_date[1]
-        s_day = self.start_date[2]
-        s_hour = self.start_date[3]
-        s_min = self.start_date[4]
-
-        e_year = self.end_date[0]
-        e_month = self.end_date[1]
-        e_day = self.end_date[2]
-        e_hour = self.end_date[3]
-        e_min = self.end_date[4]
-
-        kwargs = {
-                "msm_id": msm,
-                "start": datetime(s_year, s_month, s_day, s_hour, s_min),
-                "stop": datetime(e_year, e_month, e_day, e_hour, e_min),
-                "probe_ids": source_pids
-        }
-
-        is_success, self.traceroute_results[target_pid] = AtlasResultsRequest(**kwargs).create()
-        sleep(0.5)
-        if not is_success:
-            print("\tRetrieval unsuccessful")
+        """Retrieves the results of every anchor for every window. Returns the ones that failed."""
+        all_pids = [str(row[0]) for row in self.msm_id_list]
+        probe_ids = ",".join(all_pids)
+        tasks = []
+        for start_s, end_s in self.windows:
+            start, stop = self.window_times((start_s, end_s))
+            window_name = f"{start_s.replace(':', '')}-{end_s.replace(':', '')}"
+            for t_pid, msm_id in self.msm_id_list:
+                save_file = self.traceroute_file.replace("XXX", str(t_pid)).replace("WWW", window_name)
+                unit = f"results:{t_pid}:{window_name}"
+                if os.path.isfile(self.out_dir / save_file) or self.journal.is_done(unit):
+                    continue
+                url = self.results_url.replace("XX", str(msm_id))
+                url += f"&start={start}&stop={stop}&probe_ids={probe_ids}"
+                tasks.append((unit, url, self.out_dir / save_file))
+        num_files = len(self.msm_id_list) * len(self.windows)
+        print(f"\tRetrieving {len(tasks)} traceroute IPv4 results files, ", end='')
+        print(f"{num_files - len(tasks)} already downloaded.")
+        results = self.fetcher.map(self.retrieve_msm, tasks)
+        return [task for task, is_saved in zip(tasks, results) if not is_saved]
+
+    def retrieve_msm(self, task):
+        """Streams the results of one measurement and window to its file. Returns True if it was saved.
+        The results are written to a temporary file first, so an interrupted crawl never leaves
+        a partial file that would be skipped as already downloaded."""
+        unit, url, f_name = task
+        response = self.fetcher.get(url, stream=True)
+        if response is None or response.status_code != 200:
+            if response is not None:
+                Fetch_Pages.report(f"\t{url} returned HTTP {response.status_code}.")
+            return False
+        tmp_file = f_name.with_name(f".{f_name.name}.part")
+        try:
+            with open(tmp_file, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
+        except requests.RequestException as e:
+            Fetch_Pages.report(f"\tThe results of {unit} were interrupted ({e}).")
+            os.remove(tmp_file)
+            return False
+        finally:
+            response.close()
+        os.replace(tmp_file, f_name)
+        self.journal.record(unit, payload=f_name)
+        Fetch_Pages.report(f"\tSaved {f_name.name}.")
+        return True
 
     def read_csv(self, f_name):
         print(f"\tReading from {f_name}.")
@@ -157,11 +207,6 @@ class CrawlingRIPETraceroutes:
                 results.append(row)
         return results
 
-    def save_json(self, data, f_name):
-        print(f"\tSaving to {f_name}.")
-        with open(f_name, 'w') as f:
-            json.dump(data, f)
-
     def save_csv(self, data, header, f_name):
         print(f"\tSaving to {f_name}.")
         with open(f_name, 'w') as f:
@@ -1,11 +1,19 @@
 import os
 from pathlib import Path
-import requests
 import json
 from datetime import date
-from time import sleep
+import Fetch_Pages
+import Journal_Crawls
 
 class CrawlingTelegeography:
+    """
+        This class retrieves the submarine cable map, the landing points,
+        and the info of every cable from Telegeography.
+        The ETag and Last-Modified of every download are kept in .validators.json,
+        so a file that has not changed is answered with 304 Not Modified.
+        A file that is sent again with the same content, compared by its hash,
+        is not saved again, so only the files that changed are processed.
+    """
     def __init__(self, out_dir):
         self.base_url = "https://raw.githubusercontent.com/telegeography/www.submarinecablemap.com/master/web/public/api/v3/"
         self.map_url = self.base_url + "cable/cable-geo.json"
@@ -14,8 +22,11 @@ class CrawlingTelegeography:
         t = str(date.today()).replace('-', '_')
         self.cable_save_file = f"cable-geo_{t}.json"
         self.landing_save_file = f"landing-point-geo_{t}.json"
+        self.journal_file = out_dir / f".crawl_journal_{t}"
 
         self.cable_data_dir = out_dir / 'cable_data'
+        # the files are static, so they can be retrieved a little faster
+        self.fetcher = Fetch_Pages.FetchEngine(max_workers=8, rate=8.0, burst=8)
 
         if not os.path.isdir(self.out_dir):
             os.makedirs(self.out_dir)
@@ -25,19 +36,28 @@ class CrawlingTelegeography:
 
     def run_steps(self):
         print("Retrieving submarine cable data from Telegeography.")
+        self.validators = Fetch_Pages.ValidatorStore(self.out_dir / ".validators.json")
         # retrieve the submarine cable geojson file
         if os.path.isfile(self.out_dir / self.cable_save_file):
             print(f"\tThe latest version of cable map ({self.cable_save_file}) ", end='')
             print(f"is already downloaded. ", end='')
             print("Not downloading again.")
+            cable_file = self.out_dir / self.cable_save_file
         else:
             print(f"\tRetrieving latest cable map.")
-            raw_dump = self.retrieve_page(self.map_url)
-            dump_dict = raw_dump.json()
-            self.save_results(dump_dict, self.out_dir / self.cable_save_file)
+            cable_file = self.retrieve_dump(self.map_url, self.cable_save_file)
+            if cable_file is None:
+                print("\tCould not retrieve the cable map.")
+                return
 
         # retrieve the individual submarine cable info files
-        self.retrieve_cable_info()
+        self.journal = Journal_Crawls.CrawlJournal(self.journal_file)
+        failed = self.retrieve_cable_info(cable_file)
+        self.validators.save()
+        if failed:
+            self.journal.close()
+        else:
+            self.journal.remove()
 
         # retrieve the landing point geojson file
         if os.path.isfile(self.out_dir / self.landing_save_file):
@@ -46,33 +66,123 @@ class CrawlingTelegeography:
             print("Not downloading again.")
         else:
             print(f"\nRetrieving latest landing point map.")
-            raw_dump = self.retrieve_page(self.landing_url)
-            dump_dict = raw_dump.json()
-            self.save_results(dump_dict, self.out_dir / self.landing_save_file)
+            if self.retrieve_dump(self.landing_url, self.landing_save_file) is None:
+                print("\tCould not retrieve the landing point map.")
+        self.validators.save()
+
+    def retrieve_dump(self, url, save_file):
+        """Saves the dump to save_file if it changed since the last download,
+        and returns the file with its latest version, or None if it could not be retrieved.
+        An unchanged dump is not saved again, so it is not processed twice."""
+        entry = self.validators.get(url)
+        previous = entry.get("FILE")
+        if not previous:
+            # without validators, the newest dump is compared by its content
+            prefix = save_file.split('_')[0] + '_'
+            dumps = sorted(f for f in os.listdir(self.out_dir) if f.startswith(prefix) and f.endswith(".json"))
+            if dumps:
+                previous = dumps[-1]
+                with open(self.out_dir / previous, 'r') as f:
+                    entry = {"SHA256":Fetch_Pages.content_hash(json.load(f))}
+        if previous and not os.path.isfile(self.out_dir / previous):
+            previous = None
+        headers = self.validators.headers(url) if previous else {}
+        response = self.fetcher.get(url, headers=headers)
+        if response is None:
+            return None
+        if response.status_code == 304:
+            print(f"\tNot modified since {previous}.")
+            return self.out_dir / previous
+        if response.status_code != 200:
+            print(f"\t{url} returned HTTP {response.status_code}.")
+            return None
+        try:
+            dump_dict = response.json()
+        except ValueError:
+            print(f"\t{url} did not return json.")
+            return None
+        digest = Fetch_Pages.content_hash(dump_dict)
+        if previous and digest == entry.get("SHA256"):
+            print(f"\tThe content is the same as {previous}.")
+            self.validators.update(url, response, FILE=previous, SHA256=digest)
+            return self.out_dir / previous
+        self.save_results(dump_dict, self.out_dir / save_file)
+        self.validators.update(url, response, FILE=save_file, SHA256=digest)
+        return self.out_dir / save_file
+
+    def latest_cable_files(self):
+        """Returns the newest file of each cable already downloaded, by cable ID.
+        It is only used for the cables without validators, e.g. on the first run with them."""
+        latest = {}
+        for f in sorted(os.listdir(self.cable_data_dir)):
+            if f.startswith('.') or not f.endswith(".json"):
+                continue
+            latest[f.split('_')[0]] = f
+        return latest
 
-    def retrieve_cable_info(self):
-        cable_file = self.out_dir / self.cable_save_file
+    def retrieve_cable_info(self, cable_file):
         with open(cable_file, 'r') as f:
             cable_dict = json.load(f)
 
         t = str(date.today()).replace('-', '_')
+        self.latest_files = self.latest_cable_files()
 
+        tasks = []
         for c in cable_dict['features']:
             c_id = c['properties']['id']
             save_file = f"{c_id}_{t}.json"
-            if os.path.isfile(self.cable_data_dir / save_file):
-                print(f"File {save_file} already exists. Skipping it.")
-                continue
-            print(f"Retrieving {c_id} cable info.")
             url = self.base_url + f'cable/{c_id}.json'
-            raw_dump = self.retrieve_page(url)
-            dump_dict = raw_dump.json()
-            self.save_results(dump_dict, self.cable_data_dir / save_file)
-            sleep(0.5)
+            if self.journal.is_done(url):
+                continue
+            tasks.append((c_id, url, save_file))
+        print(f"\tRetrieving the info of {len(tasks)} cables.")
+        results = self.fetcher.map(self.retrieve_cable, tasks)
+        print(f"\t{results.count('changed')} cables changed, {results.count('unchanged')} did not.")
+        failed = [task for task, result in zip(tasks, results) if result is None]
+        if failed:
+            print(f"\t{len(failed)} cables could not be retrieved. Run the update again to retry them.")
+        return failed
 
-    def retrieve_page(self, url):
-        page = requests.get(url)
-        return page
+    def retrieve_cable(self, task):
+        """Saves the info of one cable if it changed since its newest file.
+        Returns 'changed', 'unchanged', or None if it could not be retrieved."""
+        c_id, url, save_file = task
+        entry = self.validators.get(url)
+        previous = entry.get("FILE")
+        if not previous and c_id in self.latest_files:
+            # validators are not known yet, so the newest file is compared by its content
+            previous = self.latest_files[c_id]
+            with open(self.cable_data_dir / previous, 'r') as f:
+                entry = {"SHA256":Fetch_Pages.content_hash(json.load(f))}
+        if previous and not os.path.isfile(self.cable_data_dir / previous):
+            previous = None
+        headers = self.validators.headers(url) if previous else {}
+        response = self.fetcher.get(url, headers=headers)
+        if response is None:
+            return None
+        if response.status_code == 304:
+            result = "unchanged"
+        elif response.status_code == 200:
+            try:
+                cable_info = response.json()
+            except ValueError:
+                Fetch_Pages.report(f"\t{url} did not return json.")
+                return None
+            digest = Fetch_Pages.content_hash(cable_info)
+            if previous and digest == entry.get("SHA256"):
+                result = "unchanged"
+            else:
+                tmp_file = self.cable_data_dir / f".{save_file}.part"
+                Fetch_Pages.save_json(cable_info, tmp_file, indent=4)
+                os.replace(tmp_file, self.cable_data_dir / save_file)
+                previous = save_file
+                result = "changed"
+            self.validators.update(url, response, FILE=previous, SHA256=digest)
+        else:
+            Fetch_Pages.report(f"\t{url} returned HTTP {response.status_code}.")
+            return None
+        self.journal.record(url, payload=self.cable_data_dir / previous)
+        return result
 
     def save_results(self, data, f_name):
         print(f"Saving to {f_name}.")
@@ -3,27 +3,56 @@ import sqlite3
 from sqlite3 import Error
 from pathlib import Path
 import os
+import sys
 import csv
+import time
+import shutil
+import tempfile
+import hashlib
+import json
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 class CreatingDatabase:
     """This class is called by iGDB.py to create a new database
     using the format described in dbStructure.py and
-    load data into each table from processed files."""
-    def __init__(self, in_path, out_path, f_name):
+    load data into each table from processed files.
+    With incremental=True an existing DB is updated in place and only
+    the processed files that changed since the last load are re-ingested."""
+    def __init__(self, in_path, out_path, f_name, batch_size=50000, jobs=1, incremental=False):
         if not os.path.isdir(out_path):
             os.makedirs(out_path)
         db_file = out_path / f_name
+        self.input_path = in_path
+        # number of csv rows handed to executemany at a time
+        self.batch_size = batch_size
+        # some of the WKT fields are longer than the default csv field limit
+        csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+        if incremental and os.path.isfile(db_file):
+            print(f"Updating DB here: {db_file}")
+            db_conn = self.create_connection(db_file)
+            self.update_tables(db_conn)
+            db_conn.close()
+            return
+
         if os.path.isfile(db_file):
             os.remove(db_file)
         print(f"Creating DB here: {db_file}")
-        self.input_path = in_path
         db_conn = self.create_connection(db_file)
-        # create the tables and add the data
-        for t in db.tables.keys():
-            #print(f"Creating {t}")
-            self.create_table(db_conn, db.tables[t])
-            #input("Done with creation. ENTER to continue.")
-            self.load_table(db_conn, t)
+        tune_connection(db_conn)
+        self.create_metadata_tables(db_conn)
+        if jobs > 1:
+            self.load_tables_parallel(db_conn, out_path, jobs)
+        else:
+            # create the tables and add the data
+            for t in db.tables.keys():
+                #print(f"Creating {t}")
+                self.create_table(db_conn, db.tables[t])
+                #input("Done with creation. ENTER to continue.")
+                self.load_table(db_conn, t)
+        # indexes are cheaper to build once the data is in place
+        self.create_indexes(db_conn)
+        db_conn.close()
 
     def create_connection(self, db_file):
         """ create a database connection to a SQLite database """
@@ -49,41 +78,402 @@ class CreatingDatabase:
         except Error as e:
             print(e)
 
+    def create_metadata_tables(self, conn):
+        for t in db.metadata_tables.keys():
+            self.create_table(conn, db.metadata_tables[t])
+
+    def create_indexes(self, conn):
+        """Builds the indexes defined in dbStructure.py for every table,
+        then gathers the statistics the query planner uses to choose them."""
+        print("Creating indexes.")
+        start_time = time.time()
+        for t in db.indexes.keys():
+            for index_sql in db.indexes[t]:
+                try:
+                    conn.execute(index_sql)
+                except Error as e:
+                    print(e)
+        conn.execute("ANALYZE;")
+        conn.commit()
+        print(f"\tCreated indexes in {time.time() - start_time:.2f} s.")
+
     def load_table(self, conn, table_type):
         """This is a more general version of the loading function.
         It assumes that the columns of the input csv file are the same as the
         attributes in the table we are inserting into.
-        "table_type" should be the name of a table in the DB."""
+        "table_type" should be the name of a table in the DB.
+        Rows are streamed from each processed file in batches of self.batch_size
+        and inserted with bound parameters, all in a single transaction per table."""
         cur = conn.cursor()
         local_path = self.input_path / table_type
         if not os.path.isdir(local_path):
             print(f"No existing data of type {table_type}.")
             return
 
-        for f in os.listdir(local_path):
+        start_time = time.time()
+        total_rows = 0
+        # the savepoints of the batches are nested in this transaction,
+        # so a load that fails leaves nothing of the table behind
+        conn.execute("BEGIN")
+        try:
+            for f in os.listdir(local_path):
+                if not is_processed_file(f):
+                    continue
+                print(f"Loading data from: {f}")
+                keys = set()
+                num_rows = load_processed_file(cur, table_type, local_path / f, self.batch_size, keys)
+                self.record_file(conn, table_type, local_path / f, num_rows, keys)
+                total_rows += num_rows
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        report_load(table_type, total_rows, time.time() - start_time)
+
+    def record_file(self, conn, table_type, f_name, num_rows, keys, f_hash=None):
+        """Remembers which version of a processed file is in the DB and which
+        (source, asof_date) pairs its rows have, for later incremental updates."""
+        if f_hash is None:
+            f_hash = file_hash(f_name)
+        f_stat = os.stat(f_name)
+        conn.execute("DELETE FROM load_manifest WHERE table_name=? AND file_name=?",
+                (table_type, os.path.basename(f_name)))
+        conn.execute("INSERT INTO load_manifest VALUES(?,?,?,?,?,?,?,?)",
+                (table_type, os.path.basename(f_name), f_hash, f_stat.st_size,
+                    f_stat.st_mtime, num_rows, json.dumps(sorted(keys)),
+                    datetime.now().isoformat(timespec='seconds')))
+
+    def update_tables(self, conn):
+        """Re-ingests only the processed files that are new or changed since they
+        were last loaded. The whole update happens in a single transaction."""
+        start_time = time.time()
+        self.create_metadata_tables(conn)
+        for t in db.tables.keys():
+            self.create_table(conn, db.tables[t])
+        updated = []
+        conn.execute("BEGIN")
+        try:
+            for t in db.tables.keys():
+                if self.update_table(conn, t):
+                    updated.append(t)
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        if not updated:
+            print("The DB is already up to date.")
+            return
+        # the indexes are kept up to date by SQLite, only the statistics are refreshed
+        for t in db.indexes.keys():
+            for index_sql in db.indexes[t]:
+                conn.execute(index_sql)
+        for t in updated:
+            conn.execute(f"ANALYZE {t};")
+        conn.commit()
+        print(f"Updated {len(updated)} tables in {time.time() - start_time:.2f} s.")
+
+    def update_table(self, conn, table_type):
+        """Finds the changed files of one table and replaces their rows.
+        Rows are matched on (source, asof_date), so a changed file only
+        replaces the sources and dates it covers. Tables without those
+        columns are reloaded completely when any of their files change."""
+        local_path = self.input_path / table_type
+        files = {}
+        if os.path.isdir(local_path):
+            for f in os.listdir(local_path):
+                if is_processed_file(f):
+                    files[f] = local_path / f
+        manifest = {}
+        m_query = """SELECT file_name, file_hash, file_size, file_mtime, load_keys
+                FROM load_manifest WHERE table_name=?"""
+        for row in conn.execute(m_query, (table_type,)):
+            manifest[row[0]] = {"HASH":row[1], "SIZE":row[2], "MTIME":row[3],
+                    "KEYS":set(tuple(k) for k in json.loads(row[4]))}
+
+        changed = []
+        hashes = {}
+        for f in files.keys():
+            f_stat = os.stat(files[f])
+            if f in manifest:
+                entry = manifest[f]
+                if entry["SIZE"] == f_stat.st_size and entry["MTIME"] == f_stat.st_mtime:
+                    continue
+                hashes[f] = file_hash(files[f])
+                if hashes[f] == entry["HASH"]:
+                    # touched but not modified
+                    conn.execute("""UPDATE load_manifest SET file_mtime=?
+                            WHERE table_name=? AND file_name=?""",
+                            (f_stat.st_mtime, table_type, f))
+                    continue
+            changed.append(f)
+        removed = [f for f in manifest.keys() if not f in files]
+        if not changed and not removed:
+            return False
+
+        if self.has_key_columns(conn, table_type):
+            delete_keys = set()
+            for f in changed + removed:
+                if f in manifest:
+                    delete_keys |= manifest[f]["KEYS"]
+            for f in changed:
+                delete_keys |= read_file_keys(files[f])
+            # unchanged files that share any of these keys lose rows as well,
+            # so they are reloaded too
+            while True:
+                shared = [f for f in files.keys() if f in manifest and not f in changed
+                        and manifest[f]["KEYS"] & delete_keys]
+                if not shared:
+                    break
+                for f in shared:
+                    changed.append(f)
+                    delete_keys |= manifest[f]["KEYS"]
+            self.delete_keys(conn, table_type, delete_keys)
+            for d in db.derived_tables.get(table_type, []):
+                self.delete_keys(conn, d, delete_keys)
+        else:
+            conn.execute(f"DELETE FROM {table_type}")
+            for d in db.derived_tables.get(table_type, []):
+                conn.execute(f"DELETE FROM {d}")
+            changed = list(files.keys())
+
+        for f in removed:
+            print(f"Removing data from: {f}")
+            conn.execute("DELETE FROM load_manifest WHERE table_name=? AND file_name=?",
+                    (table_type, f))
+        start_time = time.time()
+        total_rows = 0
+        cur = conn.cursor()
+        for f in changed:
             print(f"Loading data from: {f}")
-            sql_base = f"INSERT INTO {table_type}("
-            with open(local_path / f, 'r') as f:
-                csv_reader = csv.reader(f, delimiter=',')
-                # read in the header and add all the header values to the SQL query
-                # the header values must correspond to attribute fields in the DB
-                header = next(csv_reader)
-                for v in header:
-                    sql_base += f"{v},"
-                sql_base = sql_base[:-1]
-                sql_base += ") VALUES("
-
-                for row in csv_reader:
-                    sql = sql_base
-                    for r in row:
-                        sql += f"'{r}',"
-                    sql = sql[:-1]
-                    sql += ")"
-                    try:
-                        cur.execute(sql)
-                    except Error as e:
-                        print(f"{e}: {row}")
+            keys = set()
+            num_rows = load_processed_file(cur, table_type, files[f], self.batch_size, keys)
+            self.record_file(conn, table_type, files[f], num_rows, keys, hashes.get(f))
+            total_rows += num_rows
+        report_load(table_type, total_rows, time.time() - start_time)
+        return True
+
+    def has_key_columns(self, conn, table_type):
+        columns = [row[1].lower() for row in conn.execute(f"PRAGMA table_info({table_type})")]
+        return 'source' in columns and 'asof_date' in columns
+
+    def delete_keys(self, conn, table_type, keys):
+        """Deletes every row matching one of the (source, asof_date) keys in one table scan."""
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS delete_keys(source text, asof_date date)")
+        conn.execute("DELETE FROM temp.delete_keys")
+        conn.executemany("INSERT INTO temp.delete_keys VALUES(?,?)", keys)
+        conn.execute(f"""DELETE FROM {table_type} WHERE (source, asof_date) IN
+                (SELECT source, asof_date FROM temp.delete_keys)""")
+
+    def load_tables_parallel(self, conn, out_path, jobs):
+        """Parses every processed file in a pool of worker processes.
+        Each worker loads one file into its own staging SQLite file,
+        which is then merged into the DB with ATTACH and INSERT ... SELECT.
+        Tables without any processed files are still created."""
+        work = []
+        for t in db.tables.keys():
+            self.create_table(conn, db.tables[t])
+            local_path = self.input_path / t
+            if not os.path.isdir(local_path):
+                print(f"No existing data of type {t}.")
+                continue
+            for f in os.listdir(local_path):
+                if is_processed_file(f):
+                    work.append((t, local_path / f))
         conn.commit()
+        if not work:
+            return
+
+        print(f"Parsing {len(work)} files with {jobs} worker processes.")
+        start_time = time.time()
+        # rows, parse plus merge time and outstanding files for each table
+        table_rows = {}
+        table_time = {}
+        table_files = {}
+        for t, f in work:
+            table_rows[t] = 0
+            table_time[t] = 0.0
+            table_files[t] = table_files.get(t, 0) + 1
+        stage_dir = tempfile.mkdtemp(prefix=".staging_", dir=out_path)
+        try:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                futures = []
+                for i, (t, f) in enumerate(work):
+                    stage_file = os.path.join(stage_dir, f"{i}_{t}.db")
+                    futures.append(pool.submit(stage_processed_file, t, f, stage_file, self.batch_size))
+                futures = dict(zip(futures, [f for t, f in work]))
+                # merge each staging file as soon as its worker is done
+                for ft in as_completed(futures):
+                    t, stage_file, num_rows, parse_time, f_hash, keys = ft.result()
+                    merge_start = time.time()
+                    self.merge_staging_file(conn, t, stage_file)
+                    self.record_file(conn, t, futures[ft], num_rows, keys, f_hash)
+                    conn.commit()
+                    table_rows[t] += num_rows
+                    table_time[t] += parse_time + time.time() - merge_start
+                    table_files[t] -= 1
+                    if table_files[t] == 0:
+                        report_load(t, table_rows[t], table_time[t])
+        finally:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+        print(f"Loaded all tables in {time.time() - start_time:.2f} s.")
+
+    def merge_staging_file(self, conn, table_type, stage_file):
+        """The staging table has the same definition as the DB table,
+        so all of its rows can be copied over in a single statement."""
+        conn.execute("ATTACH DATABASE ? AS stage", (str(stage_file),))
+        try:
+            conn.execute(f"INSERT INTO main.{table_type} SELECT * FROM stage.{table_type}")
+            conn.commit()
+        finally:
+            conn.execute("DETACH DATABASE stage")
+        os.remove(stage_file)
+
+def tune_connection(conn):
+    """The DB is rebuilt from scratch, so durability is traded for load speed.
+    If the build fails part way through, the DB file is simply recreated."""
+    pragmas = ["PRAGMA journal_mode=MEMORY;",
+            "PRAGMA synchronous=OFF;",
+            "PRAGMA temp_store=MEMORY;",
+            "PRAGMA cache_size=-200000;"]
+    for p in pragmas:
+        try:
+            conn.execute(p)
+        except Error as e:
+            print(e)
+
+def is_processed_file(f_name):
+    return f_name.endswith('.csv') or f_name.endswith('.parquet')
+
+def read_processed_file(f_name, batch_size):
+    """Yields the header of a processed file, then lists of at most batch_size rows.
+    Besides csv, the traceroute shards can be parquet, which is read one
+    record batch at a time and needs no unescaping."""
+    if str(f_name).endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            print(f"pyarrow is not installed. Cannot load {f_name}.")
+            return
+        p_file = pq.ParquetFile(f_name)
+        yield p_file.schema_arrow.names
+        for record_batch in p_file.iter_batches(batch_size=batch_size):
+            columns = [c.to_pylist() for c in record_batch.columns]
+            yield [list(row) for row in zip(*columns)]
+        return
+    with open(f_name, 'r') as in_file:
+        csv_reader = csv.reader(in_file, delimiter=',')
+        header = next(csv_reader, None)
+        if header is None:
+            return
+        yield header
+        for batch in read_batches(csv_reader, batch_size):
+            yield batch
+
+def load_processed_file(cur, table_type, f_name, batch_size, keys=None):
+    """Loads a single processed file into "table_type" and returns the number of rows.
+    The header values of the file must correspond to attribute fields in the DB.
+    If "keys" is a set, the (source, asof_date) pair of every row is added to it."""
+    num_rows = 0
+    batches = read_processed_file(f_name, batch_size)
+    header = next(batches, None)
+    if header is None:
+        return num_rows
+    sql = insert_sql(table_type, header)
+    key_idx = key_positions(header)
+    for batch in batches:
+        if keys is not None and key_idx:
+            for row in batch:
+                keys.add((row[key_idx[0]], row[key_idx[1]]))
+        num_rows += insert_batch(cur, sql, batch)
+    return num_rows
+
+def key_positions(header):
+    """Returns the positions of the SOURCE and ASOF_DATE columns, if the file has both."""
+    upper_header = [h.upper() for h in header]
+    if 'SOURCE' in upper_header and 'ASOF_DATE' in upper_header:
+        return upper_header.index('SOURCE'), upper_header.index('ASOF_DATE')
+    return None
+
+def read_file_keys(f_name, batch_size=50000):
+    """Returns the set of (source, asof_date) pairs found in a processed file."""
+    keys = set()
+    batches = read_processed_file(f_name, batch_size)
+    key_idx = key_positions(next(batches, []))
+    if not key_idx:
+        return keys
+    for batch in batches:
+        for row in batch:
+            keys.add((row[key_idx[0]], row[key_idx[1]]))
+    return keys
+
+def file_hash(f_name):
+    sha = hashlib.sha1()
+    with open(f_name, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def stage_processed_file(table_type, f_name, stage_file, batch_size):
+    """Runs in a worker process. Parses one processed file into a new
+    staging SQLite file that only holds "table_type"."""
+    start_time = time.time()
+    csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+    conn = sqlite3.connect(stage_file)
+    tune_connection(conn)
+    conn.execute(db.tables[table_type])
+    keys = set()
+    num_rows = load_processed_file(conn.cursor(), table_type, f_name, batch_size, keys)
+    conn.commit()
+    conn.close()
+    return table_type, stage_file, num_rows, time.time() - start_time, file_hash(f_name), keys
+
+def insert_sql(table_type, header):
+    columns = ",".join(header)
+    values = ",".join(["?"] * len(header))
+    return f"INSERT INTO {table_type}({columns}) VALUES({values})"
+
+def read_batches(csv_reader, batch_size):
+    """Yields lists of at most batch_size rows so memory stays flat
+    regardless of the size of the input file.
+    The processed files escape single quotes for SQL string literals ('')
+    which is undone here, because the values are bound as parameters."""
+    batch = []
+    for row in csv_reader:
+        batch.append([r.replace("''", "'") for r in row])
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def insert_batch(cur, sql, batch):
+    """Inserts the whole batch at once. If any row in the batch is bad,
+    the batch is retried row by row so only the bad rows are skipped."""
+    cur.execute("SAVEPOINT load_batch")
+    try:
+        cur.executemany(sql, batch)
+        cur.execute("RELEASE load_batch")
+        return len(batch)
+    except Error:
+        # undo the partially inserted batch before retrying it
+        cur.execute("ROLLBACK TO load_batch")
+        cur.execute("RELEASE load_batch")
+    inserted = 0
+    for row in batch:
+        try:
+            cur.execute(sql, row)
+            inserted += 1
+        except Error as e:
+            print(f"{e}: {row}")
+    return inserted
+
+def report_load(table_type, num_rows, elapsed):
+    if elapsed > 0:
+        rate = num_rows / elapsed
+    else:
+        rate = float(num_rows)
+    print(f"\tLoaded {num_rows} rows into {table_type} in {elapsed:.2f} s ", end='')
+    print(f"({rate:.0f} rows/sec).")
 
 if __name__ == "__main__":
     print("You should not run this script by itself. It should be called from iGDB.py")
@@ -28,19 +28,20 @@ class CreatingOrgKML:
 
     def execute_queries(self):
         # first find all the nodes belonging to the organization
-        n_query = f"""SELECT DISTINCT n.node_name, n.latitude, n.longitude
+        org_pattern = f"%{self.org}%"
+        n_query = """SELECT DISTINCT n.node_name, n.latitude, n.longitude
         FROM phys_nodes n
-        WHERE n.organization LIKE "%{self.org}%"
+        WHERE n.organization LIKE ?
         ORDER BY n.node_name
         ;"""
 
-        self.nodes_list = self.querier.execute_query(n_query)
+        self.nodes_list = self.querier.execute_query(n_query, (org_pattern,))
 
         # next find all the edges between the nodes
-        e_query = f"""SELECT DISTINCT c.from_node, c.to_node, p.path_wkt
+        e_query = """SELECT DISTINCT c.from_node, c.to_node, p.path_wkt
         FROM phys_nodes fn, phys_nodes tn, phys_nodes_conn c, standard_paths p
-        WHERE fn.organization LIKE "%{self.org}%"
-        AND tn.organization LIKE "%{self.org}%"
+        WHERE fn.organization LIKE :org
+        AND tn.organization LIKE :org
         AND c.from_node == fn.node_name
         AND c.to_node == tn.node_name
 
@@ -59,7 +60,7 @@ class CreatingOrgKML:
         ORDER BY fn.city
         ;"""
 
-        edges = self.querier.execute_query(e_query)
+        edges = self.querier.execute_query(e_query, {"org":org_pattern})
         # sometimes there are duplicate edges, so we remove them
         for e in edges:
             fn = e[0]
@@ -0,0 +1,336 @@
+from pathlib import Path
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# the responses worth asking for again, everything else is final
+retry_statuses = {429, 500, 502, 503, 504}
+print_lock = threading.Lock()
+
+def report(message):
+    """Prints a whole line at once, so the lines of the workers are not mixed up."""
+    with print_lock:
+        print(message, flush=True)
+
+class TokenBucket:
+    """Allows rate requests per second on average, and up to burst at once."""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Waits until a token is free and takes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def hold(self, seconds):
+        """Takes away the tokens for the next seconds, e.g. after a Retry-After,
+        so every thread sending to the host waits and not only the one that was told to."""
+        with self.lock:
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+def retry_after(response):
+    """Returns the seconds asked for by the Retry-After header, or None."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def save_json(data, f_name, indent=None):
+    with open(f_name, 'w') as f:
+        json.dump(data, f, indent=indent)
+
+def content_hash(data):
+    """Returns the sha256 of decoded json, the same however the json was formatted."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+class ValidatorStore:
+    """
+        Keeps the ETag and Last-Modified of the last download of each url in a sidecar
+        json file, with anything else the crawler wants to remember about it,
+        e.g. the file it was saved to and the hash of its content.
+        headers(url) returns the headers that ask the server to answer 304 Not Modified
+        instead of sending the page again if it has not changed.
+    """
+    def __init__(self, store_file):
+        self.store_file = Path(store_file)
+        self.urls = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(self.store_file):
+            try:
+                with open(self.store_file, 'r') as f:
+                    self.urls = json.load(f)
+            except ValueError:
+                print(f"\tCould not read {self.store_file}. Downloading everything again.")
+                self.urls = {}
+
+    def get(self, url):
+        return self.urls.get(url, {})
+
+    def headers(self, url):
+        entry = self.get(url)
+        headers = {}
+        if entry.get("ETAG"):
+            headers["If-None-Match"] = entry["ETAG"]
+        if entry.get("LAST_MODIFIED"):
+            headers["If-Modified-Since"] = entry["LAST_MODIFIED"]
+        return headers
+
+    def update(self, url, response=None, **fields):
+        """Stores the validators of response, which keeps the old ones for a 304,
+        and the fields given, e.g. FILE or SHA256."""
+        with self.lock:
+            entry = dict(self.urls.get(url, {}))
+            if response is not None and response.status_code == 200:
+                entry["ETAG"] = response.headers.get("ETag")
+                entry["LAST_MODIFIED"] = response.headers.get("Last-Modified")
+            entry.update(fields)
+            self.urls[url] = entry
+
+    def save(self):
+        with self.lock:
+            tmp_file = self.store_file.with_name(f"{self.store_file.name}.tmp")
+            with open(tmp_file, 'w') as f:
+                json.dump(self.urls, f, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.store_file)
+
+class FetchEngine:
+    """
+        Retrieves pages for the crawlers over one pooled keep-alive session.
+        Every host has its own token bucket of rate requests per second,
+        so max_workers threads can wait on a slow server without sending
+        more to it than a single polite crawler would.
+        A 429 or 5xx response, or a connection error, is tried again up to
+        retries times, after the Retry-After of the response if it has one,
+        or else after an exponential backoff with jitter.
+        fetch_to_files skips the files that already exist and writes each file
+        under a temporary name first, so an interrupted crawl resumes where it stopped.
+    """
+    def __init__(self, max_workers=4, rate=2.0, burst=2, retries=5, backoff=1.0, timeout=30):
+        self.max_workers = max_workers
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+        self.session = requests.Session()
+        # requests decompresses the responses, so every page is sent compressed if the server can
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+        with self.buckets_lock:
+            if not host in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    def get(self, url, **kwargs):
+        """Returns the response for url, or None if it could not be retrieved.
+        A final error response, e.g. a 404, is returned as it is."""
+        kwargs.setdefault("timeout", self.timeout)
+        bucket = self.bucket(url)
+        for attempt in range(self.retries + 1):
+            bucket.take()
+            wait = None
+            try:
+                response = self.session.get(url, **kwargs)
+            except requests.RequestException as e:
+                error = e
+            else:
+                if not response.status_code in retry_statuses:
+                    return response
+                error = f"HTTP {response.status_code}"
+                wait = retry_after(response)
+            if attempt == self.retries:
+                break
+            if wait is not None:
+                # the next take waits for the host to be free again
+                report(f"\t{url} failed ({error}). Trying again in {wait:.1f} s.")
+                bucket.hold(wait)
+                continue
+            wait = self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+            report(f"\t{url} failed ({error}). Trying again in {wait:.1f} s.")
+            time.sleep(wait)
+        report(f"\tCould not retrieve {url} after {self.retries + 1} attempts ({error}).")
+        return None
+
+    def get_json(self, url, **kwargs):
+        """Returns the decoded json of url, or None if it could not be retrieved or decoded."""
+        response = self.get(url, **kwargs)
+        if response is None:
+            return None
+        if response.status_code != 200:
+            report(f"\t{url} returned HTTP {response.status_code}.")
+            return None
+        try:
+            return response.json()
+        except ValueError:
+            report(f"\t{url} did not return json.")
+            return None
+
+    def map(self, func, items):
+        """Returns func(item) for every item, in the order of items,
+        with at most max_workers of them running at once."""
+        items = list(items)
+        if self.max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(func, items))
+
+    def fetch_many(self, urls):
+        """Returns the decoded json of every url, or None for the ones that failed."""
+        return self.map(self.get_json, urls)
+
+    def fetch_to_files(self, tasks, parse=None, indent=None, replace=False, journal=None):
+        """Retrieves the (url, f_name) tasks and saves the json of each one to its file,
+        skipping the files that already exist, or that the journal has, unless replace is set.
+        parse turns the decoded json into the data to save, or returns None
+        if the page is not usable. Each saved page is recorded in the journal.
+        Returns the tasks that failed."""
+        pending = []
+        for url, f_name in tasks:
+            if not replace:
+                if os.path.isfile(f_name) or (journal is not None and journal.is_done(url)):
+                    continue
+            pending.append((url, Path(f_name)))
+        skipped = len(tasks) - len(pending)
+        if skipped:
+            report(f"\t{skipped} of {len(tasks)} files already exist. Skipping them.")
+
+        def fetch_task(task):
+            url, f_name = task
+            report(f"\tRetrieving {url}")
+            data = self.get_json(url)
+            if data is not None and parse is not None:
+                data = parse(data)
+            if data is None:
+                return task
+            tmp_file = f_name.with_name(f".{f_name.name}.part")
+            save_json(data, tmp_file, indent)
+            os.replace(tmp_file, f_name)
+            if journal is not None:
+                journal.record(url, payload=f_name)
+            return None
+
+        failed = [t for t in self.map(fetch_task, pending) if t is not None]
+        if failed:
+            report(f"\t{len(failed)} of {len(pending)} pages could not be retrieved. Run the update again to retry them.")
+        return failed
+
+    def close(self):
+        self.session.close()
+
+class StandInServer:
+    """
+        A local HTTP server to check the crawlers against, without the real sources.
+        respond(path, count) returns the (status, headers, body) of the count-th
+        request for path, so a page can fail a few times before it works.
+        Used as a context manager, it serves from a background thread at self.base_url.
+    """
+    def __init__(self, respond):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        self.seen = {}
+        seen_lock = threading.Lock()
+        seen = self.seen
+
+        class StandInHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with seen_lock:
+                    seen[self.path] = seen.get(self.path, 0) + 1
+                    count = seen[self.path]
+                status, headers, body = respond(self.path, count)
+                if isinstance(body, str):
+                    body = body.encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def num_requests(self):
+        return sum(self.seen.values())
+
+def self_check():
+    """Crawls a local stand-in server that rate limits and fails some requests."""
+    import tempfile
+
+    def respond(path, count):
+        json_type = {"Content-Type":"application/json"}
+        if path.endswith("/busy") and count == 1:
+            return 429, {"Retry-After":"1"}, "{}"
+        elif path.endswith("/flaky") and count < 3:
+            return 503, json_type, "{}"
+        elif path.endswith("/missing"):
+            return 404, json_type, "{}"
+        return 200, json_type, json.dumps({"path":path, "count":count})
+
+    engine = FetchEngine(max_workers=4, rate=20, burst=4, retries=3, backoff=0.1)
+    with StandInServer(respond) as server:
+        base_url = server.base_url
+        out_dir = Path(tempfile.mkdtemp(prefix="fetch_pages_"))
+        tasks = [(f"{base_url}/page/{i}", out_dir / f"page_{i}.json") for i in range(20)]
+        tasks += [(f"{base_url}/page/busy", out_dir / "busy.json"),
+                (f"{base_url}/page/flaky", out_dir / "flaky.json"),
+                (f"{base_url}/page/missing", out_dir / "missing.json")]
+        start_time = time.time()
+        failed = engine.fetch_to_files(tasks)
+        elapsed = time.time() - start_time
+        assert [t[0] for t in failed] == [f"{base_url}/page/missing"], failed
+        assert len(os.listdir(out_dir)) == len(tasks) - 1
+        # 20 requests at 20 per second, plus the second the 429 asked for
+        assert elapsed >= 1.0, elapsed
+        requests_sent = server.num_requests()
+        assert engine.fetch_to_files(tasks[:-1]) == []
+        assert server.num_requests() == requests_sent, "existing files were retrieved again"
+        print(f"Self-check passed: {len(tasks)} pages, {requests_sent} requests in {elapsed:.2f} s.")
+    engine.close()
+
+if __name__ == "__main__":
+    print("This script should not be run by itself. Run it through iGDB.py")
+    self_check()
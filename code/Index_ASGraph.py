@@ -0,0 +1,223 @@
+from pathlib import Path
+import os
+import json
+import shutil
+import tempfile
+from array import array
+import numpy as np
+
+# the code of each link from the point of view of its first AS
+P2C = 1
+C2P = -1
+P2P = 0
+
+# ASRank gives the relationship of asn1 to asn0,
+# e.g. "customer" means asn1 is a customer of asn0
+relationship_codes = {"customer":P2C, "provider":C2P, "peer":P2P}
+
+def relationship_code(relationship):
+    """Returns the code of an asn_conn relationship_type, or None if it is unknown."""
+    if relationship is None:
+        return None
+    return relationship_codes.get(str(relationship).lower())
+
+def build_csr(asn1, asn2, codes):
+    """Returns the CSR arrays of the links asn1 -> asn2 (see compile_as_graph).
+    Every link is stored in both directions, with the code negated for the reverse."""
+    asn1 = np.asarray(asn1, dtype=np.int64)
+    asn2 = np.asarray(asn2, dtype=np.int64)
+    codes = np.asarray(codes, dtype=np.int8)
+    asns = np.unique(np.concatenate([asn1, asn2]))
+    src = np.searchsorted(asns, asn1)
+    dst = np.searchsorted(asns, asn2)
+
+    # both directions, without the links that are listed more than once
+    src, dst, codes = (np.concatenate([src, dst]), np.concatenate([dst, src]),
+            np.concatenate([codes, -codes]))
+    keys = np.unique(np.stack([src, dst, codes.astype(np.int64)], axis=1), axis=0)
+    indptr = np.zeros(len(asns) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(keys[:, 0], minlength=len(asns)))
+    return {"asns":asns, "indptr":indptr, "indices":keys[:, 1].astype(np.int32),
+            "rels":keys[:, 2].astype(np.int8)}
+
+def compile_as_graph(asn1, asn2, codes, graph_dir, meta=None):
+    """Writes the AS graph of the links asn1 -> asn2 to graph_dir:
+        asns.npy    the sorted ASNs, so the id of an AS is its position
+        indptr.npy  for each id, where its links start in indices.npy and rels.npy
+        indices.npy the id of the AS at the other end of each link
+        rels.npy    the code of each link from the point of view of the first AS
+        meta.json   the number of ASes and links and anything in meta"""
+    csr = build_csr(asn1, asn2, codes)
+    graph_dir = Path(graph_dir)
+    if not os.path.isdir(graph_dir.parent):
+        os.makedirs(graph_dir.parent)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".as_graph_", dir=graph_dir.parent))
+    for name in ["asns", "indptr", "indices", "rels"]:
+        np.save(tmp_dir / f"{name}.npy", csr[name])
+    with open(tmp_dir / "meta.json", 'w') as f:
+        json.dump(graph_meta(csr, meta), f)
+
+    if os.path.isdir(graph_dir):
+        shutil.rmtree(graph_dir)
+    os.replace(tmp_dir, graph_dir)
+
+def graph_meta(csr, meta=None):
+    g_meta = dict(meta or {})
+    g_meta["NUM_ASNS"] = len(csr["asns"])
+    g_meta["NUM_LINKS"] = len(csr["indices"]) // 2
+    return g_meta
+
+def links_from_rows(rows):
+    """Returns the asn1, asn2 and code arrays of (relationship_type, asn1, asn2) rows,
+    e.g. from the asn_conn table, and the number of rows skipped because of
+    an unknown relationship or ASN."""
+    asn1 = array('q')
+    asn2 = array('q')
+    codes = array('b')
+    skipped = 0
+    for rel, a1, a2 in rows:
+        code = relationship_code(rel)
+        try:
+            a1 = int(a1)
+            a2 = int(a2)
+        except (TypeError, ValueError):
+            code = None
+        if code is None:
+            skipped += 1
+            continue
+        asn1.append(a1)
+        asn2.append(a2)
+        codes.append(code)
+    return asn1, asn2, codes, skipped
+
+def compile_from_rows(rows, graph_dir, meta=None):
+    """Compiles the graph from (relationship_type, asn1, asn2) rows.
+    Returns the number of rows skipped."""
+    asn1, asn2, codes, skipped = links_from_rows(rows)
+    compile_as_graph(asn1, asn2, codes, graph_dir, meta)
+    return skipped
+
+def graph_from_rows(rows, meta=None):
+    """Builds the graph of (relationship_type, asn1, asn2) rows in memory, without writing it."""
+    asn1, asn2, codes, skipped = links_from_rows(rows)
+    csr = build_csr(asn1, asn2, codes)
+    return ASGraph(csr=csr, meta=graph_meta(csr, meta))
+
+class ASGraph:
+    """The compiled AS relationship graph. The arrays are memory-mapped,
+    so loading it costs nothing until the links of an AS are read.
+    It can also hold arrays built in memory by build_csr."""
+    def __init__(self, graph_dir=None, csr=None, meta=None):
+        self.graph_dir = graph_dir
+        if csr is None:
+            self.graph_dir = Path(graph_dir)
+            with open(self.graph_dir / "meta.json", 'r') as f:
+                meta = json.load(f)
+            csr = {}
+            for name in ["asns", "indptr", "indices", "rels"]:
+                csr[name] = np.load(self.graph_dir / f"{name}.npy", mmap_mode='r')
+        self.meta = meta or {}
+        self.asns = csr["asns"]
+        self.indptr = csr["indptr"]
+        self.indices = csr["indices"]
+        self.rels = csr["rels"]
+
+    def __len__(self):
+        return len(self.asns)
+
+    def __contains__(self, asn):
+        return self.index(asn) >= 0
+
+    def index(self, asn):
+        """Returns the id of the ASN, or -1 if it has no links."""
+        i = int(np.searchsorted(self.asns, int(asn)))
+        if i < len(self.asns) and self.asns[i] == int(asn):
+            return i
+        return -1
+
+    def neighbor_ids(self, i, rel=None):
+        start = self.indptr[i]
+        end = self.indptr[i+1]
+        ids = self.indices[start:end]
+        if rel is None:
+            return np.asarray(ids)
+        return np.asarray(ids[self.rels[start:end] == rel])
+
+    def neighbors(self, asn, rel=None):
+        """Returns the ASNs linked to asn. rel limits them to one relationship,
+        e.g. P2C for its customers."""
+        i = self.index(asn)
+        if i < 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.asarray(self.asns[self.neighbor_ids(i, rel)])
+
+    def customers(self, asn):
+        return self.neighbors(asn, P2C)
+
+    def providers(self, asn):
+        return self.neighbors(asn, C2P)
+
+    def peers(self, asn):
+        return self.neighbors(asn, P2P)
+
+    def degree(self, asn, rel=None):
+        i = self.index(asn)
+        if i < 0:
+            return 0
+        if rel is None:
+            return int(self.indptr[i+1] - self.indptr[i])
+        return len(self.neighbor_ids(i, rel))
+
+    def degrees(self, rel=None):
+        """Returns the degree of every AS, in the order of self.asns."""
+        if rel is None:
+            return np.diff(self.indptr)
+        src = np.repeat(np.arange(len(self.asns)), np.diff(self.indptr))
+        return np.bincount(src[np.asarray(self.rels) == rel], minlength=len(self.asns))
+
+    def customer_cone(self, asn):
+        """Returns the ASNs reachable from asn over provider to customer links, including asn."""
+        i = self.index(asn)
+        if i < 0:
+            return np.zeros(0, dtype=np.int64)
+        seen = np.zeros(len(self.asns), dtype=bool)
+        seen[i] = True
+        frontier = [i]
+        while frontier:
+            next_frontier = []
+            for j in frontier:
+                for k in self.neighbor_ids(j, P2C):
+                    if not seen[k]:
+                        seen[k] = True
+                        next_frontier.append(k)
+            frontier = next_frontier
+        return np.asarray(self.asns[seen])
+
+    def cone_size(self, asn):
+        return len(self.customer_cone(asn))
+
+def find_as_graph(graph_root=Path("../cache/as_graph"), asof_date=None):
+    """Returns the directory of the graph for asof_date, or of the most recent one."""
+    if not os.path.isdir(graph_root):
+        return None
+    graphs = sorted(d for d in os.listdir(graph_root)
+            if os.path.isfile(Path(graph_root) / d / "meta.json"))
+    if asof_date is not None:
+        graphs = [d for d in graphs if d.endswith(asof_date)]
+    if not graphs:
+        return None
+    return Path(graph_root) / graphs[-1]
+
+def load_as_graph(graph_root=Path("../cache/as_graph"), asof_date=None):
+    graph_dir = find_as_graph(graph_root, asof_date)
+    if graph_dir is None:
+        print(f"\tThere is no AS graph in {graph_root}. Process the ASRank data first.")
+        return None
+    return ASGraph(graph_dir)
+
+if __name__ == "__main__":
+    print("This script should not be run by itself. Run it through iGDB.py")
+    example_dir = Path(tempfile.gettempdir()) / "as_graph_example"
+    compile_from_rows([("customer", 3356, 174), ("customer", 174, 64500), ("peer", 3356, 1299)], example_dir)
+    my_graph = ASGraph(example_dir)
+    print(my_graph.customer_cone(3356), my_graph.degree(3356), my_graph.peers(3356))
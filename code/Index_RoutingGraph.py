@@ -0,0 +1,251 @@
+from pathlib import Path
+import os
+import json
+import heapq
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import numpy as np
+import shapely.wkb
+from shapely import wkt
+
+# the tables the routing graph is built from
+graph_tables = ["city_points", "standard_paths"]
+
+# one graph per compiled directory, shared by every user in the process
+_graphs = {}
+
+def db_version(db_file):
+    """Returns a hash of the versions of the processed files loaded into city_points
+    and standard_paths, so the graph is only rebuilt when those tables change.
+    A DB without a load_manifest is versioned by the size and time of its file."""
+    sha = hashlib.sha1()
+    conn = sqlite3.connect(Path(db_file).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        rows = conn.execute(f"""SELECT table_name, file_name, file_hash, row_count
+                FROM load_manifest WHERE table_name IN ({','.join('?' * len(graph_tables))})
+                ORDER BY table_name, file_name""", graph_tables).fetchall()
+    except sqlite3.Error:
+        rows = []
+    finally:
+        conn.close()
+    if not rows:
+        s = os.stat(db_file)
+        rows = [["DB_FILE", s.st_size, s.st_mtime_ns]]
+    sha.update(json.dumps(rows).encode())
+    return sha.hexdigest()
+
+def compile_routing_graph(db_file, graph_dir, version=None):
+    """Reads city_points and standard_paths once and writes the routing graph to graph_dir:
+        lats.npy     the latitude of each city, NaN for a city that is only in standard_paths
+        lons.npy     the longitude of each city
+        indptr.npy   for each city, where its paths start in indices.npy, edges.npy and dists.npy
+        indices.npy  the city at the other end of each path
+        edges.npy    the path of each entry, both directions of a path share one
+        dists.npy    the distance in km of each entry
+        edge_ends.npy the from and to city of each path
+        geoms.bin    every path as WKB, back to back
+        offsets.npy  where each path starts in geoms.bin
+        meta.json    the (city, state, country) of each city and the version of the DB
+    Only the shortest path between two cities is kept, the same in both directions."""
+    print(f"\tCompiling the routing graph of {db_file} into {graph_dir}.")
+    if version is None:
+        version = db_version(db_file)
+    conn = sqlite3.connect(Path(db_file).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        cities = []
+        city_ids = {}
+        lats = []
+        lons = []
+        for city, state, country, lat, lon in conn.execute("""SELECT city_name, state_province,
+                country_code, city_latitude, city_longitude FROM city_points"""):
+            key = (city, state, country)
+            if key in city_ids:
+                continue
+            city_ids[key] = len(cities)
+            cities.append(key)
+            lats.append(float(lat))
+            lons.append(float(lon))
+
+        def city_id(key):
+            if not key in city_ids:
+                city_ids[key] = len(cities)
+                cities.append(key)
+                lats.append(np.nan)
+                lons.append(np.nan)
+            return city_ids[key]
+
+        # the shortest path of each pair of cities, in the order they were read
+        best = {}
+        for fc, fs, fcc, tc, ts, tcc, dist_km, path_wkt in conn.execute("""SELECT from_city,
+                from_state, from_country, to_city, to_state, to_country, distance_km, path_wkt
+                FROM standard_paths"""):
+            a = city_id((fc, fs, fcc))
+            b = city_id((tc, ts, tcc))
+            pair = (min(a, b), max(a, b))
+            dist_km = float(dist_km)
+            if not pair in best or dist_km < best[pair][2]:
+                best[pair] = (a, b, dist_km, path_wkt)
+    finally:
+        conn.close()
+
+    graph_dir = Path(graph_dir)
+    if not os.path.isdir(graph_dir.parent):
+        os.makedirs(graph_dir.parent)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".routing_graph_", dir=graph_dir.parent))
+
+    edge_ends = np.zeros((len(best), 2), dtype=np.int32)
+    edge_dists = np.zeros(len(best), dtype=np.float64)
+    offsets = np.zeros(len(best) + 1, dtype=np.int64)
+    with open(tmp_dir / "geoms.bin", 'wb') as f:
+        for e, (a, b, dist_km, path_wkt) in enumerate(best.values()):
+            edge_ends[e] = (a, b)
+            edge_dists[e] = dist_km
+            # the WKT is parsed once here, and the WKB only when the path is on a route
+            wkb = wkt.loads(path_wkt).wkb if path_wkt else b''
+            f.write(wkb)
+            offsets[e+1] = offsets[e] + len(wkb)
+
+    # both directions of every path, grouped by the city they start from
+    src = np.concatenate([edge_ends[:, 0], edge_ends[:, 1]]).astype(np.int64)
+    dst = np.concatenate([edge_ends[:, 1], edge_ends[:, 0]]).astype(np.int32)
+    edges = np.concatenate([np.arange(len(best)), np.arange(len(best))]).astype(np.int32)
+    order = np.argsort(src, kind="stable")
+    indptr = np.zeros(len(cities) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(src, minlength=len(cities)))
+
+    np.save(tmp_dir / "lats.npy", np.array(lats, dtype=np.float64))
+    np.save(tmp_dir / "lons.npy", np.array(lons, dtype=np.float64))
+    np.save(tmp_dir / "indptr.npy", indptr)
+    np.save(tmp_dir / "indices.npy", dst[order])
+    np.save(tmp_dir / "edges.npy", edges[order])
+    np.save(tmp_dir / "dists.npy", edge_dists[edges[order]])
+    np.save(tmp_dir / "edge_ends.npy", edge_ends)
+    np.save(tmp_dir / "offsets.npy", offsets)
+    meta = {"DB_VERSION":version, "NUM_CITIES":len(cities), "NUM_PATHS":len(best),
+            "CITIES":[list(c) for c in cities]}
+    with open(tmp_dir / "meta.json", 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(graph_dir):
+        shutil.rmtree(graph_dir)
+    os.replace(tmp_dir, graph_dir)
+
+class RoutingGraph:
+    """The compiled graph of the standard paths between cities. The arrays are memory-mapped,
+    and a path is only parsed from its WKB when it is on a route that was found."""
+    def __init__(self, graph_dir):
+        self.graph_dir = Path(graph_dir)
+        with open(self.graph_dir / "meta.json", 'r') as f:
+            meta = json.load(f)
+        self.db_version = meta["DB_VERSION"]
+        self.cities = [tuple(c) for c in meta["CITIES"]]
+        self.num_paths = meta["NUM_PATHS"]
+        for name in ["lats", "lons", "indptr", "indices", "edges", "dists", "edge_ends", "offsets"]:
+            # a plain view of the mapping, slicing a memmap is several times slower
+            setattr(self, name, np.asarray(np.load(self.graph_dir / f"{name}.npy", mmap_mode='r')))
+        if os.path.getsize(self.graph_dir / "geoms.bin") > 0:
+            self.wkb = np.memmap(self.graph_dir / "geoms.bin", dtype=np.uint8, mode='r')
+        else:
+            self.wkb = np.zeros(0, dtype=np.uint8)
+        self.city_ids = None
+        self.geoms = {}
+
+    def __len__(self):
+        return len(self.cities)
+
+    def city_id(self, city):
+        """Returns the id of a (city, state, country), or -1 if it is not in the graph."""
+        if self.city_ids is None:
+            self.city_ids = {c:i for i, c in enumerate(self.cities)}
+        return self.city_ids.get(tuple(city), -1)
+
+    def point(self, i):
+        """Returns the (lon, lat) of city i, or None if it has no coordinates."""
+        lon = float(self.lons[i])
+        lat = float(self.lats[i])
+        if np.isnan(lon) or np.isnan(lat):
+            return None
+        return lon, lat
+
+    def geometry(self, e):
+        """Returns the geometry of path e, or None if it has none."""
+        if not e in self.geoms:
+            start = self.offsets[e]
+            end = self.offsets[e+1]
+            if start == end:
+                self.geoms[e] = None
+            else:
+                self.geoms[e] = shapely.wkb.loads(self.wkb[start:end].tobytes())
+        return self.geoms[e]
+
+    def shortest_path(self, src, dst):
+        """Returns the cities and the paths of the shortest route from city src to city dst
+        by distance, and its length in km, or None if dst cannot be reached (Dijkstra)."""
+        dist = {src:0.0}
+        prev = {}
+        done = set()
+        heap = [(0.0, src)]
+        while heap:
+            d, v = heapq.heappop(heap)
+            if v in done:
+                continue
+            if v == dst:
+                break
+            done.add(v)
+            start = self.indptr[v]
+            end = self.indptr[v+1]
+            for w, e, w_dist in zip(self.indices[start:end].tolist(),
+                    self.edges[start:end].tolist(), self.dists[start:end].tolist()):
+                nd = d + w_dist
+                if nd < dist.get(w, np.inf):
+                    dist[w] = nd
+                    prev[w] = (v, e)
+                    heapq.heappush(heap, (nd, w))
+        if not dst in dist:
+            return None
+        route = [dst]
+        path_ids = []
+        while route[-1] != src:
+            v, e = prev[route[-1]]
+            route.append(v)
+            path_ids.append(e)
+        route.reverse()
+        path_ids.reverse()
+        return route, path_ids, dist[dst]
+
+def find_routing_graph(db_file, graph_root=Path("../cache/routing_graph")):
+    return Path(graph_root) / Path(db_file).stem
+
+def get_routing_graph(db_file, graph_root=Path("../cache/routing_graph")):
+    """Returns the routing graph of db_file, compiling it first if it is missing
+    or city_points or standard_paths changed since it was compiled."""
+    graph_dir = find_routing_graph(db_file, graph_root)
+    key = str(graph_dir.resolve())
+    version = db_version(db_file)
+    if key in _graphs and _graphs[key].db_version == version:
+        return _graphs[key]
+    graph = None
+    if os.path.isfile(graph_dir / "meta.json"):
+        try:
+            graph = RoutingGraph(graph_dir)
+            if graph.db_version != version:
+                print("\tThe database changed since its routing graph was compiled.")
+                graph = None
+        except Exception as e:
+            print(f"\tCould not load the routing graph: {e}")
+            graph = None
+    if graph is None:
+        compile_routing_graph(db_file, graph_dir, version)
+        graph = RoutingGraph(graph_dir)
+    _graphs[key] = graph
+    return graph
+
+if __name__ == "__main__":
+    print("This script should not be run by itself. Run it through iGDB.py")
+    db_dir = Path("../database")
+    if os.path.isdir(db_dir):
+        for f in os.listdir(db_dir):
+            my_graph = get_routing_graph(db_dir / f)
+            print(f"{f}: {len(my_graph)} cities, {my_graph.num_paths} paths.")
@@ -0,0 +1,305 @@
+from pathlib import Path
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import shapely.wkb
+from shapely.geometry import Point
+
+try:
+    from shapely import contains_xy, prepare
+except ImportError:
+    # shapely < 2 has no vectorized point in polygon test
+    contains_xy = None
+    prepare = None
+
+# the columns of the shapefile that the processors need
+attribute_columns = ["LATITUDE", "LONGITUDE", "NAME", "ADM1NAME", "ISO_A2"]
+
+# the spatial index is a grid of 1 degree cells covering the world
+grid_cols = 360
+grid_rows = 180
+
+# one index per compiled directory, shared by every user in the process
+_indexes = {}
+
+def voronoi_hash(voronoi_shapefile):
+    """Hashes the files of the shapefile that hold the polygons and their attributes,
+    so anything derived from the Voronoi map can tell when the map changes."""
+    sha = hashlib.sha1()
+    for ext in [".shp", ".shx", ".dbf"]:
+        f_name = Path(voronoi_shapefile).with_suffix(ext)
+        if not os.path.isfile(f_name):
+            continue
+        with open(f_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def source_stats(voronoi_shapefile):
+    stats = {}
+    for ext in [".shp", ".shx", ".dbf"]:
+        f_name = Path(voronoi_shapefile).with_suffix(ext)
+        if os.path.isfile(f_name):
+            s = os.stat(f_name)
+            stats[ext] = [s.st_size, s.st_mtime_ns]
+    return stats
+
+def grid_col(lons):
+    return np.clip(np.floor(np.asarray(lons, dtype=float) + 180), 0, grid_cols - 1).astype(np.int64)
+
+def grid_row(lats):
+    return np.clip(np.floor(np.asarray(lats, dtype=float) + 90), 0, grid_rows - 1).astype(np.int64)
+
+def grid_cells(lons, lats):
+    return grid_row(lats) * grid_cols + grid_col(lons)
+
+def compile_voronoi_index(voronoi_shapefile, index_dir, map_hash=None):
+    """Reads the shapefile once and writes the compiled index to index_dir:
+        bounds.npy     the bounding box of each polygon (minx, miny, maxx, maxy)
+        geoms.bin      every polygon as WKB, back to back
+        offsets.npy    where each polygon starts in geoms.bin
+        cell_start.npy for each grid cell, where its polygons start in cell_items.npy
+        cell_items.npy the polygons whose bounding box overlaps each grid cell
+        meta.json      the attributes of each polygon and the hash of the shapefile"""
+    import geopandas as gpd
+    print(f"\tCompiling {voronoi_shapefile} into {index_dir}.")
+    if map_hash is None:
+        map_hash = voronoi_hash(voronoi_shapefile)
+    cities_df = gpd.read_file(voronoi_shapefile)
+    attributes = {}
+    for column in attribute_columns:
+        if column in cities_df.columns:
+            attributes[column] = [None if v != v else v for v in cities_df[column].tolist()]
+    write_voronoi_index(list(cities_df.geometry), attributes, index_dir, map_hash,
+            source_stats(voronoi_shapefile))
+
+def write_voronoi_index(geoms, attributes, index_dir, map_hash, stats):
+    """Writes the files of the index of the polygons geoms (see compile_voronoi_index).
+    If any of the attribute columns is missing, e.g. without the .dbf of the shapefile,
+    the polygons have no cities, so no point is matched to one."""
+    missing = [c for c in attribute_columns if not c in attributes]
+    if missing:
+        print(f"\tThe Voronoi map has no {', '.join(missing)} column(s). ", end='')
+        print(f"Its .dbf file is missing or incomplete, so no location will be matched to a city.")
+        attributes = dict(attributes)
+        for column in missing:
+            attributes[column] = [None] * len(geoms)
+    index_dir = Path(index_dir)
+    if not os.path.isdir(index_dir.parent):
+        os.makedirs(index_dir.parent)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".voronoi_", dir=index_dir.parent))
+
+    bounds = np.array([g.bounds for g in geoms], dtype=np.float64).reshape(-1, 4)
+    offsets = np.zeros(len(geoms) + 1, dtype=np.int64)
+    with open(tmp_dir / "geoms.bin", 'wb') as f:
+        for i, g in enumerate(geoms):
+            wkb = g.wkb
+            f.write(wkb)
+            offsets[i+1] = offsets[i] + len(wkb)
+
+    # every polygon is listed in each cell its bounding box touches
+    cell_list = []
+    item_list = []
+    for i, (minx, miny, maxx, maxy) in enumerate(bounds):
+        if np.isnan(minx):
+            # an empty polygon cannot hold anything
+            continue
+        c0, c1 = grid_col([minx, maxx])
+        r0, r1 = grid_row([miny, maxy])
+        cells = (np.arange(r0, r1 + 1)[:, None] * grid_cols + np.arange(c0, c1 + 1)[None, :]).ravel()
+        cell_list.append(cells)
+        item_list.append(np.full(len(cells), i, dtype=np.int32))
+    cells = np.concatenate(cell_list) if cell_list else np.zeros(0, dtype=np.int64)
+    items = np.concatenate(item_list) if item_list else np.zeros(0, dtype=np.int32)
+    # a stable sort keeps the polygons of each cell in ascending order
+    order = np.argsort(cells, kind="stable")
+    cell_start = np.zeros(grid_cols * grid_rows + 1, dtype=np.int64)
+    cell_start[1:] = np.cumsum(np.bincount(cells, minlength=grid_cols * grid_rows))
+
+    np.save(tmp_dir / "bounds.npy", bounds)
+    np.save(tmp_dir / "offsets.npy", offsets)
+    np.save(tmp_dir / "cell_start.npy", cell_start)
+    np.save(tmp_dir / "cell_items.npy", items[order])
+    meta = {"MAP_HASH":map_hash, "SOURCE_STATS":stats, "MISSING_COLUMNS":missing,
+            "NUM_POLYGONS":len(geoms), "ATTRIBUTES":attributes}
+    with open(tmp_dir / "meta.json", 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(index_dir):
+        shutil.rmtree(index_dir)
+    os.replace(tmp_dir, index_dir)
+
+class VoronoiIndex:
+    """The compiled Voronoi map. The arrays are memory-mapped,
+    and a polygon is only parsed from its WKB the first time it is tested."""
+    def __init__(self, index_dir):
+        self.index_dir = Path(index_dir)
+        with open(self.index_dir / "meta.json", 'r') as f:
+            meta = json.load(f)
+        self.map_hash = meta["MAP_HASH"]
+        self.source_stats = meta["SOURCE_STATS"]
+        self.attributes = meta["ATTRIBUTES"]
+        self.num_polygons = meta["NUM_POLYGONS"]
+        self.missing_columns = meta.get("MISSING_COLUMNS", [])
+        self.bounds = np.load(self.index_dir / "bounds.npy", mmap_mode='r')
+        self.offsets = np.load(self.index_dir / "offsets.npy", mmap_mode='r')
+        self.cell_start = np.load(self.index_dir / "cell_start.npy", mmap_mode='r')
+        self.cell_items = np.load(self.index_dir / "cell_items.npy", mmap_mode='r')
+        if os.path.getsize(self.index_dir / "geoms.bin") > 0:
+            self.wkb = np.memmap(self.index_dir / "geoms.bin", dtype=np.uint8, mode='r')
+        else:
+            self.wkb = np.zeros(0, dtype=np.uint8)
+        self.geoms = {}
+
+    def __len__(self):
+        return self.num_polygons
+
+    def geometry(self, i):
+        if not i in self.geoms:
+            geom = shapely.wkb.loads(self.wkb[self.offsets[i]:self.offsets[i+1]].tobytes())
+            if prepare:
+                prepare(geom)
+            self.geoms[i] = geom
+        return self.geoms[i]
+
+    def location(self, i):
+        """Returns the attributes of polygon i keyed like LocationStandardizer.standardize()."""
+        return {"LATITUDE":self.attributes["LATITUDE"][i],
+                "LONGITUDE":self.attributes["LONGITUDE"][i],
+                "CITY":self.attributes["NAME"][i],
+                "STATE":self.attributes["ADM1NAME"][i],
+                "COUNTRY":self.attributes["ISO_A2"][i]}
+
+    def lookup(self, lat, lon):
+        """Returns the polygon holding the point, or -1 if there is none."""
+        return int(self.lookup_many([lat], [lon])[0])
+
+    def lookup_many(self, lats, lons):
+        """Returns the polygon holding each point, or -1 where there is none.
+        If a point is inside more than one polygon, the lowest numbered one wins.
+        A point with a missing or infinite coordinate is in no polygon."""
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        result = np.full(len(lats), -1, dtype=np.int64)
+        valid = np.isfinite(lats) & np.isfinite(lons)
+        if not valid.all():
+            result[valid] = self.lookup_many(lats[valid], lons[valid])
+            return result
+        if len(lats) == 0 or self.num_polygons == 0 or self.missing_columns:
+            return result
+
+        # the candidates of each point are the polygons listed in its grid cell
+        cells = grid_cells(lons, lats)
+        starts = self.cell_start[cells]
+        counts = self.cell_start[cells + 1] - starts
+        point_idx = np.repeat(np.arange(len(lats)), counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        cand = self.cell_items[np.repeat(starts, counts) + np.arange(counts.sum()) - first]
+
+        # then only the ones whose bounding box holds the point
+        b = self.bounds[cand]
+        x = lons[point_idx]
+        y = lats[point_idx]
+        in_box = (b[:, 0] <= x) & (x <= b[:, 2]) & (b[:, 1] <= y) & (y <= b[:, 3])
+        point_idx = point_idx[in_box]
+        cand = cand[in_box]
+        x = x[in_box]
+        y = y[in_box]
+
+        # and finally the exact test, once per candidate polygon
+        hit = np.zeros(len(cand), dtype=bool)
+        order = np.argsort(cand, kind="stable")
+        splits = np.flatnonzero(np.diff(cand[order])) + 1
+        for group in np.split(order, splits):
+            if len(group) == 0:
+                continue
+            geom = self.geometry(int(cand[group[0]]))
+            if contains_xy:
+                hit[group] = contains_xy(geom, x[group], y[group])
+            else:
+                hit[group] = [geom.contains(Point(px, py)) for px, py in zip(x[group], y[group])]
+
+        lowest = np.full(len(lats), self.num_polygons, dtype=np.int64)
+        np.minimum.at(lowest, point_idx[hit], cand[hit].astype(np.int64))
+        found = lowest < self.num_polygons
+        result[found] = lowest[found]
+        return result
+
+    def is_current(self, voronoi_shapefile):
+        """Checks the compiled index against the shapefile.
+        The file sizes and times are compared first, and the contents only if those differ."""
+        if self.source_stats == json.loads(json.dumps(source_stats(voronoi_shapefile))):
+            return True
+        return self.map_hash == voronoi_hash(voronoi_shapefile)
+
+def get_voronoi_index(voronoi_dir, index_dir=Path("../cache/voronoi_index")):
+    """Returns the process-wide index of voronoi_dir/cities_Voronoi.shp,
+    compiling it first if it is missing or the shapefile changed."""
+    voronoi_shapefile = Path(voronoi_dir) / "cities_Voronoi.shp"
+    key = str(Path(index_dir).resolve())
+    if key in _indexes:
+        return _indexes[key]
+    index = None
+    if os.path.isfile(Path(index_dir) / "meta.json"):
+        try:
+            index = VoronoiIndex(index_dir)
+            if not index.is_current(voronoi_shapefile):
+                print("\tThe Voronoi map changed since its index was compiled.")
+                index = None
+        except Exception as e:
+            print(f"\tCould not load the Voronoi index: {e}")
+            index = None
+    if index is None:
+        compile_voronoi_index(voronoi_shapefile, index_dir)
+        index = VoronoiIndex(index_dir)
+    _indexes[key] = index
+    return index
+
+def prepare_voronoi_index(voronoi_dir):
+    """Compiles the index ahead of the processors that share it."""
+    print("Preparing the Voronoi map index.")
+    if not os.path.isfile(Path(voronoi_dir) / "cities_Voronoi.shp"):
+        print("\tThe Voronoi map helper file does not exist. Cannot compile its index.")
+        return
+    get_voronoi_index(voronoi_dir)
+
+def self_check():
+    """Looks up points in a small index of two squares, including points without coordinates."""
+    from shapely.geometry import box
+    index_dir = Path(tempfile.mkdtemp(prefix="voronoi_index_")) / "index"
+    geoms = [box(-75, 40, -73, 42), box(-4, 40, -3, 41)]
+    attributes = {"LATITUDE":[41.0, 40.5], "LONGITUDE":[-74.0, -3.5], "NAME":["New York", "Madrid"],
+            "ADM1NAME":["New York", "Madrid"], "ISO_A2":["US", "ES"]}
+    write_voronoi_index(geoms, attributes, index_dir, "self-check", {})
+    my_index = VoronoiIndex(index_dir)
+    lats = [np.nan, 40.7, 40.5, 0.0, 40.7, np.inf, 40.5]
+    lons = [np.nan, -74.0, -3.5, 0.0, np.nan, -74.0, -np.inf]
+    found = my_index.lookup_many(lats, lons).tolist()
+    assert found == [-1, 0, 1, -1, -1, -1, -1], found
+    assert my_index.lookup(np.nan, np.nan) == -1
+    assert my_index.lookup_many([np.nan], [np.nan]).tolist() == [-1]
+    assert my_index.location(1)["CITY"] == "Madrid"
+    # a map without its .dbf has no cities to match
+    del attributes["NAME"]
+    write_voronoi_index(geoms, attributes, index_dir, "self-check", {})
+    my_index = VoronoiIndex(index_dir)
+    assert my_index.missing_columns == ["NAME"]
+    assert my_index.lookup_many(lats, lons).tolist() == [-1] * len(lats)
+    print(f"Self-check passed: {len(lats)} points.")
+    shutil.rmtree(index_dir.parent)
+
+if __name__ == "__main__":
+    print("This script should not be run by itself. Run it through iGDB.py")
+    if "--self-check" in sys.argv:
+        self_check()
+        sys.exit(0)
+    voronoi_dir = Path("../helper_data/cities_Voronoi")
+    my_index = get_voronoi_index(voronoi_dir)
+    chicago = [41.848, -87.699]
+    madrid = [40.326, -3.526]
+    for i in my_index.lookup_many([chicago[0], madrid[0]], [chicago[1], madrid[1]]):
+        print(my_index.location(i))
@@ -0,0 +1,103 @@
+from pathlib import Path
+import os
+import json
+import time
+import threading
+
+class CrawlJournal:
+    """
+        An append-only record of the work units a crawler has finished,
+        one json line per unit, e.g. a page with the file it was saved to,
+        or a measurement ID retrieved for an anchor.
+        Each line is flushed and synced to disk as soon as the unit is done,
+        so after a crash the crawler reads the journal and skips everything in it.
+        A line cut short by the crash is ignored, and that unit is done again.
+        A unit recorded again later replaces the earlier line when the journal is read.
+    """
+    def __init__(self, journal_file):
+        self.journal_file = Path(journal_file)
+        self.units = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(self.journal_file):
+            self.load()
+        elif not os.path.isdir(self.journal_file.parent):
+            os.makedirs(self.journal_file.parent)
+        self.f = open(self.journal_file, 'a')
+        if self.f.tell() > 0 and not self.ends_with_newline():
+            # the line cut short by a crash must not run into the next one
+            self.f.write('\n')
+            self.f.flush()
+
+    def ends_with_newline(self):
+        with open(self.journal_file, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def load(self):
+        with open(self.journal_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.units[entry["UNIT"]] = entry
+                except (ValueError, KeyError, TypeError):
+                    continue
+        if self.units:
+            print(f"\tResuming from {self.journal_file}, {len(self.units)} units already done.")
+
+    def is_done(self, unit):
+        """Returns True if the unit is recorded, and its payload file, if it has one, still exists."""
+        entry = self.units.get(unit)
+        if entry is None:
+            return False
+        payload = entry.get("PAYLOAD")
+        return payload is None or os.path.isfile(self.journal_file.parent / payload)
+
+    def data(self, unit, default=None):
+        """Returns the data recorded with the unit."""
+        if not self.is_done(unit):
+            return default
+        return self.units[unit].get("DATA", default)
+
+    def done_units(self, prefix=''):
+        return [u for u in self.units if u.startswith(prefix) and self.is_done(u)]
+
+    def record(self, unit, payload=None, data=None):
+        """Records the unit as done. payload is the file the unit was saved to,
+        stored relative to the journal, and data is anything small enough to keep inline."""
+        entry = {"UNIT":unit, "TIME":int(time.time())}
+        if payload is not None:
+            payload = Path(payload)
+            try:
+                payload = payload.relative_to(self.journal_file.parent)
+            except ValueError:
+                payload = Path(os.path.relpath(payload, self.journal_file.parent))
+            entry["PAYLOAD"] = str(payload)
+        if data is not None:
+            entry["DATA"] = data
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.units[unit] = entry
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
+    def remove(self):
+        """Removes the journal once the crawl it records is complete."""
+        self.close()
+        if os.path.isfile(self.journal_file):
+            os.remove(self.journal_file)
+
+if __name__ == "__main__":
+    print("This script should not be run by itself. Run it through iGDB.py")
+    import tempfile
+    example_file = Path(tempfile.mkdtemp(prefix="crawl_journal_")) / ".crawl_journal"
+    my_journal = CrawlJournal(example_file)
+    my_journal.record("msm:6001", data=[6001, 1234])
+    my_journal.close()
+    with open(example_file, 'a') as f:
+        f.write('{"UNIT": "msm:6002", "DA')
+    print(CrawlJournal(example_file).data("msm:6001"), CrawlJournal(example_file).is_done("msm:6002"))
@@ -1,17 +1,16 @@
 import os
 from pathlib import Path
 import geopandas as gpd
-from shapely import wkt
-from shapely.geometry import LineString
 from shapely.geometry import Point
-import networkx as nx
 import matplotlib.pyplot as plt
 import Querying_Database as qdb
+import Index_RoutingGraph
 import sys
 
 
 class PlottingShortestPath:
     def __init__(self, db_file, from_place, to_place, out_dir):
+        self.db_file = db_file
         self.querier = qdb.queryDatabase(db_file)
         self.src = from_place
         self.dst = to_place
@@ -20,9 +19,7 @@ class PlottingShortestPath:
             os.makedirs(self.out_dir)
 
         self.world_countries = "../helper_data/World_Countries_(Generalized)/World_Countries__Generalized_.shp"
-        self.nodes_dict = {}
-        self.edges_dict = {}
-        self.standard_graph = nx.Graph()
+        self.routing_graph = None
         self.route = None
         self.dist = 0.0
         self.route_geom = []
@@ -32,11 +29,10 @@ class PlottingShortestPath:
         print(f"Finding and plotting shortest path from '{self.src}' to '{self.dst}'.")
         cities_valid = self.are_cities_valid()
         if cities_valid:
-            self.query_db_for_nodes()
-            self.query_db_for_edges()
-            self.create_graph()
+            self.routing_graph = Index_RoutingGraph.get_routing_graph(self.db_file)
             self.get_shortest_path()
-            self.dist = self.calc_dist_along_path(self.route)
+            if self.route is None:
+                return
             print(f"\nRoute: {self.route}")
             print(f"Distance along route: {self.dist:.2f} km.\n")
             self.make_plot()
@@ -46,15 +42,17 @@ class PlottingShortestPath:
             fc = self.src.split(',')[0].strip()
             fs = self.src.split(',')[1].strip()
             fcc = self.src.split(',')[2].strip()
-            f_query = f"""SELECT * 
+            f_query = """SELECT *
                 FROM city_points
-                WHERE city_name='{fc}' AND state_province='{fs}' AND country_code='{fcc}';"""
+                WHERE city_name=? AND state_province=? AND country_code=?;"""
+            f_params = (fc, fs, fcc)
         elif len(self.src.split(',')) == 2:
             fc = self.src.split(',')[0].strip()
             fcc = self.src.split(',')[1].strip()
-            f_query = f"""SELECT * 
+            f_query = """SELECT *
                 FROM city_points
-                WHERE city_name='{fc}' AND country_code='{fcc}';"""
+                WHERE city_name=? AND country_code=?;"""
+            f_params = (fc, fcc)
         else:
             print("Please specify a city/country or city/state/country")
             return False
@@ -63,21 +61,23 @@ class PlottingShortestPath:
             tc = self.dst.split(',')[0].strip()
             ts = self.dst.split(',')[1].strip()
             tcc = self.dst.split(',')[2].strip()
-            t_query = f"""SELECT * 
+            t_query = """SELECT *
                 FROM city_points
-                WHERE city_name='{tc}' AND state_province='{ts}' AND country_code='{tcc}';"""
+                WHERE city_name=? AND state_province=? AND country_code=?;"""
+            t_params = (tc, ts, tcc)
         elif len(self.dst.split(',')) == 2:
             tc = self.dst.split(',')[0].strip()
             tcc = self.dst.split(',')[1].strip()
-            t_query = f"""SELECT * 
+            t_query = """SELECT *
                 FROM city_points
-                WHERE city_name='{tc}' AND country_code='{tcc}';"""
+                WHERE city_name=? AND country_code=?;"""
+            t_params = (tc, tcc)
         else:
             print("Please specify a city/country or city/state/country")
             return False
 
         # verify the source node is in the DB
-        results = self.querier.execute_query(f_query)
+        results = self.querier.execute_query(f_query, f_params)
         if len(results) == 0:
             print(f"{self.src} not found in the database.")
             return False
@@ -93,7 +93,7 @@ class PlottingShortestPath:
             fcc = results[0][2]
 
         # verify the destination node is in the DB
-        results = self.querier.execute_query(t_query)
+        results = self.querier.execute_query(t_query, t_params)
         if len(results) == 0:
             print(f"{self.dst} not found in the database.")
             return False
@@ -114,55 +114,6 @@ class PlottingShortestPath:
 
         return True
 
-    def query_db_for_nodes(self):
-        #print("Querying the DB for the graph nodes.")
-
-        nodes_query = f"""SELECT * FROM city_points;"""
-        results = self.querier.execute_query(nodes_query)
-        for row in results:
-            city = row[0]
-            state = row[1]
-            country = row[2]
-            lat = float(row[3])
-            lon = float(row[4])
-            self.nodes_dict[(city, state, country)] = {}
-            self.nodes_dict[(city, state, country)]['x'] = lon
-            self.nodes_dict[(city, state, country)]['y'] = lat
-            self.nodes_dict[(city, state, country)]['GEOM'] = Point(lon, lat)
-
-    def query_db_for_edges(self):
-        #print("Querying the DB for the graph edges.")
-
-        nodes_query = f"""SELECT * FROM standard_paths;"""
-        results = self.querier.execute_query(nodes_query)
-        for row in results:
-            fc = row[0]
-            fs = row[1]
-            fcc = row[2]
-            tc = row[3]
-            ts = row[4]
-            tcc = row[5]
-            dist_km = float(row[6])
-            path_wkt = row[7]
-            edge = ((fc, fs, fcc), (tc, ts, tcc))
-            self.edges_dict[edge] = {}
-            self.edges_dict[edge]['DIST_KM'] = dist_km
-            self.edges_dict[edge]['GEOM'] = wkt.loads(path_wkt)
-
-    def create_graph(self):
-        #print("Creating the graph.")
-        # add nodes
-        for n in self.nodes_dict.keys():
-            x = self.nodes_dict[n]['x']
-            y = self.nodes_dict[n]['y']
-            geom = self.nodes_dict[n]['GEOM']
-            self.standard_graph.add_node(n, x=x, y=y, geom=geom)
-        # add edges
-        for e in self.edges_dict.keys():
-            dist = self.edges_dict[e]['DIST_KM']
-            geom = self.edges_dict[e]['GEOM']
-            self.standard_graph.add_edge(e[0], e[1], dist_km=dist, geom=geom)
-
     def get_shortest_path(self):
         fc = self.src.split(',')[0].strip()
         fs = self.src.split(',')[1].strip()
@@ -174,29 +125,25 @@ class PlottingShortestPath:
         src = (fc, fs, fcc)
         dst = (tc, ts, tcc)
 
-        try:
-            self.route = nx.shortest_path(self.standard_graph, src, dst, weight='dist_km')
-            for i in range(len(self.route)-1):
-                e = (self.route[i], self.route[i+1])
-                if not e in self.edges_dict.keys():
-                    e = (self.route[i+1], self.route[i])
-                geom = self.edges_dict[e]["GEOM"]
-                self.route_geom.append(geom)
-                if not self.nodes_dict[e[0]]["GEOM"] in self.waypoints_geom:
-                    self.waypoints_geom.append(self.nodes_dict[e[0]]["GEOM"])
-                if not self.nodes_dict[e[1]]["GEOM"] in self.waypoints_geom:
-                    self.waypoints_geom.append(self.nodes_dict[e[1]]["GEOM"])
-        except:
+        src_id = self.routing_graph.city_id(src)
+        dst_id = self.routing_graph.city_id(dst)
+        result = None
+        if src_id >= 0 and dst_id >= 0:
+            result = self.routing_graph.shortest_path(src_id, dst_id)
+        if result is None:
             print(f"Could not complete query from '{self.src}' to '{self.dst}'.")
-
-    def calc_dist_along_path(self, route):
-        dist = 0.0
-        for i in range(len(route)-1):
-            e = (route[i], route[i+1])
-            if not e in self.edges_dict.keys():
-                e = (route[i+1], route[i])
-            dist += self.edges_dict[e]["DIST_KM"]
-        return dist
+            return
+        route_ids, path_ids, self.dist = result
+        self.route = [self.routing_graph.cities[i] for i in route_ids]
+        # only the paths on the route are decoded
+        for e in path_ids:
+            geom = self.routing_graph.geometry(e)
+            if geom is not None:
+                self.route_geom.append(geom)
+        for i in route_ids:
+            point = self.routing_graph.point(i)
+            if point is not None:
+                self.waypoints_geom.append(Point(point))
 
     def make_plot(self):
         #print("Making plot")
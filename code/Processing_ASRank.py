@@ -1,10 +1,12 @@
 from pathlib import Path
 import os
-import json
-import csv
+from array import array
 from datetime import date
 from datetime import timedelta
 import dbStructure
+import Buffer_Rows
+import Index_ASGraph
+import Stream_JSON
 
 class ProcessingASRank:
     def __init__(self, in_dir, out_dir):
@@ -20,10 +22,12 @@ class ProcessingASRank:
         #self.find_nearest_input_files(in_dir)
         self.out_dir =  out_dir
         self.org_map = {}
+        # one compiled AS relationship graph per date, with the other compiled artifacts
+        self.as_graph_dir = Path("../cache/as_graph")
 
         # setup for asn_conn table
-        self.asn_conn_list = []
         name, fields = self.read_fields(dbStructure.sql_create_asn_conn_table)
+        self.asn_conn_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_asn_conn_table, spill_dir=self.out_dir / name)
         self.asn_conn_header = fields
         self.asn_conn_table = name 
 
@@ -31,8 +35,8 @@ class ProcessingASRank:
             os.makedirs(self.out_dir / self.asn_conn_table)
 
         # setup for asn_asname table
-        self.asn_asname_list = []
         name, fields = self.read_fields(dbStructure.sql_create_asn_asname_table)
+        self.asn_asname_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_asn_asname_table, spill_dir=self.out_dir / name)
         self.asn_asname_header = fields
         self.asn_asname_table = name 
 
@@ -40,8 +44,8 @@ class ProcessingASRank:
             os.makedirs(self.out_dir / self.asn_asname_table)
 
         # setup for asn_org table
-        self.asn_org_list = []
         name, fields = self.read_fields(dbStructure.sql_create_asn_org_table)
+        self.asn_org_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_asn_org_table, spill_dir=self.out_dir / name)
         self.asn_org_header = fields
         self.asn_org_table = name 
 
@@ -71,41 +75,50 @@ class ProcessingASRank:
         for folder in os.listdir(self.in_dir):
             self.asof_date = folder.replace("_", "-")
             self.read_links_file(self.in_dir / folder / self.links_file)
+            self.save_as_graph()
             self.read_orgs_file(self.in_dir / folder / self.orgs_file)
             self.read_asns_file(self.in_dir / folder / self.asn_asname_file)
 
         t_file = f"{self.data_source}_{self.asn_conn_table}.csv" 
         asn_conn_file = self.out_dir / self.asn_conn_table / t_file
-        self.save_csv(self.asn_conn_list, self.asn_conn_header, asn_conn_file)
+        self.asn_conn_list.write_csv(asn_conn_file)
 
         t_file = f"{self.data_source}_{self.asn_asname_table}.csv"
         asn_asname_file = self.out_dir / self.asn_asname_table / t_file
-        self.save_csv(self.asn_asname_list, self.asn_asname_header, asn_asname_file)
+        self.asn_asname_list.write_csv(asn_asname_file)
 
         t_file = f"{self.data_source}_{self.asn_org_table}.csv"
         asn_org_file = self.out_dir / self.asn_org_table / t_file
-        self.save_csv(self.asn_org_list, self.asn_org_header, asn_org_file)
+        self.asn_org_list.write_csv(asn_org_file)
 
     def read_links_file(self, f_name):
         print(f"\tReading {f_name}")
-        link_list = []
-        with open(f_name, 'r') as f:
-            link_list = json.load(f)
-
-        for row in link_list:
+        # the links of the graph are kept in arrays rather than one list per link
+        self.graph_asn1 = array('q')
+        self.graph_asn2 = array('q')
+        self.graph_codes = array('b')
+        for row in Stream_JSON.iter_items(f_name):
             node = row['node']
             rel = node['relationship']
             asn1 = int(node['asn0']['asn'])
             asn2 = int(node['asn1']['asn'])
             new_row = [rel, asn1, asn2, self.data_source, self.asof_date]
             self.asn_conn_list.append(new_row)
+            code = Index_ASGraph.relationship_code(rel)
+            if code is not None:
+                self.graph_asn1.append(asn1)
+                self.graph_asn2.append(asn2)
+                self.graph_codes.append(code)
+
+    def save_as_graph(self):
+        graph_dir = self.as_graph_dir / f"{self.data_source}_{self.asof_date}"
+        print(f"\tSaving the AS graph to {graph_dir}.")
+        meta = {"SOURCE":self.data_source, "ASOF_DATE":self.asof_date}
+        Index_ASGraph.compile_as_graph(self.graph_asn1, self.graph_asn2, self.graph_codes, graph_dir, meta)
 
     def read_orgs_file(self, f_name):
         print(f"\tReading {f_name}")
-        orgs_list = []
-        with open(f_name, 'r') as f:
-            orgs_list = json.load(f)
-        for o in orgs_list:
+        for o in Stream_JSON.iter_items(f_name):
             org_id = o["node"]["orgId"]
             org_name = o["node"]["orgName"].replace("'", "''")
             self.org_map[org_id] = org_name
@@ -117,10 +130,7 @@ class ProcessingASRank:
         read in the organization names from another source (ORGS file).
         """
         print(f"\tReading {f_name}")
-        asn_list = []
-        with open(f_name, 'r') as f:
-            asn_list = json.load(f)
-        for a in asn_list:
+        for a in Stream_JSON.iter_items(f_name):
             asn = a["node"]["asn"]
             asn_name = a["node"]["asnName"].replace("'", "''")
             if a["node"]["organization"]:
@@ -135,14 +145,6 @@ class ProcessingASRank:
                 new_row = [asn, org_name, self.data_source, self.asof_date]
                 self.asn_org_list.append(new_row)
 
-    def save_csv(self, data, header, f_name):
-        print(f"\tSaving to {f_name}.")
-        with open(f_name, 'w') as f:
-            csv_writer = csv.writer(f, delimiter=',')
-            csv_writer.writerow(header)
-            for d in data:
-                csv_writer.writerow(d)
-
 if __name__ == "__main__":
     print("This script should not be run by itself. Run it through iGDB.py")
     input_dir = Path("../unprocessed/ASRank")
@@ -1,10 +1,10 @@
 from pathlib import Path
 import os
 import json
-import csv
 from datetime import date
 from datetime import timedelta
 import dbStructure
+import Buffer_Rows
 
 class ProcessingEuroIX:
     def __init__(self, in_dir, out_dir):
@@ -21,10 +21,10 @@ class ProcessingEuroIX:
         self.ixp_map = {}
 
         # setup for asn_asname table
-        self.asn_asname_list = []
         name, fields = self.read_fields(dbStructure.sql_create_asn_asname_table)
         self.asn_asname_header = fields
         self.asn_asname_table = name 
+        self.asn_asname_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_asn_asname_table, dedup=True, spill_dir=self.out_dir / name)
 
         if not os.path.isdir(self.out_dir / self.asn_asname_table):
             os.makedirs(self.out_dir / self.asn_asname_table)
@@ -54,9 +54,10 @@ class ProcessingEuroIX:
             self.read_ixps_file(self.in_dir / folder / self.ixps_file)
             self.read_asns_file(self.in_dir / folder / self.asns_file)
 
+        self.asn_asname_list.report()
         t_file = f"{self.data_source}_{self.asn_asname_table}.csv"
         asn_asname_file = self.out_dir / self.asn_asname_table / t_file
-        self.save_csv(self.asn_asname_list, self.asn_asname_header, asn_asname_file)
+        self.asn_asname_list.write_csv(asn_asname_file)
 
     def read_ixps_file(self, f_name):
         print(f"\tReading {f_name}")
@@ -138,17 +139,7 @@ class ProcessingEuroIX:
             else:
                 ixp_sw = ''
             new_row = [asn, asn_name, self.data_source, self.asof_date]
-            if not new_row in self.asn_asname_list:
-                self.asn_asname_list.append(new_row)
-
-    def save_csv(self, data, header, f_name):
-        print(f"\tSaving to {f_name}.")
-        with open(f_name, 'w') as f:
-            csv_writer = csv.writer(f, delimiter=',')
-            csv_writer.writerow(header)
-            for d in data:
-                csv_writer.writerow(d)
-
+            self.asn_asname_list.append(new_row)
 
 if __name__ == "__main__":
     print("This script should not be run by itself. Run it through iGDB.py")
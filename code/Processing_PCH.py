@@ -1,11 +1,11 @@
 import os
 from pathlib import Path
-import json
-import csv
 from datetime import date
 from datetime import timedelta
 import Standardize_Locations
 import dbStructure
+import Buffer_Rows
+import Stream_JSON
 
 class ProcessingPCH:
     """
@@ -22,21 +22,21 @@ class ProcessingPCH:
         self.out_dir = out_dir
         self.ixp_loc_dict = {}
         self.asn_loc_dict = {}
-        self.asn_loc_list = []
         self.physical_presence = False
         name, fields = self.read_fields(dbStructure.sql_create_asn_loc_table)
         self.asn_loc_header = fields
         self.asn_loc_table = name 
+        self.asn_loc_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_asn_loc_table, dedup=True, spill_dir=self.out_dir / name)
 
-        self.asn_org_list = []
         name, fields = self.read_fields(dbStructure.sql_create_asn_org_table)
+        self.asn_org_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_asn_org_table, spill_dir=self.out_dir / name)
         self.asn_org_header = fields
         self.asn_org_table = name
 
-        self.ip_asn_list = []
         name, fields = self.read_fields(dbStructure.sql_create_ip_asn_dns_table)
         self.ip_asn_header = fields
         self.ip_asn_table = name
+        self.ip_asn_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_ip_asn_dns_table, dedup=True, spill_dir=self.out_dir / name)
 
         self.data_source = "PCH"
         voronoi_dir = Path("../helper_data/cities_Voronoi")
@@ -69,21 +69,22 @@ class ProcessingPCH:
         return table_name, table_fields
 
     def run_steps(self):
-        print("Processing local data from Packet Clearinghouse. ", end='')
+        print("Processing local data from Packet Clearinghouse.")
         if not os.path.isdir(self.in_dir):
-            print("\n\tThere is no data to process. Update the PCH data before continuing.")
+            print("\tThere is no data to process. Update the PCH data before continuing.")
             return
-        print("This takes a while. Status reported every 100 IXPs.")
         self.read_ixp_file(self.in_dir / "pch_active_ixp.json")
         self.read_subnets_file(self.in_dir / "pch_subnets.json")
+        self.asn_loc_list.report()
+        self.ip_asn_list.report()
         asn_loc_file = self.out_dir / self.asn_loc_table / f"{self.data_source}_{self.asn_loc_table}.csv"
-        self.save_csv(self.asn_loc_list, self.asn_loc_header, asn_loc_file)
+        self.asn_loc_list.write_csv(asn_loc_file)
 
         ip_asn_file = self.out_dir / self.ip_asn_table / f"{self.data_source}_{self.ip_asn_table}.csv"
-        self.save_csv(self.ip_asn_list, self.ip_asn_header, ip_asn_file)
+        self.ip_asn_list.write_csv(ip_asn_file)
 
         asn_org_file = self.out_dir / self.asn_org_table / f"{self.data_source}_{self.asn_org_table}.csv"
-        self.save_csv(self.asn_org_list, self.asn_org_header, asn_org_file)
+        self.asn_org_list.write_csv(asn_org_file)
 
     def find_nearest_input_folder(self, start_dir):
         today = date.today()
@@ -113,11 +114,13 @@ class ProcessingPCH:
                 continue
 
     def read_ixp_file(self, ixp_file):
-        ixp_list = self.read_json(ixp_file)
-        for i, ixp in enumerate(ixp_list):
-            if (i+1) % 100 == 0:
-                print(f"\tWorking on IXP {i+1} of {len(ixp_list)}.")
+        std_ids = []
+        std_lats = []
+        std_lons = []
+        ixp_ids = []
+        for ixp in Stream_JSON.iter_items(ixp_file):
             ixp_id = ixp['id']
+            ixp_ids.append(ixp_id)
             city = ixp['cit']
             country = ixp['ctry']
             ixp_name = ixp['name']
@@ -135,9 +138,20 @@ class ProcessingPCH:
             self.ixp_loc_dict[ixp_id]["IXP_NAME"] = ixp_name
             self.ixp_loc_dict[ixp_id]["LATITUDE"] = lat
             self.ixp_loc_dict[ixp_id]["LONGITUDE"] = lon
-
             if lat and lon:
-                std_loc = self.loc_standardizer.standardize([lat, lon])
+                std_ids.append(ixp_id)
+                std_lats.append(lat)
+                std_lons.append(lon)
+
+        ### all of the IXPs are standardized in one pass
+        std_locs = {}
+        results = self.loc_standardizer.standardize_many(std_lats, std_lons)
+        for i, ixp_id in enumerate(std_ids):
+            std_locs[ixp_id] = self.loc_standardizer.result_dict(results, i)
+
+        for ixp_id in ixp_ids:
+            std_loc = std_locs.get(ixp_id, {})
+            if std_loc:
                 self.ixp_loc_dict[ixp_id]["STD_LATITUDE"] = std_loc["LATITUDE"]
                 self.ixp_loc_dict[ixp_id]["STD_LONGITUDE"] = std_loc["LONGITUDE"]
                 self.ixp_loc_dict[ixp_id]["STD_CITY"] = std_loc["CITY"].replace("'", "''")
@@ -155,16 +169,16 @@ class ProcessingPCH:
 
     def read_subnets_file(self, subnets_file):
         validated_status = ''
-        subnets_dict = self.read_json(subnets_file)
         asn_org_dict = {}
-        for ixp_id in subnets_dict.keys():
-            if isinstance(subnets_dict[ixp_id], list):
+        # the subnets of one IXP at a time
+        for ixp_id, ixp_subnets in Stream_JSON.iter_members(subnets_file):
+            if isinstance(ixp_subnets, list):
                 continue
             for ip_ver in ['IPv4', 'IPv6']:
-                if ip_ver in subnets_dict[ixp_id].keys():
-                    for ip_range in subnets_dict[ixp_id][ip_ver].keys():
-                        for ip in subnets_dict[ixp_id][ip_ver][ip_range].keys():
-                            ip_dict = subnets_dict[ixp_id][ip_ver][ip_range][ip]
+                if ip_ver in ixp_subnets.keys():
+                    for ip_range in ixp_subnets[ip_ver].keys():
+                        for ip in ixp_subnets[ip_ver][ip_range].keys():
+                            ip_dict = ixp_subnets[ip_ver][ip_range][ip]
                             asn = ip_dict['asn']
                             org_name = ip_dict['org'].replace("'", "''")
                             ip_addr = ip_dict['ip']
@@ -194,32 +208,16 @@ class ProcessingPCH:
                                     std_city, std_state, std_country,
                                     self.physical_presence, self.asof_date)
                             if lat and lon:
-                                if not loc_row in self.asn_loc_list:
-                                    self.asn_loc_list.append(loc_row)
+                                self.asn_loc_list.append(loc_row)
                             ip_row = (ip_addr, rdns, asn, std_city, std_state,
                                     std_country, self.data_source, self.asof_date)
                             if lat and lon:
-                                if not ip_row in self.ip_asn_list:
-                                    self.ip_asn_list.append(ip_row)
+                                self.ip_asn_list.append(ip_row)
 
         for asn in asn_org_dict.keys():
             row = [asn, asn_org_dict[asn], self.data_source, self.asof_date]
             self.asn_org_list.append(row)
 
-    def read_json(self, f_name):
-        data = {}
-        with open(f_name, 'r') as f:
-            data = json.load(f)
-        return data
-
-
-    def save_csv(self, data, header, f_name):
-        print(f"\tSaving to {f_name}.")
-        with open(f_name, 'w') as f:
-            csv_writer = csv.writer(f, delimiter=',')
-            csv_writer.writerow(header)
-            for d in data:
-                csv_writer.writerow(d)
 
 if __name__ == "__main__":
     print("This script should not be run by itself. Run it through iGDB.py")
@@ -1,9 +1,9 @@
 import os
 from pathlib import Path
-import json
-import csv
 import Standardize_Locations
 import dbStructure
+import Buffer_Rows
+import Stream_JSON
 
 class ProcessingPDB:
     """
@@ -14,25 +14,25 @@ class ProcessingPDB:
         self.in_dir = in_dir
         self.asof_date = ''
         self.out_dir = out_dir
-        self.pdb_dict = {}
+        self.pdb_file = ''
         self.fac_loc_dict = {}
-        self.asn_loc_list = []
         name, fields = self.read_fields(dbStructure.sql_create_asn_loc_table)
         self.asn_loc_header = fields
         self.asn_loc_table = name 
+        self.asn_loc_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_asn_loc_table, dedup=True, spill_dir=self.out_dir / name)
 
-        self.asn_org_list = []
         name, fields = self.read_fields(dbStructure.sql_create_asn_org_table)
+        self.asn_org_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_asn_org_table, spill_dir=self.out_dir / name)
         self.asn_org_header = fields
         self.asn_org_table = name
 
-        self.asn_asname_list = []
         name, fields = self.read_fields(dbStructure.sql_create_asn_asname_table)
+        self.asn_asname_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_asn_asname_table, spill_dir=self.out_dir / name)
         self.asn_asname_header = fields
         self.asn_asname_table = name
 
-        self.phys_nodes_list = []
         name, fields = self.read_fields(dbStructure.sql_create_nodes_table)
+        self.phys_nodes_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_nodes_table, spill_dir=self.out_dir / name)
         self.phys_nodes_header = fields
         self.phys_nodes_table = name
 
@@ -76,6 +76,9 @@ class ProcessingPDB:
             return
         all_dumps = []
         for f in os.listdir(self.in_dir):
+            # the crawler's journal and unfinished downloads start with a dot
+            if f.startswith('.'):
+                continue
             if 'json' in f:
                 all_dumps.append(f)
 
@@ -84,37 +87,61 @@ class ProcessingPDB:
             month = d.split('_')[4]
             day = d.split('_')[5].replace('.json', '')
             self.asof_date = f"{year}-{month}-{day}"
-            self.pdb_dict = self.read_json(self.in_dir / d)
-            self.process_asn_orgs()
-            self.process_asn_locs()
+            self.pdb_file = self.in_dir / d
+            sections = self.read_sections()
+            self.process_asn_orgs(sections)
+            self.process_asn_locs(sections)
 
         asn_org_file = self.out_dir / self.asn_org_table / f"{self.data_source}_{self.asn_org_table}.csv"
-        self.save_csv(self.asn_org_list, self.asn_org_header, asn_org_file)
+        self.asn_org_list.write_csv(asn_org_file)
 
+        self.asn_loc_list.report()
         asn_loc_file = self.out_dir / self.asn_loc_table / f"{self.data_source}_{self.asn_loc_table}.csv"
-        self.save_csv(self.asn_loc_list, self.asn_loc_header, asn_loc_file)
+        self.asn_loc_list.write_csv(asn_loc_file)
 
         t_name = f"{self.data_source}_{self.asn_asname_table}.csv"
         asn_asname_file = self.out_dir / self.asn_asname_table / t_name
-        self.save_csv(self.asn_asname_list, self.asn_asname_header, asn_asname_file)
+        self.asn_asname_list.write_csv(asn_asname_file)
 
         t_name = f"{self.data_source}_{self.phys_nodes_table}.csv"
         phys_nodes_file = self.out_dir / self.phys_nodes_table / t_name
-        self.save_csv(self.phys_nodes_list, self.phys_nodes_header, phys_nodes_file)
+        self.phys_nodes_list.write_csv(phys_nodes_file)
+
+    def read_sections(self):
+        """Reads the sections of the PeeringDB dump that are used, in one pass over the file.
+        Only the fields that are used are kept from each record,
+        so the whole dump is never held in memory or read more than once."""
+        print(f"\tReading {self.pdb_file}.")
+        sections = {"as_set":{}, "net":[], "fac":[], "netfac":[], "ixfac":[], "netixlan":[]}
+        for section, item in Stream_JSON.iter_sections(self.pdb_file, sections):
+            if section == 'as_set':
+                # the ASN names are the members of the first item
+                if not sections['as_set']:
+                    sections['as_set'] = item
+            elif section == 'net':
+                sections['net'].append((item['asn'], item['name'], item['aka']))
+            elif section == 'fac':
+                sections['fac'].append((item['id'], item['latitude'], item['longitude'],
+                        item['org_name'], item['name']))
+            elif section == 'netfac':
+                sections['netfac'].append((item['local_asn'], item['fac_id']))
+            elif section == 'ixfac':
+                sections['ixfac'].append((item['ix_id'], item['fac_id']))
+            elif section == 'netixlan':
+                sections['netixlan'].append((item['asn'], item['ix_id']))
+        return sections
 
-    def process_asn_orgs(self):
+    def process_asn_orgs(self, sections):
         print("\tWorking on the PeeringDB ASN to organization map.")
         asn_org_dict = {}
-        for i, asn in enumerate(self.pdb_dict['as_set']['data'][0]):
+        for asn, asn_name in sections['as_set'].items():
             asn_i = int(asn)
             asn_org_dict[asn_i] = {}
-            asn_org_dict[asn_i]["ASN_NAME"] = self.pdb_dict['as_set']['data'][0][asn]
+            asn_org_dict[asn_i]["ASN_NAME"] = asn_name
             asn_org_dict[asn_i]["ORGANIZATION_NAME"] = 'NULL'
             asn_org_dict[asn_i]["ORGANIZATION_AKA"] = 'NULL'
-        for i, net in enumerate(self.pdb_dict['net']['data']):
-            asn = int(net['asn'])
-            org_name = net['name']
-            org_aka = net['aka']
+        for asn, org_name, org_aka in sections['net']:
+            asn = int(asn)
             if not asn in asn_org_dict.keys():
                 asn_org_dict[asn] = {}
                 asn_org_dict[asn]["ASN_NAME"] = 'NULL'
@@ -158,31 +185,41 @@ class ProcessingPDB:
                 results.append(e)
         return results
 
-    def process_asn_locs(self):
+    def process_asn_locs(self, sections):
         validated = ''
-        print("\tWorking on the PeeringDB facilities. ", end='')
-        print("This takes a while. Status reported every 100 facilities.")
-        for i, fac in enumerate(self.pdb_dict['fac']['data']):
-            if (i+1) % 100 == 0:
-                print(f"\tWorking on facility {i+1} of {len(self.pdb_dict['fac']['data'])}.")
-            fac_id = fac['id']
-            if fac['latitude']:
-                lat = round(float(fac['latitude']), 4)
+        print("\tWorking on the PeeringDB facilities.")
+        std_ids = []
+        std_lats = []
+        std_lons = []
+        fac_ids = []
+        for fac_id, fac_lat, fac_lon, fac_org, fac_name in sections['fac']:
+            fac_ids.append(fac_id)
+            if fac_lat:
+                lat = round(float(fac_lat), 4)
             else:
                 lat = 'NULL'
-            if fac['longitude']:
-                lon = round(float(fac['longitude']), 4)
+            if fac_lon:
+                lon = round(float(fac_lon), 4)
             else:
                 lon = 'NULL'
             self.fac_loc_dict[fac_id] = {}
             self.fac_loc_dict[fac_id]["LATITUDE"] = lat
             self.fac_loc_dict[fac_id]["LONGITUDE"] = lon
-            self.fac_loc_dict[fac_id]["ORGANIZATION"] = fac['org_name'].replace("'", "''")
-            self.fac_loc_dict[fac_id]["NODE_NAME"] = fac['name'].replace("'", "''")
-
-            std_loc = {}
+            self.fac_loc_dict[fac_id]["ORGANIZATION"] = fac_org.replace("'", "''")
+            self.fac_loc_dict[fac_id]["NODE_NAME"] = fac_name.replace("'", "''")
             if (not lat == 'NULL') and (not lon == 'NULL'):
-                std_loc = self.loc_standardizer.standardize([lat, lon])
+                std_ids.append(fac_id)
+                std_lats.append(lat)
+                std_lons.append(lon)
+
+        ### all of the facilities are standardized in one pass
+        std_locs = {}
+        results = self.loc_standardizer.standardize_many(std_lats, std_lons)
+        for i, fac_id in enumerate(std_ids):
+            std_locs[fac_id] = self.loc_standardizer.result_dict(results, i)
+
+        for fac_id in fac_ids:
+            std_loc = std_locs.get(fac_id, {})
             if std_loc:
                 self.fac_loc_dict[fac_id]["STD_LATITUDE"] = std_loc["LATITUDE"]
                 self.fac_loc_dict[fac_id]["STD_LONGITUDE"] = std_loc["LONGITUDE"]
@@ -210,9 +247,7 @@ class ProcessingPDB:
             self.phys_nodes_list.append(phys_row)
 
         print("\tWorking on the PeeringDB networks.")
-        for net in self.pdb_dict['netfac']['data']:
-            asn = net['local_asn']
-            fac_id = net['fac_id']
+        for asn, fac_id in sections['netfac']:
             lat = self.fac_loc_dict[fac_id]["LATITUDE"]
             lon = self.fac_loc_dict[fac_id]["LONGITUDE"]
             std_lat = self.fac_loc_dict[fac_id]["STD_LATITUDE"]
@@ -226,16 +261,14 @@ class ProcessingPDB:
                     std_lat, std_lon, std_city, std_state, std_country,
                     physical_presence, self.asof_date]
             if lat and lon:
-                if not new_row in self.asn_loc_list:
-                    self.asn_loc_list.append(new_row)
+                self.asn_loc_list.append(new_row)
         print('\tWorking on the PeeringDB virtual presence')
         mapping_ixp_pop = {}
-        for ixfac in self.pdb_dict['ixfac']['data']:
-            mapping_ixp_pop[ixfac['ix_id']] = ixfac['fac_id']
-        for net in self.pdb_dict['netixlan']['data']:
-            asn = net['asn']
-            if net['ix_id'] in mapping_ixp_pop:
-                fac_id = mapping_ixp_pop[net['ix_id']]
+        for ix_id, fac_id in sections['ixfac']:
+            mapping_ixp_pop[ix_id] = fac_id
+        for asn, ix_id in sections['netixlan']:
+            if ix_id in mapping_ixp_pop:
+                fac_id = mapping_ixp_pop[ix_id]
                 lat = self.fac_loc_dict[fac_id]["LATITUDE"]
                 lon = self.fac_loc_dict[fac_id]["LONGITUDE"]
                 std_lat = self.fac_loc_dict[fac_id]["STD_LATITUDE"]
@@ -249,22 +282,7 @@ class ProcessingPDB:
                            std_lat, std_lon, std_city, std_state, std_country,
                            physical_presence, self.asof_date]
                 if lat and lon:
-                    if not new_row in self.asn_loc_list:
-                        self.asn_loc_list.append(new_row)
-
-    def read_json(self, f_name):
-        data = {}
-        with open(f_name, 'r') as f:
-            data = json.load(f)
-        return data
-
-    def save_csv(self, data, header, f_name):
-        print(f"\tSaving to {f_name}.")
-        with open(f_name, 'w') as f:
-            csv_writer = csv.writer(f, delimiter=',')
-            csv_writer.writerow(header)
-            for d in data:
-                csv_writer.writerow(d)
+                    self.asn_loc_list.append(new_row)
 
 if __name__ == "__main__":
     print("This script should not be run by itself. Run it through iGDB.py")
@@ -1,11 +1,12 @@
 from pathlib import Path
 import os
 import json
-import csv
 from datetime import date
 from datetime import timedelta
 import Standardize_Locations
 import dbStructure
+import Buffer_Rows
+import Track_Partitions
 
 class ProcessingRIPEAtlas:
     def __init__(self, in_dir, out_dir):
@@ -15,11 +16,11 @@ class ProcessingRIPEAtlas:
             print(f"{in_dir} does not exist.")
             return
         self.out_dir =  out_dir
-        self.asn_loc_list = []
         self.physical_presence = False
         name, fields = self.read_fields(dbStructure.sql_create_asn_loc_table)
         self.asn_loc_header = fields
         self.asn_loc_table = name 
+        self.asn_loc_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_asn_loc_table, dedup=True, spill_dir=self.out_dir / name)
 
         self.data_source = "RIPEAtlas"
         voronoi_dir = Path("../helper_data/cities_Voronoi")
@@ -51,27 +52,38 @@ class ProcessingRIPEAtlas:
             print("\n\tThere is no data to process. Update the RIPE Atlas data before continuing.")
             return
         print("\tThis takes a while. Status reported every 10 files.")
-        for d in os.listdir(self.in_dir):
+        out_path = self.out_dir / self.asn_loc_table
+        manifest = Track_Partitions.PartitionManifest(self.out_dir / "manifests" / f"{self.data_source}_{self.asn_loc_table}.json")
+        Track_Partitions.remove_legacy_file(out_path / f"{self.data_source}_{self.asn_loc_table}.csv")
+        folders = manifest.pending(self.in_dir, out_path)
+        print(f"\t{len(folders)} new or changed days to process.")
+        for d in folders:
             year = d.split('_')[0]
             month = d.split('_')[1]
             day = d.split('_')[2]
             self.asof_date = f"{year}-{month}-{day}"
+            # each day is saved to its own partition
+            self.asn_loc_list = Buffer_Rows.ColumnarBuffer(dbStructure.sql_create_asn_loc_table, dedup=True, spill_dir=out_path)
 
-            for i, f in enumerate(os.listdir(self.in_dir / d)):
+            day_files = os.listdir(self.in_dir / d)
+            for i, f in enumerate(day_files):
                 if (i+1) % 10 == 0:
-                    print(f"\tWorking on file {i+1} of {len(os.listdir(self.in_dir / d))}.")
+                    print(f"\tWorking on file {i+1} of {len(day_files)}.")
                 if 'anchor' in f:
                     self.read_anchor_file(self.in_dir / d / f)
                 elif 'probes' in f:
                     self.read_probe_file(self.in_dir / d / f)
 
-        asn_loc_file = self.out_dir / self.asn_loc_table / f"{self.data_source}_{self.asn_loc_table}.csv"
-        self.save_csv(self.asn_loc_list, self.asn_loc_header, asn_loc_file)
+            self.asn_loc_list.report()
+            manifest.remove_outputs(d, out_path)
+            asn_loc_file = f"{self.data_source}_{self.asof_date}.csv"
+            self.asn_loc_list.write_csv(out_path / asn_loc_file)
+            manifest.record(self.in_dir, d, [asn_loc_file])
 
     def read_anchor_file(self, f_name):
-        validated = ''
         with open(f_name, 'r') as f:
             raw_data = json.load(f)
+        located = []
         if 'results' in raw_data.keys():
             for r in raw_data['results']:
                 try:
@@ -84,35 +96,13 @@ class ProcessingRIPEAtlas:
                     continue
                 if not as_v4:
                     continue
-                std_loc = {}
-                std_loc = self.loc_standardizer.standardize([lat, lon])
-                if std_loc:
-                    std_lat = std_loc["LATITUDE"]
-                    std_lon = std_loc["LONGITUDE"]
-                    std_city = std_loc["CITY"].replace("'", "''")
-                    try:
-                        std_state = std_loc["STATE"].replace("'", "''")
-                    except:
-                        std_state = None
-                    std_country = std_loc["COUNTRY"]
-                else:
-                    std_lat = 'NULL'
-                    std_lon = 'NULL'
-                    std_city = 'NULL'
-                    std_state = 'NULL'
-                    std_country = 'NULL'
-
-                new_row = [as_v4, lat, lon, self.data_source, validated,
-                        std_lat, std_lon, std_city, std_state, std_country,
-                        self.physical_presence, self.asof_date]
-                #if not new_row in self.city_asn_list:
-                if not new_row in self.asn_loc_list:
-                    self.asn_loc_list.append(new_row)
+                located.append([as_v4, lat, lon])
+        self.add_asn_locs(located)
 
     def read_probe_file(self, f_name):
-        validated = ''
         with open(f_name, 'r') as f:
             raw_data = json.load(f)
+        located = []
         if 'results' in raw_data.keys():
             for r in raw_data['results']:
                 try:
@@ -126,37 +116,41 @@ class ProcessingRIPEAtlas:
                 if not as_v4:
                     continue
                 if status == 'Connected':
-                    std_loc = {}
-                    if lat and lon:
-                        std_loc = self.loc_standardizer.standardize([lat, lon])
-                    if std_loc:
-                        std_lat = std_loc["LATITUDE"]
-                        std_lon = std_loc["LONGITUDE"]
-                        std_city = std_loc["CITY"].replace("'", "''")
-                        try:
-                            std_state = std_loc["STATE"].replace("'", "''")
-                        except:
-                            std_state = None
-                        std_country = std_loc["COUNTRY"]
-                    else:
-                        std_lat = 'NULL'
-                        std_lon = 'NULL'
-                        std_city = 'NULL'
-                        std_state = 'NULL'
-                        std_country = 'NULL'
-                    new_row = [as_v4, lat, lon, self.data_source, validated,
-                            std_lat, std_lon, std_city, std_state, std_country,
-                            self.physical_presence, self.asof_date]
-                    if not new_row in self.asn_loc_list:
-                        self.asn_loc_list.append(new_row)
+                    located.append([as_v4, lat, lon])
+        self.add_asn_locs(located)
 
-    def save_csv(self, data, header, f_name):
-        print(f"\tSaving to {f_name}.")
-        with open(f_name, 'w') as f:
-            csv_writer = csv.writer(f, delimiter=',')
-            csv_writer.writerow(header)
-            for d in data:
-                csv_writer.writerow(d)
+    def add_asn_locs(self, located):
+        """Standardizes the [asn, lat, lon] entries of one file in a single pass
+        and adds the new asn_loc rows."""
+        validated = ''
+        std_idx = [i for i, (as_v4, lat, lon) in enumerate(located) if lat and lon]
+        results = self.loc_standardizer.standardize_many([located[i][1] for i in std_idx],
+                [located[i][2] for i in std_idx])
+        std_locs = {}
+        for j, i in enumerate(std_idx):
+            std_locs[i] = self.loc_standardizer.result_dict(results, j)
+
+        for i, (as_v4, lat, lon) in enumerate(located):
+            std_loc = std_locs.get(i, {})
+            if std_loc:
+                std_lat = std_loc["LATITUDE"]
+                std_lon = std_loc["LONGITUDE"]
+                std_city = std_loc["CITY"].replace("'", "''")
+                try:
+                    std_state = std_loc["STATE"].replace("'", "''")
+                except:
+                    std_state = None
+                std_country = std_loc["COUNTRY"]
+            else:
+                std_lat = 'NULL'
+                std_lon = 'NULL'
+                std_city = 'NULL'
+                std_state = 'NULL'
+                std_country = 'NULL'
+            new_row = [as_v4, lat, lon, self.data_source, validated,
+                    std_lat, std_lon, std_city, std_state, std_country,
+                    self.physical_presence, self.asof_date]
+            self.asn_loc_list.append(new_row)
 
 if __name__ == "__main__":
     print("This script should not be run by itself. Run it through iGDB.py")
@@ -1,23 +1,46 @@
 from pathlib import Path
 import os
-import json
 import csv
 from datetime import date
 from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import dbStructure
+import Stream_JSON
+import Buffer_Rows
+import Track_Partitions
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
 
 class ProcessingRIPETraceroutes:
-    def __init__(self, in_dir, out_dir):
+    """
+        This class processes the RIPE Atlas traceroute results.
+        Each day is saved to its own partition, and only the days that are
+        new or changed since the last run are processed again.
+        The result files of a day are split into shards, and each shard is parsed
+        by its own worker process straight into its own output file,
+        either csv or parquet (if pyarrow is installed).
+    """
+    def __init__(self, in_dir, out_dir, jobs=1, out_format="csv"):
         self.in_dir = in_dir
         self.asof_date = ''
+        self.jobs = jobs
+        self.out_format = out_format
+        if self.out_format == "parquet" and pq is None:
+            print("pyarrow is not installed. Saving the traceroutes as csv instead of parquet.")
+            self.out_format = "csv"
         if not os.path.isdir(in_dir):
             print(f"{in_dir} does not exist.")
             return
         self.out_dir =  out_dir
-        self.traceroutes_list = []
         name, fields = self.read_fields(dbStructure.sql_create_traceroutes_table)
         self.traceroutes_header = fields
-        self.traceroutes_table = name 
+        self.traceroutes_table = name
+        self.traceroutes_types = Buffer_Rows.read_field_types(dbStructure.sql_create_traceroutes_table)
 
         self.data_source = "RIPEAtlas"
 
@@ -39,62 +62,189 @@ class ProcessingRIPETraceroutes:
         return table_name, table_fields
 
     def run_steps(self):
-        print("Processing local RIPE Atlas traceroute data. ", end='')
+        print("Processing local RIPE Atlas traceroute data.")
         if not os.path.isdir(self.in_dir):
-            print("\n\tThere is no data to process. Update the RIPE Atlas traceroute data.")
+            print("\tThere is no data to process. Update the RIPE Atlas traceroute data.")
             return
-        print("This takes a while. Status reported every 25 files.")
-        for d in os.listdir(self.in_dir):
-            year = d.split('_')[0]
-            month = d.split('_')[1]
-            day = d.split('_')[2]
-            self.asof_date = f"{year}-{month}-{day}"
-
-            for i, f in enumerate(os.listdir(self.in_dir / d)):
-                if (i+1) % 25 == 0:
-                    print(f"\tWorking on file {i+1} of {len(os.listdir(self.in_dir / d))}.")
-                if 'measurement_id' in f:
-                    continue
-                elif 'traceroute_results' in f:
-                    self.read_traceroute_file(self.in_dir / d / f)
+        out_path = self.out_dir / self.traceroutes_table
+        manifest = Track_Partitions.PartitionManifest(self.out_dir / "manifests" / f"{self.data_source}_{self.traceroutes_table}.json",
+                self.out_format)
+        for f in os.listdir(out_path):
+            # the combined files from before the partitions existed
+            if f.startswith(f"{self.data_source}_{self.traceroutes_table}"):
+                Track_Partitions.remove_legacy_file(out_path / f)
+        folders = manifest.pending(self.in_dir, out_path)
+
+        # every shard of every new day is a separate unit of work
+        work = []
+        day_outputs = {}
+        for d in folders:
+            asof_date = self.folder_date(d)
+            tasks = self.find_traceroute_files(d, asof_date)
+            shards = self.split_shards(tasks, self.jobs)
+            day_outputs[d] = []
+            for i, shard in enumerate(shards):
+                if len(shards) == 1:
+                    t_file = f"{self.data_source}_{asof_date}.{self.out_format}"
+                else:
+                    t_file = f"{self.data_source}_{asof_date}_{i}.{self.out_format}"
+                day_outputs[d].append(t_file)
+                work.append((d, shard, out_path / t_file))
+            manifest.remove_outputs(d, out_path)
+            self.remove_day_files(out_path, asof_date)
+
+        print(f"\tParsing {len(folders)} new or changed days in {len(work)} shards. Status reported every 25 files.")
+        remaining = {d:len(day_outputs[d]) for d in folders}
+        num_rows = 0
+        for d in folders:
+            if remaining[d] == 0:
+                # a day without any traceroute results
+                manifest.record(self.in_dir, d, [])
+        if self.jobs <= 1:
+            for d, shard, out_file in work:
+                num_rows += process_traceroute_shard(shard, out_file, self.traceroutes_header,
+                    self.traceroutes_types, self.data_source, self.out_format)
+                remaining[d] -= 1
+                if remaining[d] == 0:
+                    manifest.record(self.in_dir, d, day_outputs[d])
+        else:
+            with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                futures = {}
+                for d, shard, out_file in work:
+                    futures[pool.submit(process_traceroute_shard, shard, out_file,
+                        self.traceroutes_header, self.traceroutes_types, self.data_source, self.out_format)] = d
+                # a day is recorded as soon as all of its shards are saved
+                for future in as_completed(futures):
+                    d = futures[future]
+                    num_rows += future.result()
+                    remaining[d] -= 1
+                    if remaining[d] == 0:
+                        manifest.record(self.in_dir, d, day_outputs[d])
+        print(f"\tSaved {num_rows} traceroute hops.")
+
+    def remove_day_files(self, out_path, asof_date):
+        """Removes every partition of the day, in any format and with any number of shards,
+        including the ones the manifest does not know about, e.g. from a run that stopped
+        before the day was recorded, so no row is loaded twice."""
+        day_files = set(out_path.glob(f"{self.data_source}_{asof_date}.*"))
+        day_files |= set(out_path.glob(f"{self.data_source}_{asof_date}_*.*"))
+        for f in sorted(day_files):
+            print(f"\tRemoving {f.name}, the day is processed again.")
+            os.remove(f)
 
-        trace_file = self.out_dir / self.traceroutes_table / f"{self.data_source}_{self.traceroutes_table}.csv"
-        self.save_csv(self.traceroutes_list, self.traceroutes_header, trace_file)
+    def folder_date(self, d):
+        year = d.split('_')[0]
+        month = d.split('_')[1]
+        day = d.split('_')[2]
+        return f"{year}-{month}-{day}"
 
-    def read_traceroute_file(self, f_name):
-        #print(f"Reading: {f_name}")
-        with open(f_name, 'r') as f:
-            tr_dict = json.load(f)
-        for m in tr_dict:
+    def find_traceroute_files(self, d, asof_date):
+        """Returns (file, asof_date) for every traceroute result file in the folder of one day."""
+        tasks = []
+        for f in sorted(os.listdir(self.in_dir / d)):
+            if 'measurement_id' in f or f.startswith('.'):
+                continue
+            elif 'traceroute_results' in f:
+                tasks.append((self.in_dir / d / f, asof_date))
+        return tasks
+
+    def split_shards(self, tasks, num_shards):
+        """Spreads the files over the shards so each one has about the same number of bytes.
+        The largest files are placed first, each in the shard with the fewest bytes so far."""
+        num_shards = max(1, min(num_shards, len(tasks)))
+        shards = [[] for i in range(num_shards)]
+        shard_bytes = [0] * num_shards
+        for task in sorted(tasks, key=lambda t: os.path.getsize(t[0]), reverse=True):
+            i = shard_bytes.index(min(shard_bytes))
+            shards[i].append(task)
+            shard_bytes[i] += os.path.getsize(task[0])
+        return [s for s in shards if s]
+
+def read_traceroute_file(f_name, data_source, asof_date):
+    """Yields one row for every reply of every hop in the file."""
+    for m in Stream_JSON.iter_items(f_name):
+        try:
+            src_ip = m['src_addr']
+            dst_ip = m['dst_addr']
+            timestamp = m['timestamp']
+        except:
+            continue
+        for h in m['result']:
             try:
-                src_ip = m['src_addr']
-                dst_ip = m['dst_addr']
-                timestamp = m['timestamp']
+                hop = h['hop']
             except:
                 continue
-            for h in m['result']:
+            for r in h['result']:
                 try:
-                    hop = h['hop']
+                    hop_ip = r['from']
+                    ttl = r['ttl']
+                    rtt = r['rtt']
                 except:
                     continue
-                for r in h['result']:
-                    try:
-                        hop_ip = r['from']
-                        ttl = r['ttl']
-                        rtt = r['rtt']
-                    except:
-                        continue
-                    new_row = [src_ip, dst_ip, hop_ip, ttl, rtt,
-                            self.data_source, timestamp, self.asof_date]
-                    self.traceroutes_list.append(new_row)
-
-    def save_csv(self, data, header, f_name):
-        print(f"\tSaving to {f_name}.")
-        with open(f_name, 'w') as f:
-            csv_writer = csv.writer(f, delimiter=',')
-            csv_writer.writerow(header)
-            for d in data:
-                csv_writer.writerow(d)
+                yield [src_ip, dst_ip, hop_ip, ttl, rtt,
+                        data_source, timestamp, asof_date]
+
+class CSVRowWriter:
+    def __init__(self, f_name, header):
+        self.f = open(f_name, 'w')
+        self.csv_writer = csv.writer(self.f, delimiter=',')
+        self.csv_writer.writerow(header)
+
+    def write_rows(self, rows):
+        self.csv_writer.writerows(rows)
+
+    def close(self):
+        self.f.close()
+
+class ParquetRowWriter:
+    """Writes the rows in row groups of row_group_size rows,
+    so only one row group is held in memory at a time."""
+    arrow_types = {"text":"string", "date":"string", "integer":"int64", "numeric":"float64"}
+
+    def __init__(self, f_name, header, field_types, row_group_size=500000):
+        self.header = header
+        self.schema = pa.schema([(h, self.arrow_types.get(t, "string"))
+            for h, t in zip(header, field_types)])
+        self.writer = pq.ParquetWriter(f_name, self.schema)
+        self.row_group_size = row_group_size
+        self.rows = []
+
+    def write_rows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = [list(c) for c in zip(*self.rows)]
+        self.writer.write_table(pa.Table.from_arrays(
+            [pa.array(c, type=f.type) for c, f in zip(columns, self.schema)], schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def process_traceroute_shard(tasks, out_file, header, field_types, data_source, out_format):
+    """Runs in a worker process. Parses the (file, asof_date) tasks of one shard
+    into out_file and returns the number of rows written."""
+    print(f"\tSaving to {out_file}.")
+    if out_format == "parquet":
+        writer = ParquetRowWriter(out_file, header, field_types)
+    else:
+        writer = CSVRowWriter(out_file, header)
+    num_rows = 0
+    try:
+        for i, (f_name, asof_date) in enumerate(tasks):
+            if (i+1) % 25 == 0:
+                print(f"\tWorking on file {i+1} of {len(tasks)} for {Path(out_file).name}.")
+            rows = list(read_traceroute_file(f_name, data_source, asof_date))
+            writer.write_rows(rows)
+            num_rows += len(rows)
+    finally:
+        writer.close()
+    return num_rows
 
 if __name__ == "__main__":
     print("This script should not be run by itself. Run it through iGDB.py")
@@ -102,4 +252,3 @@ if __name__ == "__main__":
     output_dir = Path("../processed")
     my_processor = ProcessingRIPETraceroutes(input_dir, output_dir)
     my_processor.run_steps()
-
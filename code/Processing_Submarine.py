@@ -5,6 +5,7 @@ import pandas as pd
 import csv
 import json
 import dbStructure
+import Index_Voronoi
 
 class ProcessingSubmarine:
     """
@@ -70,6 +71,8 @@ class ProcessingSubmarine:
         cable_dumps = []
         landing_dumps = []
         for f in os.listdir(self.in_dir):
+            if f.startswith('.'):
+                continue
             if 'cable' in f and 'json' in f:
                 cable_dumps.append(f)
             if 'landing' in f and 'json' in f:
@@ -92,7 +95,7 @@ class ProcessingSubmarine:
             month = ld.split('_')[2]
             day = ld.split('_')[3].replace('.json', '')
             self.asof_date = f"{year}-{month}-{day}"
-            self.process_landing(self.in_dir / ld, self.shapefile)
+            self.process_landing(self.in_dir / ld, self.shapefile.parent)
         save_file = self.out_dir / self.landing_table / f"{self.data_source}_{self.landing_table}.csv"
         self.landing_df.to_csv(save_file, index=False)
 
@@ -111,7 +114,7 @@ class ProcessingSubmarine:
             self.cables_list.append([cable_id, cable_name, feat_id, geom.wkt,
                 self.data_source, self.asof_date])
 
-    def process_landing(self, f_name, vor_fname):
+    def process_landing(self, f_name, voronoi_dir):
         tele_df = gpd.read_file(f_name)
         landing_dict = {}
         landing_dict['city_name'] = []
@@ -154,9 +157,14 @@ class ProcessingSubmarine:
         l_df = gpd.GeoDataFrame(landing_dict,
                 geometry=gpd.points_from_xy(landing_dict['longitude'], landing_dict['latitude'],
                     crs="EPSG:4326"))
-        all_df = gpd.read_file(vor_fname)
-        loc_df = all_df[["NAME", "ADM1NAME", "ISO_A2", "geometry"]]
-        join_df = gpd.sjoin(l_df, loc_df, how="inner", predicate='within')
+        voronoi_index = Index_Voronoi.get_voronoi_index(voronoi_dir)
+        polygons = voronoi_index.lookup_many(landing_dict['latitude'], landing_dict['longitude'])
+        # only the landing points inside a city polygon are kept
+        join_df = l_df[polygons >= 0].copy()
+        found = polygons[polygons >= 0]
+        join_df["NAME"] = [voronoi_index.attributes["NAME"][i] for i in found]
+        join_df["ADM1NAME"] = [voronoi_index.attributes["ADM1NAME"][i] for i in found]
+        join_df["ISO_A2"] = [voronoi_index.attributes["ISO_A2"][i] for i in found]
         landing_df = join_df[["city_name", "state_province", "country", "latitude", "longitude",
             "source", "asof_date", "NAME", "ADM1NAME", "ISO_A2"]]
         # format the columns and data for entry to the DB
@@ -176,6 +184,9 @@ class ProcessingSubmarine:
 
     def process_cable_landing(self):
         for f_name in os.listdir(self.cable_data_dir):
+            # the crawler's unfinished downloads start with a dot
+            if f_name.startswith('.'):
+                continue
             with open(self.cable_data_dir / f_name, 'r') as f:
                 d = json.load(f)
             c_id = f_name.split('_')[0]
@@ -2,7 +2,7 @@ from pathlib import Path
 import os
 import csv
 import dbStructure
-import geopandas as gpd
+import Index_Voronoi
 
 class ProcessingVoronoi:
     def __init__(self, in_dir, out_dir):
@@ -47,7 +47,8 @@ class ProcessingVoronoi:
         if not os.path.isdir(self.in_dir):
             print("\tThere is no data to process. Update the world city data before continuing.")
             return
-        self.read_shapefile(self.shapefile)
+        if not self.read_index(self.in_dir):
+            return
 
         t_file = f"{self.polygons_table}.csv" 
         polygons_file = self.out_dir / self.polygons_table / t_file
@@ -57,24 +58,30 @@ class ProcessingVoronoi:
         points_file = self.out_dir / self.points_table / t_file
         self.save_csv(self.points_list, self.points_header, points_file)
 
-    def read_shapefile(self, f_name):
-        print(f"\tReading {f_name}")
-        loc_df = gpd.read_file(f_name)
-        for i,row in loc_df.iterrows():
-            lat = row["LATITUDE"]
-            lon = row["LONGITUDE"]
-            city_name = row["NAME"].replace("'", "''")
+    def read_index(self, voronoi_dir):
+        voronoi_index = Index_Voronoi.get_voronoi_index(voronoi_dir)
+        print(f"\tReading {voronoi_index.index_dir}")
+        if voronoi_index.missing_columns:
+            print(f"\tThe Voronoi map has no {', '.join(voronoi_index.missing_columns)} column(s). ", end='')
+            print(f"Add its .dbf file to {voronoi_dir} to process the cities.")
+            return False
+        for i in range(len(voronoi_index)):
+            loc = voronoi_index.location(i)
+            lat = loc["LATITUDE"]
+            lon = loc["LONGITUDE"]
+            city_name = loc["CITY"].replace("'", "''")
             try:
-                province_name = row["ADM1NAME"].replace("'", "''")
+                province_name = loc["STATE"].replace("'", "''")
             except:
                 province_name = None
-            cc = row["ISO_A2"]
-            poly_wkt = row["geometry"].wkt
+            cc = loc["COUNTRY"]
+            poly_wkt = voronoi_index.geometry(i).wkt
             polygon_row = [city_name, province_name, cc, poly_wkt]
             self.polygons_list.append(polygon_row)
 
             points_row = [city_name, province_name, cc, lat, lon]
             self.points_list.append(points_row)
+        return True
 
     def save_csv(self, data, header, f_name):
         print(f"\tSaving to {f_name}.")
@@ -1,47 +1,209 @@
 import sqlite3
 from sqlite3 import Error
 import os
+import csv
+import json
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+class ConnectionPool:
+    """A thread-safe pool of read-only connections to a single SQLite file.
+    Connections are opened on demand, up to max_size, and handed back to the pool
+    after each query, so the connection setup, schema parsing and the
+    prepared statements cached by each connection are reused across queries."""
+    def __init__(self, db_file, max_size=8, cached_statements=256):
+        self.uri = Path(db_file).resolve().as_uri() + "?mode=ro&cache=shared"
+        self.max_size = max_size
+        self.cached_statements = cached_statements
+        self.idle = []
+        self.num_open = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise Error("The connection pool is closed.")
+                if self.idle:
+                    return self.idle.pop()
+                if self.num_open < self.max_size:
+                    self.num_open += 1
+                    break
+                self.cond.wait()
+        try:
+            return sqlite3.connect(self.uri, uri=True, check_same_thread=False,
+                    cached_statements=self.cached_statements)
+        except Error:
+            with self.cond:
+                self.num_open -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, conn):
+        with self.cond:
+            if self.closed:
+                conn.close()
+                self.num_open -= 1
+            else:
+                self.idle.append(conn)
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for conn in self.idle:
+                conn.close()
+                self.num_open -= 1
+            self.idle = []
+            self.cond.notify_all()
+
+# one pool per database file, shared by every queryDatabase in the process
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_file, max_size=8):
+    key = str(Path(db_file).resolve())
+    with _pools_lock:
+        if not key in _pools or _pools[key].closed:
+            _pools[key] = ConnectionPool(db_file, max_size)
+        return _pools[key]
 
 class queryDatabase:
-    def __init__(self, db_file):
+    def __init__(self, db_file, pool_size=8):
+        self.pool = None
         if not os.path.isfile(db_file):
             print(f"{db_file} is not a file.")
             self.db_file = ""
         else:
             self.db_file = db_file
+            self.pool = get_pool(db_file, pool_size)
 
-    # create database connection
-    def create_connection(self):
-        """ create a database connection to a SQLite database """
-        conn = None
-        try:
-            conn = sqlite3.connect(self.db_file)
-            #print(f"SQLite version: {sqlite3.version}")
-        except Error as e:
-            print(e)
-        return conn
-
-    def execute_query(self, query_str):
-        conn = self.create_connection()
-        try:
-            c = conn.cursor()
-            c.execute(query_str)
-        except Error as e:
-            print(e)
-        results = c.fetchall()
+    def execute_query(self, query_str, params=()):
+        """Runs query_str with the bound parameters and returns all of the rows.
+        Values should always be passed in params rather than formatted into query_str."""
+        if not self.pool:
+            print("There is no database to query.")
+            return []
+        with self.pool.connection() as conn:
+            try:
+                c = conn.execute(query_str, params)
+                return c.fetchall()
+            except Error as e:
+                print(e)
+                return []
+
+    def executemany(self, query_str, params_list):
+        """Runs the same query once for each set of parameters on a single connection,
+        so the statement is only prepared once. Returns one list of rows per set."""
+        if not self.pool:
+            print("There is no database to query.")
+            return []
+        results = []
+        with self.pool.connection() as conn:
+            try:
+                for params in params_list:
+                    results.append(conn.execute(query_str, params).fetchall())
+            except Error as e:
+                print(e)
         return results
 
+    def iter_query(self, query_str, params=(), batch_size=1000):
+        """Yields the rows of the query one at a time, fetching batch_size rows
+        from SQLite at a time instead of the whole result, so memory stays bounded.
+        The connection is returned to the pool once the generator is exhausted or closed."""
+        for batch in self.iter_batches(query_str, params, batch_size):
+            for row in batch:
+                yield row
+
+    def iter_batches(self, query_str, params=(), batch_size=1000, columns=None):
+        """Yields lists of at most batch_size rows.
+        If columns is a list, it is filled with the column names of the result."""
+        if not self.pool:
+            print("There is no database to query.")
+            return
+        with self.pool.connection() as conn:
+            try:
+                c = conn.execute(query_str, params)
+            except Error as e:
+                print(e)
+                return
+            if columns is not None and c.description:
+                columns.extend([d[0] for d in c.description])
+            while True:
+                batch = c.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield batch
+
+    def page_query(self, query_str, params=(), limit=None, offset=None):
+        """Wraps query_str so that only "limit" rows starting at "offset" are returned."""
+        if limit is None and offset is None:
+            return query_str, params
+        query_str = query_str.strip().rstrip(';')
+        paged_str = f"SELECT * FROM ({query_str}) LIMIT ? OFFSET ?"
+        if limit is None:
+            limit = -1
+        if offset is None:
+            offset = 0
+        if isinstance(params, dict):
+            # named parameters cannot be mixed with positional ones
+            paged_str = f"SELECT * FROM ({query_str}) LIMIT :page_limit OFFSET :page_offset"
+            paged_params = dict(params)
+            paged_params["page_limit"] = limit
+            paged_params["page_offset"] = offset
+            return paged_str, paged_params
+        return paged_str, tuple(params) + (limit, offset)
+
+    def export_query(self, query_str, out_file, out_format="csv", params=(), batch_size=1000):
+        """Streams the results of the query to the open file out_file,
+        either as csv with a header row or as one JSON object per line (ndjson).
+        Returns the number of rows written."""
+        num_rows = 0
+        columns = []
+        csv_writer = None
+        for batch in self.iter_batches(query_str, params, batch_size, columns):
+            if out_format == "ndjson":
+                for row in batch:
+                    out_file.write(json.dumps(dict(zip(columns, row)), default=str) + "\n")
+            else:
+                if csv_writer is None:
+                    csv_writer = csv.writer(out_file, delimiter=',')
+                    csv_writer.writerow(columns)
+                csv_writer.writerows(batch)
+            num_rows += len(batch)
+        if out_format != "ndjson" and csv_writer is None and columns:
+            csv.writer(out_file, delimiter=',').writerow(columns)
+        return num_rows
+
+    def explain_query(self, query_str, params=()):
+        """Returns the plan SQLite would use to run query_str.
+        Each row is (id, parent id, unused, detail)."""
+        return self.execute_query(f"EXPLAIN QUERY PLAN {query_str}", params)
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+
 if __name__ == "__main__":
     print("You should not run this script by itself. It should be called from iGDB.py")
     f_name = "../database/db_test.db"
     query = """SELECT *
-            FROM ases
-            WHERE asn = 3"""
+            FROM asn_loc
+            WHERE asn = ?"""
 
     if not os.path.isfile(f_name):
         print(f"{f_name} is not a file.")
     else:
         my_querier = queryDatabase(f_name)
-        my_results = my_querier.execute_query(query)
+        my_results = my_querier.execute_query(query, (3,))
         print(my_results)
-
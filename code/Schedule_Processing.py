@@ -0,0 +1,161 @@
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
+
+def run_stage(func, args):
+    """Runs one stage and returns how long it took, and the traceback if it failed.
+    This runs in the worker process, so it only measures the stage itself,
+    and the traceback is formatted here where the exception was raised."""
+    start = time.time()
+    try:
+        func(*args)
+    except Exception:
+        return None, traceback.format_exc()
+    return time.time() - start, None
+
+def run_processor(processor_class, args):
+    processor = processor_class(*args)
+    processor.run_steps()
+
+class ProcessingScheduler:
+    """
+        Runs the processing stages in dependency order.
+        Each stage is a function and its arguments, plus the names of the stages
+        that must finish before it starts. With more than one job, every stage
+        whose dependencies are done runs at once in a pool of worker processes,
+        so the stages that do not depend on each other overlap.
+    """
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+        self.stages = {}
+
+    def add_stage(self, name, func, args=(), deps=()):
+        self.stages[name] = {"FUNC":func, "ARGS":args, "DEPS":list(deps)}
+
+    def add_processor(self, name, processor_class, args, deps=()):
+        """Adds a stage that creates a Processing_* class with args and runs its steps."""
+        self.add_stage(name, run_processor, (processor_class, args), deps)
+
+    def select(self, names):
+        """Returns the named stages and everything they depend on, in the order they were added."""
+        if not names:
+            return list(self.stages.keys())
+        selected = set()
+        to_visit = list(names)
+        while to_visit:
+            name = to_visit.pop()
+            if name in selected:
+                continue
+            if not name in self.stages:
+                raise ValueError(f"There is no processing stage named {name}.")
+            selected.add(name)
+            to_visit.extend(self.stages[name]["DEPS"])
+        return [name for name in self.stages if name in selected]
+
+    def topological_order(self, names):
+        """Orders the stages so each one comes after its dependencies,
+        otherwise keeping the order they were added."""
+        order = []
+        placed = set()
+        remaining = list(names)
+        while remaining:
+            ready = [n for n in remaining if all(d in placed for d in self.stages[n]["DEPS"])]
+            if not ready:
+                raise ValueError(f"The processing stages {remaining} depend on each other.")
+            order.append(ready[0])
+            placed.add(ready[0])
+            remaining.remove(ready[0])
+        return order
+
+    def run(self, names=None):
+        """Runs the named stages (all of them by default) and their dependencies.
+        A stage is skipped if one of its dependencies failed.
+        Returns the wall time of each stage that finished, and the stages that did not."""
+        order = self.topological_order(self.select(names))
+        start = time.time()
+        if self.jobs <= 1:
+            timings, failed = self.run_serial(order)
+        else:
+            timings, failed = self.run_parallel(order)
+        self.report(order, timings, failed, time.time() - start)
+        return timings, failed
+
+    def finish(self, name, elapsed, error, timings, failed):
+        if error is None:
+            timings[name] = elapsed
+        else:
+            print(f"\tProcessing {name} failed:\n{error}", end='')
+            failed.add(name)
+        return error is None
+
+    def blocked_by(self, name, failed):
+        return [d for d in self.stages[name]["DEPS"] if d in failed]
+
+    def run_serial(self, order):
+        timings = {}
+        failed = set()
+        for name in order:
+            stage = self.stages[name]
+            print()
+            if self.blocked_by(name, failed):
+                print(f"Skipping {name} because {self.blocked_by(name, failed)} did not finish.")
+                failed.add(name)
+                continue
+            elapsed, error = run_stage(stage["FUNC"], stage["ARGS"])
+            self.finish(name, elapsed, error, timings, failed)
+        return timings, failed
+
+    def run_parallel(self, order):
+        timings = {}
+        failed = set()
+        done = set()
+        pending = list(order)
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                for name in list(pending):
+                    if self.blocked_by(name, failed):
+                        print(f"Skipping {name} because {self.blocked_by(name, failed)} did not finish.")
+                        failed.add(name)
+                        pending.remove(name)
+                    elif all(d in done for d in self.stages[name]["DEPS"]):
+                        stage = self.stages[name]
+                        running[pool.submit(run_stage, stage["FUNC"], stage["ARGS"])] = name
+                        pending.remove(name)
+                if not running:
+                    continue
+                finished, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        elapsed, error = future.result()
+                    except Exception:
+                        # the worker itself died, e.g. the stage could not be sent to it
+                        elapsed, error = None, traceback.format_exc()
+                    if self.finish(name, elapsed, error, timings, failed):
+                        done.add(name)
+        return timings, failed
+
+    def report(self, order, timings, failed, elapsed):
+        print(f"\nProcessing stage times with {self.jobs} job(s):")
+        for name in order:
+            if name in timings:
+                print(f"\t{name}: {timings[name]:.1f} s")
+            else:
+                print(f"\t{name}: did not finish")
+        print(f"\tTotal: {elapsed:.1f} s")
+
+def example_stage(name, seconds):
+    print(f"\tRunning {name} for {seconds} s.")
+    time.sleep(seconds)
+
+if __name__ == "__main__":
+    print("This script should not be run by itself. Run it through iGDB.py")
+    my_scheduler = ProcessingScheduler(jobs=4)
+    my_scheduler.add_stage("index", example_stage, ("index", 0.5))
+    my_scheduler.add_stage("first", example_stage, ("first", 1), ["index"])
+    my_scheduler.add_stage("second", example_stage, ("second", 1), ["index"])
+    my_scheduler.add_stage("independent", example_stage, ("independent", 1))
+    my_scheduler.run()
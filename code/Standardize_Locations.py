@@ -1,36 +1,193 @@
 from pathlib import Path
-import geopandas as gpd
+import os
+import sqlite3
+from collections import OrderedDict
 import numpy as np
-from shapely.geometry import Point
+import Index_Voronoi
+
+# the keys of a standardized location
+std_columns = ["LATITUDE", "LONGITUDE", "CITY", "STATE", "COUNTRY"]
+
+# one geocoding cache per cache file, shared by every LocationStandardizer in the process
+_geocode_caches = {}
+
+class GeocodeCache:
+    """Remembers the standardized location of each rounded (lat, lon).
+    The results are kept in a SQLite file so they survive between runs,
+    with the most recently used ones also held in memory.
+    Every entry is tagged with the hash of the Voronoi map that produced it,
+    and entries from any other map are dropped when the cache is opened."""
+    def __init__(self, cache_file, map_hash, max_memory=100000):
+        self.cache_file = cache_file
+        self.map_hash = map_hash
+        self.max_memory = max_memory
+        self.memory = OrderedDict()
+        if not os.path.isdir(Path(cache_file).parent):
+            os.makedirs(Path(cache_file).parent)
+        self.conn = sqlite3.connect(cache_file, timeout=60)
+        # the processors running in parallel all share the cache file
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS geocode (
+                lat REAL NOT NULL,
+                lon REAL NOT NULL,
+                map_hash TEXT NOT NULL,
+                found INTEGER NOT NULL,
+                latitude REAL,
+                longitude REAL,
+                city TEXT,
+                state TEXT,
+                country TEXT,
+                PRIMARY KEY (lat, lon)
+                );""")
+        with self.conn:
+            num_stale = self.conn.execute("DELETE FROM geocode WHERE map_hash != ?;",
+                    (map_hash,)).rowcount
+        if num_stale > 0:
+            print(f"\tThe Voronoi map changed. Dropped {num_stale} cached locations.")
+
+    def key(self, lat, lon):
+        return (round(float(lat), 4), round(float(lon), 4))
+
+    def get_many(self, keys):
+        """Returns a dict of the keys that are cached.
+        A key that was not inside any city polygon maps to {}."""
+        found = {}
+        missing = []
+        for k in keys:
+            if k in self.memory:
+                self.memory.move_to_end(k)
+                found[k] = self.memory[k]
+            else:
+                missing.append(k)
+        query = """SELECT found, latitude, longitude, city, state, country
+                FROM geocode WHERE lat = ? AND lon = ? AND map_hash = ?;"""
+        for k in missing:
+            row = self.conn.execute(query, (k[0], k[1], self.map_hash)).fetchone()
+            if row is None:
+                continue
+            if row[0]:
+                found[k] = {"LATITUDE":row[1], "LONGITUDE":row[2],
+                        "CITY":row[3], "STATE":row[4], "COUNTRY":row[5]}
+            else:
+                found[k] = {}
+            self.remember(k, found[k])
+        return found
+
+    def put_many(self, entries):
+        """Stores a dict of key -> standardized location ({} if there was none)."""
+        rows = []
+        for k, loc in entries.items():
+            self.remember(k, loc)
+            if loc:
+                rows.append((k[0], k[1], self.map_hash, 1, float(loc["LATITUDE"]),
+                        float(loc["LONGITUDE"]), loc["CITY"], loc["STATE"], loc["COUNTRY"]))
+            else:
+                rows.append((k[0], k[1], self.map_hash, 0, None, None, None, None, None))
+        if not rows:
+            return
+        with self.conn:
+            self.conn.executemany("""INSERT OR REPLACE INTO geocode
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);""", rows)
+
+    def remember(self, k, loc):
+        self.memory[k] = loc
+        self.memory.move_to_end(k)
+        if len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+
+def get_geocode_cache(cache_file, map_hash):
+    key = str(Path(cache_file).resolve())
+    if not key in _geocode_caches or _geocode_caches[key].map_hash != map_hash:
+        _geocode_caches[key] = GeocodeCache(cache_file, map_hash)
+    return _geocode_caches[key]
 
 class LocationStandardizer:
-    def __init__(self, voronoi_dir):
-        self.voronoi_dir = voronoi_dir
+    def __init__(self, voronoi_dir, cache_file=Path("../cache/geocode_cache.db")):
+        """Set cache_file to None to always run the point in polygon tests."""
+        self.voronoi_dir = Path(voronoi_dir)
         self.voronoi_shapefile = self.voronoi_dir / "cities_Voronoi.shp"
-        self._read_cities_shapefile()
+        self._load_voronoi_index()
+        self.cache = None
+        if cache_file is not None:
+            self.cache = get_geocode_cache(cache_file, self.map_hash)
 
-    def _read_cities_shapefile(self):
-        self.cities_df = gpd.read_file(self.voronoi_shapefile)
-        self.cities_series = gpd.GeoSeries(self.cities_df.geometry)
+    def _load_voronoi_index(self):
+        # the compiled index is memory-mapped once per process and shared
+        self.voronoi_index = Index_Voronoi.get_voronoi_index(self.voronoi_dir)
+        self.map_hash = self.voronoi_index.map_hash
 
     def standardize(self, node_coords):
-        my_point = Point(node_coords[1], node_coords[0])
-        contains = self.cities_series.contains(my_point)
-        result = np.where(contains.values == True)
-        if len(result) > 1:
-            print(f"Error with: {node_coords}")
-        try:
-            std_lat = self.cities_df.iloc[result[0]]["LATITUDE"].values[0]
-            std_lon = self.cities_df.iloc[result[0]]["LONGITUDE"].values[0]
-            city = self.cities_df.iloc[result[0]]["NAME"].values[0]
-            state = self.cities_df.iloc[result[0]]["ADM1NAME"].values[0]
-            cc = self.cities_df.iloc[result[0]]["ISO_A2"].values[0]
-            result_dict = {"LATITUDE":std_lat, "LONGITUDE":std_lon,
-                    "CITY":city, "STATE":state, "COUNTRY":cc}
-        except:
+        if self.cache:
+            k = self.cache.key(node_coords[0], node_coords[1])
+            cached = self.cache.get_many([k])
+            if k in cached:
+                if not cached[k]:
+                    print(f"\tNo lat/long for {node_coords}")
+                return dict(cached[k])
+            result_dict = self._standardize(node_coords)
+            self.cache.put_many({k:result_dict})
+            return result_dict
+        return self._standardize(node_coords)
+
+    def _standardize(self, node_coords):
+        i = self.voronoi_index.lookup(node_coords[0], node_coords[1])
+        if i < 0:
             print(f"\tNo lat/long for {node_coords}")
-            result_dict = {}
-        return result_dict
+            return {}
+        return self.voronoi_index.location(i)
+
+    def standardize_many(self, lats, lons):
+        """Standardizes many coordinates at once with a single pass over the index.
+        Returns a dict of arrays with the same keys as standardize(),
+        plus FOUND, which is False for the coordinates outside every city polygon.
+        Only the coordinates missing from the cache are looked up."""
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        if not self.cache:
+            return self._standardize_many(lats, lons)
+
+        keys = [self.cache.key(lat, lon) for lat, lon in zip(lats, lons)]
+        cached = self.cache.get_many(set(keys))
+        miss_idx = [i for i, k in enumerate(keys) if not k in cached]
+        miss_results = self._standardize_many(lats[miss_idx], lons[miss_idx])
+        new_entries = {}
+        for j, i in enumerate(miss_idx):
+            new_entries[keys[i]] = self.result_dict(miss_results, j)
+        self.cache.put_many(new_entries)
+        cached.update(new_entries)
+
+        results = {"FOUND":np.zeros(len(lats), dtype=bool)}
+        for key in std_columns:
+            results[key] = np.full(len(lats), None, dtype=object)
+        for i, k in enumerate(keys):
+            if cached[k]:
+                results["FOUND"][i] = True
+                for key in std_columns:
+                    results[key][i] = cached[k][key]
+            elif not k in new_entries:
+                print(f"\tNo lat/long for {[float(lats[i]), float(lons[i])]}")
+        return results
+
+    def _standardize_many(self, lats, lons):
+        results = {"FOUND":np.zeros(len(lats), dtype=bool)}
+        for key in std_columns:
+            results[key] = np.full(len(lats), None, dtype=object)
+        polygons = self.voronoi_index.lookup_many(lats, lons)
+        for i, poly in enumerate(polygons):
+            if poly < 0:
+                print(f"\tNo lat/long for {[float(lats[i]), float(lons[i])]}")
+                continue
+            results["FOUND"][i] = True
+            for key, value in self.voronoi_index.location(poly).items():
+                results[key][i] = value
+        return results
+
+    def result_dict(self, results, i):
+        """Returns the i-th location of a standardize_many() result
+        in the same form as standardize(), or {} if it was not found."""
+        if not results["FOUND"][i]:
+            return {}
+        return {key:results[key][i] for key in std_columns}
 
 if __name__ == "__main__":
     voronoi_dir = Path("../helper_data/cities_Voronoi")
@@ -44,3 +201,8 @@ if __name__ == "__main__":
     print(f"Classifying a point ({madrid}) in Madrid.")
     result = my_standardizer.standardize(madrid)
     print(result)
+
+    print("Classifying both points at once.")
+    results = my_standardizer.standardize_many([chicago[0], madrid[0]], [chicago[1], madrid[1]])
+    for i in range(len(results["FOUND"])):
+        print(my_standardizer.result_dict(results, i))
@@ -0,0 +1,223 @@
+import re
+import json
+
+# the next character that changes the nesting outside or inside of a string
+_structure_re = re.compile(r'["\[\]{}]')
+_string_re = re.compile(r'["\\]')
+_ws_re = re.compile(r'\s*')
+_number_chars = "0123456789.eE+-"
+
+class JSONStream:
+    """
+        Reads one JSON document incrementally from an open text file.
+        Only the part of the file around the current position is held in memory,
+        so the records of a large array or object can be visited one at a time.
+        Each record is parsed by the json module itself, and the values that
+        are not wanted are skipped by scanning for brackets and quotes.
+    """
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        """Reads the next chunk, dropping the part of the buffer already consumed.
+        Returns False at the end of the file."""
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next character that is not whitespace, or '' at the end."""
+        while True:
+            self.pos = _ws_re.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        ch = self.peek()
+        if not ch or not ch in chars:
+            raise ValueError(f"Expected one of {chars!r} but found {ch!r} at offset {self.pos}.")
+        self.pos += 1
+        return ch
+
+    def read_value(self):
+        """Parses the next complete value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if self.eof or (end < len(self.buf) and not self.buf[end] in _number_chars):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def skip_value(self):
+        """Moves past the next value without building it."""
+        ch = self.peek()
+        if not ch in '[{':
+            self.read_value()
+            return
+        depth = 0
+        in_string = False
+        while True:
+            if in_string:
+                m = _string_re.search(self.buf, self.pos)
+            else:
+                m = _structure_re.search(self.buf, self.pos)
+            if m is None or (m.group() == '\\' and m.end() >= len(self.buf)):
+                # keep the unfinished escape sequence for the next chunk
+                if m is not None:
+                    self.pos = m.start()
+                else:
+                    self.pos = len(self.buf)
+                if not self.fill():
+                    raise ValueError("The JSON document ended inside a value.")
+                continue
+            c = m.group()
+            self.pos = m.end()
+            if in_string:
+                if c == '\\':
+                    self.pos += 1
+                else:
+                    in_string = False
+            elif c == '"':
+                in_string = True
+            elif c in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def iter_array(self):
+        """Yields the items of the array starting at the current position."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self.expect(',]') == ']':
+                return
+
+    def iter_object(self):
+        """Yields (key, value) for the members of the object starting at the current position."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            yield key, self.read_value()
+            if self.expect(',}') == '}':
+                return
+
+    def iter_keys(self):
+        """Yields the keys of the object starting at the current position.
+        The value of each key must be read or skipped before the next key is asked for."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def find(self, path):
+        """Moves to the value at path, a list of object keys and array indexes.
+        Returns False if there is no such value."""
+        for step in path:
+            ch = self.peek()
+            if isinstance(step, int) and ch == '[':
+                self.expect('[')
+                if self.peek() == ']':
+                    return False
+                for i in range(step):
+                    self.skip_value()
+                    if self.expect(',]') == ']':
+                        return False
+            elif not isinstance(step, int) and ch == '{':
+                self.expect('{')
+                if self.peek() == '}':
+                    return False
+                while True:
+                    key = self.read_value()
+                    self.expect(':')
+                    if key == step:
+                        break
+                    self.skip_value()
+                    if self.expect(',}') == '}':
+                        return False
+            else:
+                return False
+        return True
+
+def iter_items(f_name, path=()):
+    """Yields the items of the array at path in the JSON file f_name,
+    e.g. iter_items(f_name, ['net', 'data']) for the networks of a PeeringDB dump."""
+    with open(f_name, 'r') as f:
+        stream = JSONStream(f)
+        if not stream.find(path):
+            return
+        if stream.peek() != '[':
+            return
+        for item in stream.iter_array():
+            yield item
+
+def iter_members(f_name, path=()):
+    """Yields (key, value) for each member of the object at path in the JSON file f_name."""
+    with open(f_name, 'r') as f:
+        stream = JSONStream(f)
+        if not stream.find(path):
+            return
+        if stream.peek() != '{':
+            return
+        for key, value in stream.iter_object():
+            yield key, value
+
+def iter_sections(f_name, sections):
+    """Yields (section, item) for the items of the array at [section, 'data'] in the JSON
+    file f_name, for every section in sections, in the order they are in the file.
+    The whole file is read once, and the members that are not wanted are skipped."""
+    with open(f_name, 'r') as f:
+        stream = JSONStream(f)
+        if stream.peek() != '{':
+            return
+        for section in stream.iter_keys():
+            if not section in sections or stream.peek() != '{':
+                stream.skip_value()
+                continue
+            for key in stream.iter_keys():
+                if key == 'data' and stream.peek() == '[':
+                    for item in stream.iter_array():
+                        yield section, item
+                else:
+                    stream.skip_value()
+
+if __name__ == "__main__":
+    print("This script should not be run by itself. Run it through iGDB.py")
+    import io
+    test_doc = '{"as_set": {"data": [{"1": "A\\"B"}]}, "net": {"data": [{"asn": 1}, {"asn": 2}]}}'
+    my_stream = JSONStream(io.StringIO(test_doc), chunk_size=4)
+    my_stream.find(["net", "data"])
+    print(list(my_stream.iter_array()))
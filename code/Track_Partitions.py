@@ -0,0 +1,103 @@
+from pathlib import Path
+import os
+import json
+
+class PartitionManifest:
+    """
+        Records which dated input folders a processor already turned into
+        output partitions, e.g. unprocessed/RIPETraceroutes/2022_10_08 into
+        processed/traceroutes/RIPEAtlas_2022-10-08.csv.
+        Each folder is stored with the size and modification time of its files,
+        so a folder is processed again if a crawler added to it or changed it,
+        or if one of its partitions was deleted.
+        A processor that can write more than one format gives out_format,
+        and a folder saved in another format is processed again.
+    """
+    def __init__(self, manifest_file, out_format=None):
+        self.manifest_file = Path(manifest_file)
+        self.out_format = out_format
+        self.folders = {}
+        if os.path.isfile(self.manifest_file):
+            try:
+                with open(self.manifest_file, 'r') as f:
+                    self.folders = json.load(f)
+            except ValueError:
+                print(f"\tCould not read {self.manifest_file}. Processing every folder again.")
+                self.folders = {}
+
+    def folder_state(self, folder):
+        state = {}
+        for f in os.listdir(folder):
+            s = os.stat(Path(folder) / f)
+            state[f] = [s.st_size, s.st_mtime_ns]
+        return state
+
+    def is_current(self, in_dir, folder, out_dir):
+        if not folder in self.folders:
+            return False
+        entry = self.folders[folder]
+        if entry["FILES"] != self.folder_state(Path(in_dir) / folder):
+            return False
+        if not self.is_same_format(folder):
+            return False
+        return all(os.path.isfile(Path(out_dir) / o) for o in entry["OUTPUTS"])
+
+    def is_same_format(self, folder):
+        # the entries from before the format was recorded were all csv
+        if self.out_format is None or not folder in self.folders:
+            return True
+        return self.folders[folder].get("FORMAT", "csv") == self.out_format
+
+    def pending(self, in_dir, out_dir):
+        """Returns the input folders that need to be processed, oldest first."""
+        folders = []
+        for d in sorted(os.listdir(in_dir)):
+            if not os.path.isdir(Path(in_dir) / d):
+                continue
+            if not self.is_current(in_dir, d, out_dir):
+                folders.append(d)
+        reformat = [d for d in folders if not self.is_same_format(d)]
+        if reformat:
+            print(f"\t{len(reformat)} days were saved in another format. ", end='')
+            print(f"Processing them again as {self.out_format}.")
+        return folders
+
+    def outputs(self, folder):
+        """Returns the partitions last written for the folder, relative to the output directory."""
+        if folder in self.folders:
+            return self.folders[folder]["OUTPUTS"]
+        return []
+
+    def remove_outputs(self, folder, out_dir):
+        for o in self.outputs(folder):
+            if os.path.isfile(Path(out_dir) / o):
+                os.remove(Path(out_dir) / o)
+
+    def record(self, in_dir, folder, outputs):
+        self.folders[folder] = {"FILES":self.folder_state(Path(in_dir) / folder),
+                "OUTPUTS":[str(o) for o in outputs]}
+        if self.out_format is not None:
+            self.folders[folder]["FORMAT"] = self.out_format
+        self.save()
+
+    def save(self):
+        """Writes the manifest to a temporary file first,
+        so an interrupted run never leaves a partial manifest."""
+        if not os.path.isdir(self.manifest_file.parent):
+            os.makedirs(self.manifest_file.parent)
+        tmp_file = self.manifest_file.with_suffix(".tmp")
+        with open(tmp_file, 'w') as f:
+            json.dump(self.folders, f, sort_keys=True)
+        os.replace(tmp_file, self.manifest_file)
+
+def remove_legacy_file(f_name):
+    """Removes an output file from before the partitions existed,
+    whose rows would otherwise be loaded twice."""
+    if os.path.isfile(f_name):
+        print(f"\tRemoving {f_name}, which is replaced by the daily partitions.")
+        os.remove(f_name)
+
+if __name__ == "__main__":
+    print("This script should not be run by itself. Run it through iGDB.py")
+    my_manifest = PartitionManifest(Path("../processed/manifests/RIPEAtlas_asn_loc.json"))
+    print(my_manifest.pending(Path("../unprocessed/RIPEAtlas"), Path("../processed/asn_loc")))
@@ -1,5 +1,6 @@
 """These SQL statements are used to create each table in the DB.
-The DB structure should all be defined in this file."""
+The DB structure should all be defined in this file.
+The indexes listed after each table are built once the table is loaded."""
 
 sql_create_city_points_table = """ CREATE TABLE IF NOT EXISTS city_points(
                                         city_name text,
@@ -9,6 +10,10 @@ sql_create_city_points_table = """ CREATE TABLE IF NOT EXISTS city_points(
                                         city_longitude numeric
                                     ); """
 
+sql_create_city_points_indexes = [
+        "CREATE INDEX IF NOT EXISTS city_points_city_idx ON city_points(city_name, state_province, country_code);"
+]
+
 sql_create_city_polygons_table = """ CREATE TABLE IF NOT EXISTS city_polygons(
                                         city_name text,
                                         state_province text,
@@ -16,6 +21,10 @@ sql_create_city_polygons_table = """ CREATE TABLE IF NOT EXISTS city_polygons(
                                         polygon_wkt text
                                     ); """
 
+sql_create_city_polygons_indexes = [
+        "CREATE INDEX IF NOT EXISTS city_polygons_city_idx ON city_polygons(city_name, state_province, country_code);"
+]
+
 sql_create_ip_asn_dns_table = """ CREATE TABLE IF NOT EXISTS ip_asn_dns(
                                         ip_addr text,
                                         rdns text,
@@ -27,6 +36,11 @@ sql_create_ip_asn_dns_table = """ CREATE TABLE IF NOT EXISTS ip_asn_dns(
                                         asof_date date
                                     ); """
 
+sql_create_ip_asn_dns_indexes = [
+        "CREATE INDEX IF NOT EXISTS ip_asn_dns_ip_idx ON ip_asn_dns(ip_addr);",
+        "CREATE INDEX IF NOT EXISTS ip_asn_dns_asn_idx ON ip_asn_dns(asn);"
+]
+
 sql_create_ip_dns_table = """ CREATE TABLE IF NOT EXISTS ip_dns(
                                         ip_addr text,
                                         rdns text,
@@ -34,11 +48,19 @@ sql_create_ip_dns_table = """ CREATE TABLE IF NOT EXISTS ip_dns(
                                         rdns_geography text
                                     ); """
 
+sql_create_ip_dns_indexes = [
+        "CREATE INDEX IF NOT EXISTS ip_dns_ip_idx ON ip_dns(ip_addr);"
+]
+
 sql_create_ip_inference_table = """ CREATE TABLE IF NOT EXISTS ip_inference(
                                         ip_addr text,
                                         geography_inference text
                                     ); """
 
+sql_create_ip_inference_indexes = [
+        "CREATE INDEX IF NOT EXISTS ip_inference_ip_idx ON ip_inference(ip_addr);"
+]
+
 sql_create_traceroutes_table = """ CREATE TABLE IF NOT EXISTS traceroutes(
                                         source_ip text,
                                         destination_ip text,
@@ -50,6 +72,11 @@ sql_create_traceroutes_table = """ CREATE TABLE IF NOT EXISTS traceroutes(
                                         asof_date date
                                     ); """
 
+sql_create_traceroutes_indexes = [
+        "CREATE INDEX IF NOT EXISTS traceroutes_src_dst_idx ON traceroutes(source_ip, destination_ip);",
+        "CREATE INDEX IF NOT EXISTS traceroutes_hop_idx ON traceroutes(hop_ip);"
+]
+
 sql_create_asn_asname_table = """ CREATE TABLE IF NOT EXISTS asn_asname(
                                         asn integer,
                                         asn_name text,
@@ -57,6 +84,10 @@ sql_create_asn_asname_table = """ CREATE TABLE IF NOT EXISTS asn_asname(
                                         asof_date date
                                     ); """
 
+sql_create_asn_asname_indexes = [
+        "CREATE INDEX IF NOT EXISTS asn_asname_asn_idx ON asn_asname(asn);"
+]
+
 sql_create_asn_loc_table = """ CREATE TABLE IF NOT EXISTS asn_loc(
                                         asn integer,
                                         latitude numeric,
@@ -72,6 +103,11 @@ sql_create_asn_loc_table = """ CREATE TABLE IF NOT EXISTS asn_loc(
                                         asof_date date
                                     ); """
 
+sql_create_asn_loc_indexes = [
+        "CREATE INDEX IF NOT EXISTS asn_loc_asn_idx ON asn_loc(asn);",
+        "CREATE INDEX IF NOT EXISTS asn_loc_city_idx ON asn_loc(standard_city, standard_state, standard_country);"
+]
+
 sql_create_asn_org_table = """ CREATE TABLE IF NOT EXISTS asn_org(
                                         asn integer,
                                         organization text,
@@ -79,6 +115,10 @@ sql_create_asn_org_table = """ CREATE TABLE IF NOT EXISTS asn_org(
                                         asof_date date
                                     ); """
 
+sql_create_asn_org_indexes = [
+        "CREATE INDEX IF NOT EXISTS asn_org_asn_idx ON asn_org(asn);"
+]
+
 
 sql_create_asn_conn_table = """ CREATE TABLE IF NOT EXISTS asn_conn(
                                         relationship_type text,
@@ -88,6 +128,26 @@ sql_create_asn_conn_table = """ CREATE TABLE IF NOT EXISTS asn_conn(
                                         asof_date date
                                     ); """
 
+sql_create_asn_conn_indexes = [
+        "CREATE INDEX IF NOT EXISTS asn_conn_asn1_idx ON asn_conn(asn1);",
+        "CREATE INDEX IF NOT EXISTS asn_conn_asn2_idx ON asn_conn(asn2);"
+]
+
+# computed from asn_conn by Analyzing_ASCones, not loaded from the processed files
+sql_create_asn_cone_table = """ CREATE TABLE IF NOT EXISTS asn_cone(
+                                        asn integer,
+                                        customer_cone_size integer,
+                                        upstream_size integer,
+                                        provider_depth integer,
+                                        valley_free_reach integer,
+                                        source text,
+                                        asof_date date
+                                    ); """
+
+sql_create_asn_cone_indexes = [
+        "CREATE INDEX IF NOT EXISTS asn_cone_asn_idx ON asn_cone(asn);"
+]
+
 sql_create_nodes_table = """ CREATE TABLE IF NOT EXISTS phys_nodes(
                                         organization text,
                                         node_name text,
@@ -100,6 +160,11 @@ sql_create_nodes_table = """ CREATE TABLE IF NOT EXISTS phys_nodes(
                                         asof_date date
                                     ); """
 
+sql_create_nodes_indexes = [
+        "CREATE INDEX IF NOT EXISTS phys_nodes_name_idx ON phys_nodes(node_name);",
+        "CREATE INDEX IF NOT EXISTS phys_nodes_city_idx ON phys_nodes(city, country);"
+]
+
 sql_create_nodes_conn_table = """ CREATE TABLE IF NOT EXISTS phys_nodes_conn(
                                         from_node text,
                                         to_node text,
@@ -107,6 +172,11 @@ sql_create_nodes_conn_table = """ CREATE TABLE IF NOT EXISTS phys_nodes_conn(
                                         asof_date date
                                     ); """
 
+sql_create_nodes_conn_indexes = [
+        "CREATE INDEX IF NOT EXISTS phys_nodes_conn_from_idx ON phys_nodes_conn(from_node);",
+        "CREATE INDEX IF NOT EXISTS phys_nodes_conn_to_idx ON phys_nodes_conn(to_node);"
+]
+
 sql_create_standard_paths_table = """ CREATE TABLE IF NOT EXISTS standard_paths(
                                         from_city text,
                                         from_state text,
@@ -119,6 +189,11 @@ sql_create_standard_paths_table = """ CREATE TABLE IF NOT EXISTS standard_paths(
                                         asof_date date
                                     ); """
 
+sql_create_standard_paths_indexes = [
+        "CREATE INDEX IF NOT EXISTS standard_paths_from_idx ON standard_paths(from_city, from_country, to_city, to_country);",
+        "CREATE INDEX IF NOT EXISTS standard_paths_to_idx ON standard_paths(to_city, to_country, from_city, from_country);"
+]
+
 sql_create_submarine_cables_table = """ CREATE TABLE IF NOT EXISTS submarine_cables(
                                         cable_id text,
                                         cable_name text,
@@ -128,6 +203,10 @@ sql_create_submarine_cables_table = """ CREATE TABLE IF NOT EXISTS submarine_cab
                                         asof_date date
                                     ); """
 
+sql_create_submarine_cables_indexes = [
+        "CREATE INDEX IF NOT EXISTS submarine_cables_id_idx ON submarine_cables(cable_id);"
+]
+
 sql_create_landing_points_table = """ CREATE TABLE IF NOT EXISTS landing_points(
                                         city_name text,
                                         state_province text,
@@ -141,6 +220,10 @@ sql_create_landing_points_table = """ CREATE TABLE IF NOT EXISTS landing_points(
                                         asof_date date
                                     ); """
 
+sql_create_landing_points_indexes = [
+        "CREATE INDEX IF NOT EXISTS landing_points_city_idx ON landing_points(standard_city, standard_state, standard_country);"
+]
+
 sql_create_cable_landing_points_table = """ CREATE TABLE IF NOT EXISTS cable_landing_points(
                                         cable_id text,
                                         city_name text,
@@ -151,6 +234,21 @@ sql_create_cable_landing_points_table = """ CREATE TABLE IF NOT EXISTS cable_lan
                                         asof_date date
                                     ); """
 
+sql_create_cable_landing_points_indexes = [
+        "CREATE INDEX IF NOT EXISTS cable_landing_points_id_idx ON cable_landing_points(cable_id);"
+]
+
+sql_create_load_manifest_table = """ CREATE TABLE IF NOT EXISTS load_manifest(
+                                        table_name text,
+                                        file_name text,
+                                        file_hash text,
+                                        file_size integer,
+                                        file_mtime numeric,
+                                        row_count integer,
+                                        load_keys text,
+                                        loaded_at text
+                                    ); """
+
 tables = {
         'city_points':sql_create_city_points_table,
         'city_polygons':sql_create_city_polygons_table,
@@ -162,6 +260,7 @@ tables = {
         'asn_loc':sql_create_asn_loc_table,
         'asn_org':sql_create_asn_org_table,
         'asn_conn':sql_create_asn_conn_table,
+        'asn_cone':sql_create_asn_cone_table,
         'phys_nodes':sql_create_nodes_table,
         'phys_nodes_conn':sql_create_nodes_conn_table,
         'standard_paths':sql_create_standard_paths_table,
@@ -169,3 +268,34 @@ tables = {
         'landing_points':sql_create_landing_points_table,
         'cable_landing_points':sql_create_cable_landing_points_table
 }
+
+# tables computed from the rows of another table, e.g. by Analyzing_ASCones,
+# whose rows for a (source, asof_date) are dropped when that table's rows are replaced
+derived_tables = {
+        'asn_conn':['asn_cone']
+}
+
+# bookkeeping tables that are not loaded from the processed files
+metadata_tables = {
+        'load_manifest':sql_create_load_manifest_table
+}
+
+indexes = {
+        'city_points':sql_create_city_points_indexes,
+        'city_polygons':sql_create_city_polygons_indexes,
+        'ip_asn_dns':sql_create_ip_asn_dns_indexes,
+        'ip_dns':sql_create_ip_dns_indexes,
+        'ip_inference':sql_create_ip_inference_indexes,
+        'traceroutes':sql_create_traceroutes_indexes,
+        'asn_asname':sql_create_asn_asname_indexes,
+        'asn_loc':sql_create_asn_loc_indexes,
+        'asn_org':sql_create_asn_org_indexes,
+        'asn_conn':sql_create_asn_conn_indexes,
+        'asn_cone':sql_create_asn_cone_indexes,
+        'phys_nodes':sql_create_nodes_indexes,
+        'phys_nodes_conn':sql_create_nodes_conn_indexes,
+        'standard_paths':sql_create_standard_paths_indexes,
+        'submarine_cables':sql_create_submarine_cables_indexes,
+        'landing_points':sql_create_landing_points_indexes,
+        'cable_landing_points':sql_create_cable_landing_points_indexes
+}
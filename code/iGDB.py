@@ -1,6 +1,7 @@
 import sys
 import os
 from pathlib import Path
+from datetime import datetime
 import dbStructure
 import Crawling_ASRank
 import Crawling_EuroIX
@@ -18,9 +19,12 @@ import Processing_RIPEAtlas
 import Processing_RIPETraceroutes
 import Processing_Submarine
 import Processing_Voronoi
+import Index_Voronoi
+import Schedule_Processing
 import Creating_Database
 import Creating_OrgKML
 import Querying_Database
+import Analyzing_ASCones
 import Plotting_ASNLocs
 import Plotting_ShortestPath
 
@@ -30,10 +34,18 @@ class iGDB:
         self.create_db = False
         self.create_db_name = ""
         self.process_data = False
+        self.process_sources = []
+        self.process_format = "csv"
         self.update_db = False
         self.update_location = ""
         self.query_db = False
         self.query_string = ""
+        self.query_params = ()
+        self.explain = False
+        self.query_format = ""
+        self.query_output = ""
+        self.query_limit = None
+        self.query_offset = None
         self.graph_asn = False
         self.graph_asn_num = ""
         self.hull_choice = False
@@ -41,16 +53,29 @@ class iGDB:
         self.graph_shortest_path = False
         self.create_kml = False
         self.organization = ""
+        self.analyze_cones = False
+        self.analyze_asn = ""
         self.start_loc = ""
         self.end_loc = ""
+        self.jobs = 1
+        self.incremental = False
+        self.trace_windows = []
+        self.failed_stages = set()
+        # set when an option expects a value as the next argument
+        self.pending_option = ""
         self.valid_remote_locations = ["asrank", "euroix", "pch", "pdb", "he",
                 "ripeatlas", "ripetraceroute", "telegeography"]
+        self.valid_process_sources = ["asrank", "euroix", "pch", "pdb",
+                "ripeatlas", "ripetraceroute", "telegeography", "voronoi"]
         self.unprocessed_path = Path("../unprocessed")
         self.processed_path = Path("../processed")
         self.database_path = Path("../database")
         self.plot_path = Path("../plots")
         self.helper_path = Path("../helper_data")
         for a in cli_args:
+            if self.pending_option:
+                self.set_option_value(a)
+                continue
             if a == "-h" or "--help" in a:
                 self.print_help = True
                 break
@@ -74,6 +99,28 @@ class iGDB:
                 self.graph_shortest_path = True
             elif a == "-k" or "--create_kml" in a:
                 self.create_kml = True
+            elif a == "-ac" or a == "--analyze-cones":
+                self.analyze_cones = True
+            elif a == "-j" or a == "--jobs":
+                self.pending_option = "jobs"
+            elif a == "-i" or a == "--incremental":
+                self.incremental = True
+            elif self.query_db and a == "--explain":
+                self.explain = True
+            elif self.query_db and a in ["--format", "--output", "--limit", "--offset"]:
+                self.pending_option = a.replace("--", "")
+            elif self.update_db and a == "--window":
+                self.pending_option = "window"
+            elif self.process_data and a == "--format":
+                self.pending_option = "process_format"
+            elif self.process_data:
+                if a.lower() in self.valid_process_sources:
+                    self.process_sources.append(a.lower())
+                else:
+                    self.process_data = False
+                    print(f"{a} is an invalid processing source.")
+                    print(f"Please specify a valid source from one of: {self.valid_process_sources}.")
+                    return
             elif self.update_db and self.update_location == "":
                 if a.lower() in self.valid_remote_locations:
                     self.update_location = a.lower()
@@ -95,6 +142,8 @@ class iGDB:
                 self.end_loc = a
             elif self.create_kml and self.organization == "":
                 self.organization = a
+            elif self.analyze_cones and self.analyze_asn == "":
+                self.analyze_asn = a
 
         if self.update_db and self.update_location == "":
             self.update_db = False
@@ -117,6 +166,47 @@ class iGDB:
             self.create_kml = False
             print(f"Please specify an organization.")
 
+    def set_option_value(self, value):
+        if self.pending_option == "jobs":
+            try:
+                self.jobs = max(1, int(value))
+            except ValueError:
+                print(f"{value} is an invalid number of jobs. Using 1 job.")
+        elif self.pending_option == "format":
+            if value.lower() in ["csv", "ndjson"]:
+                self.query_format = value.lower()
+            else:
+                print(f"{value} is an invalid output format. Using csv.")
+                self.query_format = "csv"
+        elif self.pending_option == "process_format":
+            if value.lower() in ["csv", "parquet"]:
+                self.process_format = value.lower()
+            else:
+                print(f"{value} is an invalid processed format. Using csv.")
+        elif self.pending_option == "window":
+            window = value.split('-')
+            try:
+                for t in window:
+                    datetime.strptime(t, "%H:%M")
+                if len(window) != 2:
+                    raise ValueError
+                self.trace_windows.append((window[0], window[1]))
+            except ValueError:
+                print(f"{value} is an invalid time window. Use HH:MM-HH:MM. Ignoring it.")
+        elif self.pending_option == "output":
+            self.query_output = value
+        elif self.pending_option in ["limit", "offset"]:
+            try:
+                num = max(0, int(value))
+            except ValueError:
+                print(f"{value} is an invalid {self.pending_option}. Ignoring it.")
+                num = None
+            if self.pending_option == "limit":
+                self.query_limit = num
+            else:
+                self.query_offset = num
+        self.pending_option = ""
+
     def run_steps(self):
         if self.print_help:
             self.print_help_func()
@@ -135,6 +225,8 @@ class iGDB:
             self.plot_shortest_physical_path()
         elif self.create_kml:
             self.create_org_kml()
+        elif self.analyze_cones:
+            self.analyze_as_cones()
         else:
             self.print_help_func()
 
@@ -158,6 +250,16 @@ class iGDB:
         print("\t\tcreates a new database from local files.")
         print("\t\t<name> is the filename, created in the default location.")
         print("\t\tNOTE: Unformatted data must be processed with '-p' before this can be run.")
+        print("\t-j or --jobs <N>")
+        print("\t\tused with -c to parse the processed files with <N> worker processes,")
+        print("\t\tor with -p to run up to <N> processors at once and split the traceroutes into <N> shards.")
+        print("\t-i or --incremental")
+        print("\t\tused with -c to update an existing database in place, ", end='')
+        print("loading only the processed files that changed.")
+        print("\t-ac or --analyze-cones [ASN]")
+        print("\t\tcomputes the customer cone, upstream, provider depth and valley-free reach ", end='')
+        print("of every AS in asn_conn")
+        print("\t\tand caches them in the asn_cone table. Prints the results for <ASN> if given.")
         print("\t-ga or --graph-asn <ASN> ")
         print("\t\tplot the nodes of <ASN> on a map.")
         print("\t-gab or --graph-asn-buffer <ASN> ")
@@ -169,12 +271,19 @@ class iGDB:
         print("\t\tplot the shortest inferred physical fiber between the specified cities on a map.")
         print("\t-k or --create_kml <ORGANIZATION>")
         print("\t\tcreate a KML file with the <ORGANIZATION> nodes and edges.")
-        print("\t-p or --process")
+        print("\t-p or --process [source ...]")
         print("\t\tconverts unformatted local data files ", end='')
         print("into a format that can be added to the database")
+        source_string = ", ".join([f"'{s}'" for s in self.valid_process_sources])
+        print(f"\t\tonly processes the listed sources if any are given, from: {source_string}")
+        print("\t\tadd --format <csv|parquet> to save the traceroutes as parquet (requires pyarrow).")
         print("\t-q or --query <sql>")
         print("\t\texecutes a query of the iGIS database.")
         print("\t\t<sql> should be a valid SQL query")
+        print("\t\tadd --explain to print the query plan instead of the results.")
+        print("\t\tadd --format <csv|ndjson> to stream the results instead of printing a list,")
+        print("\t\t\tand --output <file> to stream them to <file> instead of the screen.")
+        print("\t\tadd --limit <N> and --offset <M> to return only <N> results after the first <M>.")
         print("\t-u or --update <location>")
         print("\t\tqueries remote <location> ", end='')
         print("for updates to the local unprocessed information.")
@@ -183,24 +292,23 @@ class iGDB:
             loc_string += f"'{loc}', "
         loc_string = loc_string[:-2]
         print(f"\t\t<location> must be one of: {loc_string}")
+        print("\t\tadd --window <HH:MM-HH:MM> to retrieve the 'ripetraceroute' results of that UTC window ", end='')
+        print("of yesterday instead of 12:00-12:30. It can be given more than once.")
         print("\nREQUIREMENTS")
         print("\tThe utility is written for python 3.8 and requires these packages ", end='')
         print("(listed in requirements.txt):")
         print("\t\t* geopandas")
-        print("\t\t* graphqlclient")
         print("\t\t* matplotlib")
-        print("\t\t* networkx")
         print("\t\t* numpy")
         print("\t\t* pandas")
         print("\t\t* requests")
-        print("\t\t* ripe.atlas.cousteau")
-        print("\t\t* rtree")
         print("\t\t* selenium")
         print("\t\t* shapely")
 
     def create_db_func(self):
         db_creator = Creating_Database.CreatingDatabase(self.processed_path,
-                self.database_path, self.create_db_name)
+                self.database_path, self.create_db_name, jobs=self.jobs,
+                incremental=self.incremental)
 
     def update_db_func(self):
         if not os.path.isdir(self.unprocessed_path):
@@ -226,7 +334,7 @@ class iGDB:
             ripe_crawler.run_steps()
         elif self.update_location.lower() == 'ripetraceroute':
             trace_crawler = Crawling_RIPETrace.CrawlingRIPETraceroutes(self.unprocessed_path / 'RIPETraceroutes',
-                    self.unprocessed_path / 'RIPEAtlas')
+                    self.unprocessed_path / 'RIPEAtlas', self.trace_windows)
             trace_crawler.run_steps()
         elif self.update_location.lower() == 'telegeography':
             tele_crawler = Crawling_Telegeography.CrawlingTelegeography(self.unprocessed_path / 'Telegeography')
@@ -236,52 +344,39 @@ class iGDB:
         if not os.path.isdir(self.processed_path):
             os.makedirs(self.processed_path)
 
-        # CAIDA ASRank processing
-        asrank_processor = Processing_ASRank.ProcessingASRank(self.unprocessed_path / "ASRank",
-                self.processed_path)
-        asrank_processor.run_steps()
+        voronoi_dir = self.helper_path / 'cities_Voronoi'
+        scheduler = Schedule_Processing.ProcessingScheduler(self.jobs)
+        # compile the Voronoi map once, so every processor memory-maps the same index
+        scheduler.add_stage("voronoi_index", Index_Voronoi.prepare_voronoi_index, (voronoi_dir,))
+        # the processors that standardize locations wait for the index
+        std_deps = ["voronoi_index"]
 
+        # CAIDA ASRank processing
+        scheduler.add_processor("asrank", Processing_ASRank.ProcessingASRank,
+                (self.unprocessed_path / "ASRank", self.processed_path))
         # EuroIX processing
-        print()
-        euroix_processor = Processing_EuroIX.ProcessingEuroIX(self.unprocessed_path / "EuroIX",
-                self.processed_path)
-        euroix_processor.run_steps()
-
+        scheduler.add_processor("euroix", Processing_EuroIX.ProcessingEuroIX,
+                (self.unprocessed_path / "EuroIX", self.processed_path))
         # Packet Clearinghouse processing
-        print()
-        pch_processor = Processing_PCH.ProcessingPCH(self.unprocessed_path / 'PCH',
-                self.processed_path)
-        pch_processor.run_steps()
-
+        scheduler.add_processor("pch", Processing_PCH.ProcessingPCH,
+                (self.unprocessed_path / 'PCH', self.processed_path), std_deps)
         # PeeringDB processing
-        print()
-        pdb_processor = Processing_PDB.ProcessingPDB(self.unprocessed_path / 'PeeringDB',
-                self.processed_path)
-        pdb_processor.run_steps()
-
+        scheduler.add_processor("pdb", Processing_PDB.ProcessingPDB,
+                (self.unprocessed_path / 'PeeringDB', self.processed_path), std_deps)
         # RIPE Atlas anchors and probes processing
-        print()
-        ripe_processor = Processing_RIPEAtlas.ProcessingRIPEAtlas(self.unprocessed_path / 'RIPEAtlas',
-                self.processed_path)
-        ripe_processor.run_steps()
-
+        scheduler.add_processor("ripeatlas", Processing_RIPEAtlas.ProcessingRIPEAtlas,
+                (self.unprocessed_path / 'RIPEAtlas', self.processed_path), std_deps)
         # RIPE Atlas traceroute processing
-        print()
-        trace_processor = Processing_RIPETraceroutes.ProcessingRIPETraceroutes(self.unprocessed_path / 'RIPETraceroutes',
-                self.processed_path)
-        trace_processor.run_steps()
-
+        scheduler.add_processor("ripetraceroute", Processing_RIPETraceroutes.ProcessingRIPETraceroutes,
+                (self.unprocessed_path / 'RIPETraceroutes', self.processed_path, self.jobs, self.process_format))
         # Telegeography submarine cables processing
-        print()
-        telegeography_processor = Processing_Submarine.ProcessingSubmarine(self.unprocessed_path / 'Telegeography',
-                self.processed_path, self.helper_path / 'cities_Voronoi')
-        telegeography_processor.run_steps()
-
+        scheduler.add_processor("telegeography", Processing_Submarine.ProcessingSubmarine,
+                (self.unprocessed_path / 'Telegeography', self.processed_path, voronoi_dir), std_deps)
         # Process the Voronoi diagram for the cities relations
-        print()
-        voronoi_processor = Processing_Voronoi.ProcessingVoronoi(self.helper_path / 'cities_Voronoi',
-                self.processed_path)
-        voronoi_processor.run_steps()
+        scheduler.add_processor("voronoi", Processing_Voronoi.ProcessingVoronoi,
+                (voronoi_dir, self.processed_path), std_deps)
+
+        timings, self.failed_stages = scheduler.run(self.process_sources)
 
     def query_db_func(self):
         # we assume the first file in the database directory
@@ -295,14 +390,43 @@ class iGDB:
 
         #print(f"Querying {f_name} DB for '{self.query_string}'.")
         my_querier = Querying_Database.queryDatabase(self.database_path / f_name)
-        my_results = my_querier.execute_query(self.query_string)
+        if self.explain:
+            self.print_query_plan(my_querier.explain_query(self.query_string, self.query_params))
+            return ''
+        query_string, query_params = my_querier.page_query(self.query_string,
+                self.query_params, self.query_limit, self.query_offset)
+        if self.query_format or self.query_output:
+            self.stream_query_results(my_querier, query_string, query_params)
+            return ''
+        my_results = my_querier.execute_query(query_string, query_params)
         # uncomment to print the results of the query
         print(f"{my_results}")
         return my_results
 
+    def stream_query_results(self, querier, query_string, query_params):
+        """Writes the results row by row, so large tables can be exported
+        without holding the whole result in memory."""
+        out_format = self.query_format or "csv"
+        if self.query_output:
+            with open(self.query_output, 'w', newline='') as f:
+                num_rows = querier.export_query(query_string, f, out_format, query_params)
+            print(f"Saved {num_rows} rows to {self.query_output}.")
+        else:
+            querier.export_query(query_string, sys.stdout, out_format, query_params)
+
+    def print_query_plan(self, plan):
+        """Prints the EXPLAIN QUERY PLAN rows as an indented tree."""
+        print("QUERY PLAN")
+        depth = {0:0}
+        for row in plan:
+            node_id = row[0]
+            parent = row[1]
+            depth[node_id] = depth.get(parent, 0) + 1
+            print(f"{'  ' * depth[node_id]}{row[3]}")
+
     def plot_asn_locations(self):
-        self.query_string = "SELECT latitude, longitude FROM asn_loc "
-        self.query_string += f"WHERE asn={self.graph_asn_num}; "
+        self.query_string = "SELECT latitude, longitude FROM asn_loc WHERE asn=?;"
+        self.query_params = (self.graph_asn_num,)
         asn_coords = self.query_db_func()
         if asn_coords:
             asn_plotter = Plotting_ASNLocs.PlottingASNLocs(self.graph_asn_num,
@@ -327,6 +451,17 @@ class iGDB:
         my_creator = Creating_OrgKML.CreatingOrgKML(db_file, self.organization, self.plot_path)
         my_creator.create_kml()
 
+    def analyze_as_cones(self):
+        db_file = None
+        if os.path.isdir(self.database_path):
+            for f in os.listdir(self.database_path):
+                db_file = self.database_path / f
+
+        my_analyzer = Analyzing_ASCones.AnalyzingASCones(db_file, self.analyze_asn)
+        my_analyzer.run_steps()
+
 if __name__ == "__main__":
     my_igdb = iGDB(sys.argv)
     my_igdb.run_steps()
+    if my_igdb.failed_stages:
+        sys.exit(1)